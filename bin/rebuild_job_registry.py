@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+"""
+rebuilds the index of the scratch directories from the content of the dispatcher working directory,
+e.g. after restoring or moving the working directory
+"""
+
+import os
+import argparse
+
+from cdci_data_analysis.app_logging import app_logging
+from cdci_data_analysis.analysis.job_registry import JobRegistry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-work_dir', type=str, default=None, help='dispatcher working directory, defaults to the current one')
+    parser.add_argument('-registry_path', type=str, default=None,
+                        help='path of the registry, relative to the working directory; '
+                             'defaults to DISPATCHER_JOB_REGISTRY environment variable or the built-in default')
+    parser.add_argument('-incremental', action='store_true', help='only add new directories and remove vanished ones')
+
+    args = parser.parse_args(argv)
+
+    app_logging.level_by_logger = {"": "info"}
+    app_logging.setup()
+
+    if args.work_dir is not None:
+        os.chdir(args.work_dir)
+
+    registry = JobRegistry(registry_path=args.registry_path)
+    n_scratch_dirs = registry.rebuild(full=not args.incremental)
+
+    print(f"{registry}: {n_scratch_dirs} scratch directories indexed")
+
+
+if __name__ == "__main__":
+    main()
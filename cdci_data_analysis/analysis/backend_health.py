@@ -0,0 +1,143 @@
+"""
+health of the data server backends, as found by the communication tests which precede each new query
+
+a backend which answered the communication test less than ttl_s ago is assumed to be healthy, and is not tested again.
+a circuit breaker is kept for each backend:
+
+* "closed": the backend is tested (unless recently found healthy), the queries are submitted
+* "open": after failure_threshold consecutive failures, the queries fail at once, without test, for open_s
+* "half-open": then, one query tests the backend again: the circuit is closed if it answers, opened again otherwise
+
+the transitions are counted, and passed to the listeners (e.g. to send them to logstash).
+"""
+
+import time
+import logging
+import threading
+import collections
+import typing
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class BackendHealth:
+
+    def __init__(self, ttl_s=60., failure_threshold=3, open_s=30.):
+        self.ttl_s = ttl_s
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+
+        self.transitions = collections.Counter()
+        self.listeners = []
+
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl_s=None, failure_threshold=None, open_s=None):
+        if ttl_s is not None:
+            self.ttl_s = ttl_s
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if open_s is not None:
+            self.open_s = open_s
+
+    def _backend(self, name) -> dict:
+        if name not in self._backends:
+            self._backends[name] = {'state': CLOSED,
+                                    'n_failures': 0,
+                                    'last_success': None,
+                                    'opened_at': None,
+                                    'probing': False}
+        return self._backends[name]
+
+    def _set_state(self, name, backend, state):
+        previous_state = backend['state']
+        if previous_state == state:
+            return
+
+        backend['state'] = state
+        self.transitions[(name, previous_state, state)] += 1
+        logger.warning("backend %s: circuit %s => %s", name, previous_state, state)
+
+        for listener in self.listeners:
+            try:
+                listener(name, previous_state, state)
+            except Exception as e:
+                logger.error("backend health listener %s failed: %s", listener, e)
+
+    def check(self, name) -> str:
+        """
+        "skip" if the backend was recently found healthy, "probe" if it should be tested,
+        "fail" if the circuit is open and the query should fail without test
+        """
+        now = time.time()
+
+        with self._lock:
+            backend = self._backend(name)
+
+            if backend['state'] == CLOSED:
+                if backend['last_success'] is not None and now - backend['last_success'] < self.ttl_s:
+                    return 'skip'
+                return 'probe'
+
+            if backend['state'] == OPEN:
+                if now - backend['opened_at'] < self.open_s:
+                    return 'fail'
+                self._set_state(name, backend, HALF_OPEN)
+
+            # half-open: a single query tests the backend
+            if backend['probing']:
+                return 'fail'
+
+            backend['probing'] = True
+            return 'probe'
+
+    def record_success(self, name):
+        with self._lock:
+            backend = self._backend(name)
+            backend['n_failures'] = 0
+            backend['last_success'] = time.time()
+            backend['probing'] = False
+            self._set_state(name, backend, CLOSED)
+
+    def record_failure(self, name):
+        with self._lock:
+            backend = self._backend(name)
+            backend['n_failures'] += 1
+            backend['last_success'] = None
+            backend['probing'] = False
+
+            if backend['state'] == HALF_OPEN or backend['n_failures'] >= self.failure_threshold:
+                backend['opened_at'] = time.time()
+                self._set_state(name, backend, OPEN)
+
+    def retry_in(self, name) -> float:
+        """
+        seconds until the open circuit lets a query test the backend
+        """
+        with self._lock:
+            backend = self._backend(name)
+            if backend['state'] != OPEN:
+                return 0.
+            return max(0., self.open_s - (time.time() - backend['opened_at']))
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                'backends': {name: {k: v for k, v in backend.items() if k != 'probing'}
+                             for name, backend in self._backends.items()},
+                'transitions': [{'backend': name, 'from': previous_state, 'to': state, 'count': count}
+                                for (name, previous_state, state), count in self.transitions.items()],
+            }
+
+    def reset(self):
+        with self._lock:
+            self._backends.clear()
+            self.transitions.clear()
+
+
+backend_health = BackendHealth()
@@ -0,0 +1,95 @@
+"""
+HTTP sessions shared by the data server queries of the plugins
+
+the plugins build a new data_server_query_class for each communication test, input products test and submission:
+instead of opening new connections each time, they can borrow the session of their backend, with
+Instrument.http_session (see the plugin interface in analysis/instrument.py). The sessions keep the connections alive,
+in a pool of at most pool_size connections per host, and apply the default timeouts to the requests without timeout.
+The sessions serve the queries of all the users, so they do not keep the cookies set by the backends.
+
+there is one session per backend and per process: the connections are not shared with forked processes.
+"""
+
+import os
+import logging
+import threading
+import typing
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class BackendSession(requests.Session):
+    """
+    session with default (connect, read) timeouts, which does not keep the cookies from one request to the next
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=10., read_timeout=300.):
+        super().__init__()
+
+        self.timeout = (connect_timeout, read_timeout)
+
+        # the cookies passed to a request are still sent, and kept along its redirects
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+class BackendSessions:
+
+    def __init__(self, pool_size=10, connect_timeout=10., read_timeout=300.):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        """
+        the new options apply to the sessions created from now on
+        """
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+
+        self.close_all()
+
+    def get(self, backend) -> BackendSession:
+        key = (os.getpid(), backend)
+
+        with self._lock:
+            if key not in self._sessions:
+                logger.info("creating HTTP session for backend %s: pool_size=%s timeouts=%s",
+                            backend, self.pool_size, (self.connect_timeout, self.read_timeout))
+                self._sessions[key] = BackendSession(pool_size=self.pool_size,
+                                                     connect_timeout=self.connect_timeout,
+                                                     read_timeout=self.read_timeout)
+            return self._sessions[key]
+
+    def close_all(self):
+        with self._lock:
+            for (pid, backend), session in list(self._sessions.items()):
+                if pid == os.getpid():
+                    session.close()
+            self._sessions.clear()
+
+
+backend_sessions = BackendSessions()
+
+
+def get_backend_session(backend: typing.Union[str, None]) -> BackendSession:
+    return backend_sessions.get(backend)
@@ -9,7 +9,6 @@ import requests
 import base64
 import copy
 import uuid
-import glob
 import re
 
 from typing import Optional, Tuple, Dict
@@ -23,6 +22,7 @@ from astropy import units as u
 
 from cdci_data_analysis.analysis import tokenHelper
 from ..analysis.exceptions import RequestNotUnderstood, InternalError, RequestNotAuthorized
+from ..analysis.job_registry import job_registry
 from ..flask_app.templates import body_article_product_gallery
 from ..app_logging import app_logging
 
@@ -366,16 +366,6 @@ def post_content_to_gallery(decoded_token,
     timezone = disp_conf.product_gallery_timezone
 
     sentry_dsn = getattr(disp_conf, 'sentry_url', None)
-    if sentry_dsn is not None:
-        sentry_sdk.init(
-            dsn=sentry_dsn,
-            # Set traces_sample_rate to 1.0 to capture 100%
-            # of transactions for performance monitoring.
-            # We recommend adjusting this value in production.
-            traces_sample_rate=1.0,
-            debug=True,
-            max_breadcrumbs=50,
-        )
 
     par_dic = copy.deepcopy(kwargs)
     # extract email address and then the relative user_id
@@ -1028,7 +1018,7 @@ def post_data_product_to_gallery(product_gallery_url, gallery_jwt_token, convert
         # in case job_id is passed then it automatically extracts time, instrument and product_type information
         # related to the specific job, and uses them unless provided by the user
 
-        job_id_scratch_dir_list = glob.glob(f'scratch_sid_*_jid_{job_id}*')
+        job_id_scratch_dir_list = job_registry.find_scratch_dirs(job_id)
         analysis_parameters_json_content_original = None
 
         if len(job_id_scratch_dir_list) >= 1:
@@ -27,6 +27,7 @@ from bs4 import BeautifulSoup
 
 from ..analysis.exceptions import BadRequest, MissingRequestParameter
 from ..analysis.hash import make_hash
+from ..analysis.job_registry import job_registry
 
 from datetime import datetime
 
@@ -576,15 +577,14 @@ def is_email_to_send_run_query(logger, status, time_original_request, scratch_di
         email_history_dir = os.path.join(scratch_dir + '/email_history')
         logger.info("email_history_dir: %s", email_history_dir)
 
-        email_history_dirs_same_job_id = f"scratch_*_{job_id}*/email_history"
+        email_history_dirs_same_job_id = [os.path.join(d, 'email_history') for d in job_registry.find_scratch_dirs(job_id)]
         logger.info("email_history_dirs_same_job_id: %s", email_history_dirs_same_job_id)
 
         # find all
-        submitted_email_pattern = os.path.join(
-                email_history_dirs_same_job_id,
-                'email_submitted_*.email'
-            )
-        submitted_email_files = glob.glob(submitted_email_pattern)
+        submitted_email_pattern = 'email_submitted_*.email'
+        submitted_email_files = []
+        for email_history_dir_same_job_id in email_history_dirs_same_job_id:
+            submitted_email_files += glob.glob(os.path.join(email_history_dir_same_job_id, submitted_email_pattern))
         logger.info("submitted_email_files: %s as %s", len(submitted_email_files), submitted_email_pattern)
         log_additional_info_obj['submitted_email_files'] = submitted_email_files
 
@@ -669,7 +669,9 @@ def is_email_to_send_callback(logger, status, time_original_request, scratch_dir
             logger.info("email_sending_timeout and duration_query > timeout_threshold_email %s",
                         email_sending_timeout and duration_query > timeout_threshold_email)
 
-            done_email_files = glob.glob(f'scratch_*_jid_{job_id}*/email_history/email_done_*')
+            done_email_files = []
+            for scratch_dir_same_job_id in job_registry.find_scratch_dirs(job_id):
+                done_email_files += glob.glob(os.path.join(scratch_dir_same_job_id, 'email_history', 'email_done_*'))
             log_additional_info_obj['done_email_files'] = done_email_files
             if len(done_email_files) >= 1:
                 logger.info("the email cannot be sent because the number of done emails sent is too high: %s", len(done_email_files))
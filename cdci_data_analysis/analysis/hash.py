@@ -1,5 +1,6 @@
 import hashlib
 import json
+import functools
 from collections import OrderedDict
 
 default_kw_black_list = ('session_id',
@@ -13,24 +14,42 @@ default_kw_black_list = ('session_id',
                  'async_dispatcher')
 
 
+def format_hash(x):
+    # note that even strings change hash() value between python invocations, so it's not safe to do so
+    return hashlib.md5(
+        json.dumps(sorted(x)).encode()
+    ).hexdigest()[:16]
+
+
+# scalars of these exact types are equal only if they have the same json representation
+memoized_scalar_types = (str, int, bool, type(None))
+
+
+@functools.lru_cache(maxsize=16384)
+def _scalar_hash(scalar_type, o):
+    # the type is part of the key: 1 and True are equal, but are represented differently
+    return format_hash(json.dumps(o))
+
+
 def make_hash(o):
     """
     Makes a hash from a dictionary, list, tuple or set to any level, that contains
     only other hashable types (including any lists, tuples, sets, and
     dictionaries).
 
+    The hash of a container is the hash of the sorted hashes of its elements, and a dictionary is the set of its
+    (key, value) pairs; the job_id are made with it, and must stay the same.
+    The hashes of the strings and numbers, which are repeated in most requests, are memoized.
     """
 
-    # note that even strings change hash() value between python invocations, so it's not safe to do so
-    def format_hash(x): return hashlib.md5(
-        json.dumps(sorted(x)).encode()
-    ).hexdigest()[:16]
-
     if isinstance(o, (set, tuple, list)):
-        return format_hash(tuple(map(make_hash, o)))
+        return format_hash([make_hash(x) for x in o])
+
+    elif isinstance(o, dict):
+        return format_hash([format_hash((make_hash(k), make_hash(v))) for k, v in o.items()])
 
-    elif isinstance(o, (dict, OrderedDict)):
-        return make_hash(tuple(o.items()))        
+    if type(o) in memoized_scalar_types:
+        return _scalar_hash(type(o), o)
 
     # this takes care of various strange objects which can not be properly represented
     return format_hash(json.dumps(o))
@@ -41,6 +41,7 @@ from .catalog import BasicCatalog
 from .products import QueryOutput
 from .queries import ProductQuery, SourceQuery, InstrumentQuery
 from .io_helper import upload_file
+from .backend_sessions import get_backend_session
 from .exceptions import RequestNotUnderstood, RequestNotAuthorized, InternalError
 
 from oda_api.api import DispatcherAPI, RemoteException, DispatcherException, DispatcherNotAvailable, UnexpectedDispatcherStatusCode, RequestNotUnderstood as RequestNotUnderstoodOdaApi
@@ -81,6 +82,98 @@ non_parameter_args = ['instrument',
 # some arguments may be used to set values of several parameters 
 # (e.g. for Time(name='T1') and Time(name='T2') arguments will be T1, T2, T_format)
 
+class ParameterNormalizers(dict):
+    """
+    the compiled ParameterNormalizer of an instrument, by product_type: shared by the copies of the instrument
+    made for each request (see importer.get_instrument)
+    """
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class ParameterNormalizer:
+    """
+    the parameters of the queries of one product_type, resolved once for the instrument:
+    normalizing the arguments of a request is then one pass over these parameters, and one over the arguments
+
+    the parameters are kept by position in the queries, and looked up in the instrument being normalized,
+    since each request uses its own copy of the instrument
+    """
+
+    def __init__(self, instrument, product_type):
+        if product_type is not None:
+            query_obj = instrument.get_query_by_name(instrument.get_product_query_name(product_type))
+            # the parameters of the requested query, but also of the instrument query and source query
+            queries = [query_obj, instrument.instrumet_query, instrument.src_query]
+        else:
+            queries = instrument._queries_list
+
+        self.parameters = []
+        for query in queries:
+            # the last one with the name, as get_query_by_name
+            query_position = max(i for i, _query in enumerate(instrument._queries_list) if _query is query)
+
+            for par_position, par in enumerate(query.parameters):
+                # in some cases a parameter is set without a name (eg UserCatalog)
+                if par.name is None:
+                    continue
+
+                if par.units_name is not None and par.default_units is None:
+                    error = "Error when setting the parameter %s: default unit not specified" % par.name
+                elif par.par_format_name is not None and par.par_default_format is None:
+                    error = "Error when setting the parameter %s: default format not specified" % par.name
+                else:
+                    error = None
+
+                if par.par_format_name is None:
+                    instrument.logger.warning("units_name for the parameter %s not specified", par.name)
+
+                self.parameters.append((query_position, par_position, par.name,
+                                        par.units_name, par.default_units,
+                                        par.par_format_name, par.par_default_format,
+                                        error))
+
+        self.known_argument_names = frozenset(non_parameter_args + instrument.get_arguments_name_list())
+
+    def normalize(self, instrument, arg_dic, verbose=False):
+        updated_arg_dic = arg_dic.copy()
+        excluded_names = set(params_not_to_be_included)
+        queries_list = instrument._queries_list
+
+        for query_position, par_position, name, units_name, default_units, par_format_name, par_default_format, error \
+                in self.parameters:
+            # some don't have to be set (eg scw_list)
+            if name in excluded_names:
+                continue
+
+            par = queries_list[query_position].parameters[par_position]
+
+            # set the value for par to a default format,
+            # or to a default value if this is not included within the request
+            updated_arg_dic[name] = par.set_value_from_form(arg_dic, verbose=verbose)
+
+            if error is not None:
+                raise InternalError(error)
+
+            if units_name is not None:
+                updated_arg_dic[units_name] = default_units
+            if par_format_name is not None:
+                updated_arg_dic[par_format_name] = par_default_format
+
+            if name == "scw_list":
+                instrument.logger.info("set_pars_from_dic>> scw_list is %s", par.value)
+
+        instrument.logger.debug("set_pars_from_dic>> normalized %s parameters", len(self.parameters))
+
+        unknown_arguments_name_list = [k for k in updated_arg_dic if k not in self.known_argument_names]
+
+        return updated_arg_dic, unknown_arguments_name_list
+
+
 class DataServerQueryClassNotSet(Exception):
     pass
 
@@ -126,6 +219,8 @@ class Instrument:
         
         self.allow_unknown_arguments = allow_unknown_arguments
 
+        self._parameter_normalizers = ParameterNormalizers()
+
     def __repr__(self):
         return f"[ {self.__class__.__name__} : {self.name} ]"
 
@@ -146,66 +241,37 @@ class Instrument:
     def _check_names(self):
         pass
 
-    def set_pars_from_dic(self, arg_dic, verbose=False):
-        product_type = arg_dic.get('product_type', None)
-        if product_type is not None:
-            query_name = self.get_product_query_name(product_type)
-            query_obj = self.get_query_by_name(query_name)
-            # loop over the list of parameters for the requested query,
-            # but also of the instrument query and source query
-            param_list = (query_obj.parameters +
-                          self.instrumet_query.parameters +
-                          self.src_query.parameters)
-        else:
-            param_list = [par for _query in self._queries_list for par in _query.parameters]
+    def get_parameter_normalizer(self, product_type) -> ParameterNormalizer:
+        normalizers = self.__dict__.get('_parameter_normalizers')
+        if normalizers is None:
+            # instruments of the plugins which do not call Instrument.__init__
+            normalizers = self._parameter_normalizers = ParameterNormalizers()
 
-        updated_arg_dic = arg_dic.copy()
-        
-        for par in param_list:
-            self.logger.info("before normalizing, set_pars_from_dic>> par: %s par.name: %s par.value: %s par_dic[par.name]: %s",
-                             par, par.name, par.value, arg_dic.get(par.name, None))
-
-            # this is required because in some cases a parameter is set without a name (eg UserCatalog),
-            # or they don't have to set (eg scw_list)
-            if par.name is not None and par.name not in params_not_to_be_included:
-                # set the value for par to a default format,
-                # or to a default value if this is not included within the request
-                updated_arg_dic[par.name] = par.set_value_from_form(arg_dic, verbose=verbose)
-
-                if par.units_name is not None:
-                    if par.default_units is not None:
-                        updated_arg_dic[par.units_name] = par.default_units
-                    else:
-                        raise InternalError("Error when setting the parameter %s: "
-                                            "default unit not specified" % par.name)
-                if par.par_format_name is not None:
-                    if par.par_default_format is not None:
-                        updated_arg_dic[par.par_format_name] = par.par_default_format
-                    else:
-                        raise InternalError("Error when setting the parameter %s: "
-                                            "default format not specified" % par.name)
-                else:
-                    self.logger.warning("units_name for the parameter %s not specified", par.name)
+        # the queries of some plugins may change after the instrument is built
+        key = (product_type, tuple(len(_query.parameters) for _query in self._queries_list))
+
+        normalizer = normalizers.get(key)
+        if normalizer is None:
+            normalizer = normalizers[key] = ParameterNormalizer(self, product_type)
 
-            self.logger.info("after normalizing, set_pars_from_dic>> par: %s par.name: %s par.value: %s par_dic[par.name]: %s",
-                             par, par.name, par.value, arg_dic.get(par.name, None))
+        return normalizer
+
+    def set_pars_from_dic(self, arg_dic, verbose=False):
+        normalizer = self.get_parameter_normalizer(arg_dic.get('product_type', None))
 
-            if par.name == "scw_list":
-                self.logger.info("set_pars_from_dic>> scw_list is %s", par.value)
+        updated_arg_dic, unknown_arguments_name_list = normalizer.normalize(self, arg_dic, verbose=verbose)
 
         if arg_dic.get('allow_unknown_args', None):
             self.allow_unknown_arguments = arg_dic.get('allow_unknown_args', 'False') == 'True'
-        known_argument_names = non_parameter_args + self.get_arguments_name_list()
         self.unknown_arguments_name_list = []
-        for k in list(updated_arg_dic.keys()):
-            if k not in known_argument_names:
-                if not self.allow_unknown_arguments:
-                    updated_arg_dic.pop(k) 
-                    self.logger.warning("argument '%s' is in the request but not used by instrument '%s', removing it", k, self.name)
-                    self.unknown_arguments_name_list.append(k)
-                else:
-                    self.logger.warning("argument '%s' not defined for instrument '%s'", k, self.name)
-        
+        for k in unknown_arguments_name_list:
+            if not self.allow_unknown_arguments:
+                updated_arg_dic.pop(k)
+                self.logger.warning("argument '%s' is in the request but not used by instrument '%s', removing it", k, self.name)
+                self.unknown_arguments_name_list.append(k)
+            else:
+                self.logger.warning("argument '%s' not defined for instrument '%s'", k, self.name)
+
         return updated_arg_dic
 
     def set_par(self,par_name,value):
@@ -223,6 +289,14 @@ class Instrument:
 
         return p
 
+    @property
+    def http_session(self):
+        """
+        HTTP session for the backend of the instrument, shared by the data_server_query_class instances of the process:
+        using it, instead of requests.get/post, keeps the connections to the backend alive
+        """
+        return get_backend_session(self.name)
+
     def test_communication(self, config, logger=None):
         if self.data_server_query_class is not None:
             return self.data_server_query_class(config=config, instrument=self).test_communication(logger=logger)
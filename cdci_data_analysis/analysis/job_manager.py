@@ -25,7 +25,6 @@ from builtins import (bytes, str, open, super, range,
 
 
 __author__ = "Andrea Tramacere"
-import glob
 
 import json
 import  os
@@ -48,6 +47,7 @@ logger = logging.getLogger(__name__)
 # relative import eg: from .mod import f
 
 from ..analysis.io_helper import FilePath
+from ..analysis.job_state_store import get_job_state_store
 
 
 class Job(object):
@@ -66,7 +66,8 @@ class Job(object):
                  status_kw_name='action',
                  aliased=False,
                  token=None,
-                 time_request=None):
+                 time_request=None,
+                 state_store=None):
 
         #if aliased is False:
         #
@@ -87,6 +88,10 @@ class Job(object):
         self.token=token
         self.time_request=time_request
 
+        if state_store is None:
+            state_store = get_job_state_store()
+        self.state_store = state_store
+
         #self.job_id=job_id
         #self.session_id=session_id
         #self.status=status
@@ -162,17 +167,16 @@ class Job(object):
     def get_status(self):
         return self.monitor['status']
 
-    def updated_dataserver_monitor(self,):
+    def updated_dataserver_monitor(self, since=None):
         # TODO: combine all files
 
-        try:
-            with open(self.file_path, 'r') as infile:
-                #print("=====> reading  from ", self.file_path)
-                self.monitor = json.load(infile,)
+        monitor = self.state_store.read(os.path.dirname(self.file_path), self.file_name)
 
-            logger.info('JOB MANAGER CHECK-->', self.monitor)
-        except Exception as e:
-            logger.warning("no current job state: %s", e)
+        if monitor is not None:
+            self.monitor = monitor
+            logger.info('JOB MANAGER CHECK--> %s', self.monitor)
+        else:
+            logger.warning("no current job state in %s", self.file_path)
             self.set_unaccessible()
 
         return self.monitor
@@ -209,9 +213,7 @@ class Job(object):
         if full_dict is not None:
             self.monitor['full_report_dict'] = full_dict
 
-        with open(self.file_path, 'w') as outfile:
-            my_json_str = json.dumps(self.monitor)
-            outfile.write(u'%s' % my_json_str)
+        self.state_store.write(os.path.dirname(self.file_path), self.file_name, self.monitor)
 
     def get_call_back_url(self):
         if self.dispatcher_callback_url_base is not None:
@@ -250,7 +252,8 @@ class OsaJob(Job):
                  par_dic=None,
                  aliased=False,
                  token=None,
-                 time_request=None):
+                 time_request=None,
+                 state_store=None):
 
         file_id=None
         file_message=None
@@ -289,73 +292,55 @@ class OsaJob(Job):
                                   status_kw_name=status_kw_name,
                                   aliased=aliased,
                                   token=token,
-                                  time_request=time_request)
-
-    def updated_dataserver_monitor(self,work_dir=None):
+                                  time_request=time_request,
+                                  state_store=state_store)
+
+    def updated_dataserver_monitor(self, work_dir=None, since=None):
+        """
+        the job status is derived from the aggregate of all the job monitor records,
+        only the progress reports written after the sequence number since are returned
+        """
         if work_dir is None:
             work_dir=self.work_dir
         else:
             raise NotImplementedError
 
-        job_files_list = sorted(glob.glob(work_dir + '/job_monitor*.json'), key=os.path.getmtime)
-
-        logger.info("\033[33m found %s job log files in %s", len(job_files_list), work_dir)
-
-        #print('OSA JOB get data server status form files',job_files_list)
-        job_done=False
-        job_failed=False
-        progress=False
-        full_report_dict_list=[]
+        aggregate = self.state_store.read_aggregate(work_dir)
 
-        n_progress = 0
+        logger.info("\033[33m found %s job monitors in %s, last sequence number %s",
+                    aggregate.n_by_status, work_dir, aggregate.seq)
 
-        for job_file in job_files_list:
-            try:
-                with open(job_file, 'r') as infile:
-                    try:
-                        self.monitor = json.load(infile, encoding='utf-8')
-                    except Exception as e:
-                        # happens in py3.9 at least
-                        infile.seek(0)
-                        self.monitor = json.load(infile)                    
+        last_record = aggregate.last_record()
+        if last_record is not None:
+            _, _, last_monitor = last_record
+            if last_monitor is not None:
+                self.monitor = dict(last_monitor)
 
-                    if self.monitor['status'] not in self._allowed_job_status_values_:
-                        raise Exception("not allowed status in file")
-                        #self.monitor['status']
-
-                    if self.monitor['status'] == 'done':
-                        job_done = True
-                    elif self.monitor['status'] == 'failed':
-                        job_failed = True
-
-                    if 'full_report_dict' in  self.monitor.keys():
-                        full_report_dict_list.append(self.monitor['full_report_dict'])
-
-                        if 'progressing' in self.monitor['full_report_dict'].keys():
-                            progress = True
-                            n_progress += 1
-
-            except Exception:
+            if last_monitor is None or last_monitor.get('status', None) not in self._allowed_job_status_values_:
                 #TODO add sentry here
                 self.set_unaccessible()
 
-        print(f"found {n_progress} PROGRESS entries in {len(job_files_list)} job_files ({work_dir}/job_monitor*.json)")
+        print(f"found {aggregate.n_progress} PROGRESS entries in {sum(aggregate.n_by_status.values())} job monitors ({work_dir})")
 
-        if progress is True:
+        if aggregate.n_progress > 0:
             self.monitor['status'] = 'progress'
 
-        if job_done == True:
+        if aggregate.n_by_status.get('done', 0) > 0:
             self.monitor['status'] = 'done'
 
-        if job_failed == True:
+        if aggregate.n_by_status.get('failed', 0) > 0:
             self.monitor['status'] = 'failed'
 
-        self.monitor['full_report_dict_list']=full_report_dict_list
+        self.monitor['full_report_dict_list'] = aggregate.full_report_dict_list(since)
+        self.monitor['n_progress'] = aggregate.n_progress
+        self.monitor['last_progress'] = aggregate.last_progress
+        self.monitor['seq'] = aggregate.seq
+
         print('\033[32mfinal status', self.monitor['status'], '\033[0m')
         return self.monitor
 
 
-def job_factory(instrument_name, scratch_dir, dispatcher_host, dispatcher_port, dispatcher_callback_url_base, session_id, job_id, par_dic, aliased=False, token=None, time_request=None):
+def job_factory(instrument_name, scratch_dir, dispatcher_host, dispatcher_port, dispatcher_callback_url_base, session_id, job_id, par_dic, aliased=False, token=None, time_request=None, state_store=None):
     # TODO does this list need to be updated?
     osa_list = ['jemx', 'isgri', 'empty-async']
 
@@ -372,7 +357,8 @@ def job_factory(instrument_name, scratch_dir, dispatcher_host, dispatcher_port,
              par_dic=par_dic,
              aliased=aliased,
              token=token,
-             time_request=time_request)
+             time_request=time_request,
+             state_store=state_store)
 
     else:
         j = Job(
@@ -386,6 +372,7 @@ def job_factory(instrument_name, scratch_dir, dispatcher_host, dispatcher_port,
              job_id=job_id,
              aliased=aliased,
              token=token,
-             time_request=time_request)
+             time_request=time_request,
+             state_store=state_store)
 
     return j
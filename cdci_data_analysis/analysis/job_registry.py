@@ -0,0 +1,284 @@
+"""
+persistent index of the scratch_sid_*_jid_* directories found in the dispatcher working directory
+
+with many jobs, globbing the working directory is a full readdir, and it is done several times per request;
+the registry keeps one row per scratch directory in an SQLite file, so that lookups by job_id and session_id
+are indexed queries.
+
+the registry is kept consistent with directories created or removed outside of the dispatcher (e.g. by hand, or by tests)
+by remembering the mtime of the working directory at the last scan: before each lookup, the working directory is
+stat'ed, and it is re-scanned only if it was modified since then by anything else than the dispatcher itself.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+scratch_dir_pattern = re.compile(
+    r"^scratch(?:_sid_(?P<session_id>.*?))?_jid_(?P<job_id>.+?)(?P<aliased_marker>_aliased|)$")
+
+# on filesystems with coarse (one second) mtime resolution, a directory modified just after a scan may keep the same mtime:
+# such a scan is only trusted if it happened well after the recorded modification
+mtime_granularity_s = 2
+
+default_registry_path = os.path.join('.dispatcher-job-registry', 'job_registry.sqlite')
+
+
+class JobRegistry:
+
+    def __init__(self, registry_path=None, work_dir=''):
+        if registry_path is None:
+            registry_path = os.environ.get('DISPATCHER_JOB_REGISTRY', default_registry_path)
+
+        self.registry_path = registry_path
+        self.work_dir = work_dir
+        self._local = threading.local()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.registry_path} ]"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # one connection per thread and per process: workers may be forked after the module is imported
+        if getattr(self._local, 'pid', None) != os.getpid():
+            registry_dir = os.path.dirname(self.registry_path)
+            if registry_dir != '':
+                os.makedirs(registry_dir, exist_ok=True)
+
+            connection = sqlite3.connect(self.registry_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS scratch_dirs (
+                    name TEXT PRIMARY KEY,
+                    session_id TEXT,
+                    job_id TEXT NOT NULL,
+                    aliased INTEGER NOT NULL,
+                    mtime REAL,
+                    ctime REAL,
+                    analysis_parameters TEXT,
+                    analysis_parameters_mtime REAL
+                );
+                CREATE INDEX IF NOT EXISTS scratch_dirs_job_id ON scratch_dirs (job_id);
+                CREATE INDEX IF NOT EXISTS scratch_dirs_session_id ON scratch_dirs (session_id);
+                CREATE TABLE IF NOT EXISTS registry_state (
+                    key TEXT PRIMARY KEY,
+                    value
+                );
+            """)
+
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return self._local.connection
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    @staticmethod
+    def parse_scratch_dir_name(name) -> typing.Union[dict, None]:
+        r = scratch_dir_pattern.match(name)
+        if r is None:
+            return None
+
+        return dict(session_id=r.group('session_id'),
+                    job_id=r.group('job_id'),
+                    aliased_marker=r.group('aliased_marker'))
+
+    def stat_work_dir(self):
+        return os.stat(self.work_dir or os.curdir).st_mtime_ns
+
+    def _get_state(self, key):
+        row = self.connection.execute("SELECT value FROM registry_state WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return row['value']
+
+    def _set_state(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO registry_state (key, value) VALUES (?, ?)", (key, value))
+
+    def _mark_synced(self, work_dir_mtime_ns):
+        self._set_state('work_dir_mtime_ns', work_dir_mtime_ns)
+        self._set_state('synced_at', time.time())
+
+    def is_synced(self, work_dir_mtime_ns=None) -> bool:
+        if work_dir_mtime_ns is None:
+            work_dir_mtime_ns = self.stat_work_dir()
+
+        synced_mtime_ns = self._get_state('work_dir_mtime_ns')
+        synced_at = self._get_state('synced_at')
+
+        if synced_mtime_ns is None or synced_at is None:
+            return False
+
+        if int(synced_mtime_ns) != work_dir_mtime_ns:
+            return False
+
+        if work_dir_mtime_ns % 1_000_000_000 == 0:
+            return synced_at - work_dir_mtime_ns / 1e9 > mtime_granularity_s
+
+        return True
+
+    def _insert(self, name, scratch_dir_info, stat_result=None):
+        if stat_result is None:
+            stat_result = os.stat(self.path(name))
+
+        self.connection.execute(
+            "INSERT OR IGNORE INTO scratch_dirs (name, session_id, job_id, aliased, mtime, ctime) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (name,
+             scratch_dir_info['session_id'],
+             scratch_dir_info['job_id'],
+             int(scratch_dir_info['aliased_marker'] != ''),
+             stat_result.st_mtime,
+             stat_result.st_ctime))
+
+    def register(self, scratch_dir, work_dir_mtime_ns_before=None):
+        """
+        records a scratch directory just created by the dispatcher;
+        if the working directory was in sync before the creation, it stays in sync
+        """
+        name = os.path.relpath(scratch_dir, self.work_dir or os.curdir)
+        scratch_dir_info = self.parse_scratch_dir_name(name)
+        if scratch_dir_info is None:
+            logger.warning("not registering %s: not a scratch directory name", scratch_dir)
+            return
+
+        self._insert(name, scratch_dir_info)
+
+        if work_dir_mtime_ns_before is not None and self.is_synced(work_dir_mtime_ns_before):
+            self._mark_synced(self.stat_work_dir())
+
+    def rebuild(self, full=True) -> int:
+        """
+        imports the existing directory tree; with full=True, all the records are dropped first
+        """
+        t0 = time.time()
+        work_dir_mtime_ns = self.stat_work_dir()
+
+        found = {}
+        with os.scandir(self.work_dir or os.curdir) as it:
+            for entry in it:
+                if entry.name.startswith('scratch') and entry.is_dir():
+                    scratch_dir_info = self.parse_scratch_dir_name(entry.name)
+                    if scratch_dir_info is not None:
+                        found[entry.name] = scratch_dir_info
+
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if full:
+                connection.execute("DELETE FROM scratch_dirs")
+                known = set()
+            else:
+                known = set(row['name'] for row in connection.execute("SELECT name FROM scratch_dirs"))
+                vanished = known - set(found)
+                connection.executemany("DELETE FROM scratch_dirs WHERE name = ?", [(n,) for n in vanished])
+
+            for name, scratch_dir_info in found.items():
+                if name not in known:
+                    try:
+                        self._insert(name, scratch_dir_info)
+                    except FileNotFoundError:
+                        pass
+
+            self._mark_synced(work_dir_mtime_ns)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        logger.info("job registry %s synced with %s scratch directories in %.3g s",
+                    self.registry_path, len(found), time.time() - t0)
+
+        return len(found)
+
+    def sync(self) -> bool:
+        """
+        re-scans the working directory only if it was modified since the last scan
+        """
+        if self.is_synced():
+            return False
+
+        self.rebuild(full=False)
+        return True
+
+    def _select(self, where, args) -> typing.List[sqlite3.Row]:
+        rows = self.connection.execute(f"SELECT * FROM scratch_dirs WHERE {where} ORDER BY name", args).fetchall()
+
+        existing_rows = []
+        for row in rows:
+            if os.path.isdir(self.path(row['name'])):
+                existing_rows.append(row)
+            else:
+                self.connection.execute("DELETE FROM scratch_dirs WHERE name = ?", (row['name'],))
+
+        return existing_rows
+
+    def find_scratch_dirs(self,
+                          job_id,
+                          session_id=None,
+                          aliased: typing.Union[bool, None] = None) -> typing.List[str]:
+        where = "job_id = ?"
+        args = [job_id]
+
+        if session_id is not None:
+            where += " AND session_id = ?"
+            args.append(session_id)
+
+        if aliased is not None:
+            where += " AND aliased = ?"
+            args.append(int(aliased))
+
+        self.sync()
+
+        return [self.path(row['name']) for row in self._select(where, args)]
+
+    def list_scratch_dirs(self, job_id_prefix=None) -> typing.List[dict]:
+        self.sync()
+
+        if job_id_prefix is None:
+            rows = self._select("1", [])
+        else:
+            rows = self._select("substr(job_id, 1, ?) = ?", [len(job_id_prefix), job_id_prefix])
+
+        return [dict(scratch_dir=self.path(row['name']),
+                     session_id=row['session_id'],
+                     job_id=row['job_id'],
+                     aliased_marker='_aliased' if row['aliased'] else '')
+                for row in rows]
+
+    def get_analysis_parameters(self, job_id) -> typing.Union[dict, None]:
+        """
+        returns the analysis parameters stored for job_id in any session, as recorded in analysis_parameters.json
+        """
+        self.sync()
+
+        for row in self._select("job_id = ?", [job_id]):
+            fn = os.path.join(self.path(row['name']), 'analysis_parameters.json')
+            try:
+                mtime = os.stat(fn).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if row['analysis_parameters'] is not None and row['analysis_parameters_mtime'] == mtime:
+                return json.loads(row['analysis_parameters'])
+
+            with open(fn) as f:
+                analysis_parameters_json = f.read()
+
+            analysis_parameters = json.loads(analysis_parameters_json)
+
+            self.connection.execute(
+                "UPDATE scratch_dirs SET analysis_parameters = ?, analysis_parameters_mtime = ? WHERE name = ?",
+                (analysis_parameters_json, mtime, row['name']))
+
+            return analysis_parameters
+
+
+job_registry = JobRegistry()
@@ -0,0 +1,469 @@
+"""
+storage of the job monitor records, written by the dispatcher when a job is submitted and on each call_back
+
+each record has a name (e.g. job_monitor.json, or job_monitor_<node>_<message>_.json for the OSA jobs),
+a new record with the same name replaces the previous one.
+records are returned in the order in which they were last written. They are summarized in a JobStateAggregate,
+with the counts needed to derive the job status; the "log" and "redis" backends persist this summary apart from
+the records, and only update it with the records written since, so that reading the status does not read the records.
+
+* "file": one json file per record in the job work_dir, the original layout
+* "log": each record is appended to a log in the job work_dir, and the summary is updated in a state file when read
+* "redis": records are kept in redis, in the broker used by celery, and the summary is updated as they are written
+"""
+
+import os
+import glob
+import json
+import logging
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class JobStateAggregate:
+    """
+    running summary of the job monitor records: the counts which are needed to derive the job status,
+    the last progress report and the last record, updated as each record is added
+
+    each record has a sequence number, increasing with each write; records can be requested since a sequence number,
+    they are read from the store only then
+    """
+
+    def __init__(self, state=None, read_records=None):
+        if state is None:
+            state = {'seq': 0,
+                     'n_by_status': {},
+                     'n_progress': 0,
+                     'last_progress': None,
+                     'last_record': None}
+
+        self.state = state
+        self._read_records = read_records
+
+    @property
+    def seq(self):
+        return self.state['seq']
+
+    @property
+    def n_by_status(self):
+        return self.state['n_by_status']
+
+    @property
+    def n_progress(self):
+        return self.state['n_progress']
+
+    @property
+    def last_progress(self):
+        return self.state['last_progress']
+
+    @staticmethod
+    def _is_progress(monitor):
+        return isinstance(monitor, dict) and 'progressing' in monitor.get('full_report_dict', {})
+
+    @classmethod
+    def record_meta(cls, monitor) -> list:
+        """
+        what is counted for a record: [status, whether it is a progress report];
+        to be kept by the stores, for the record to be discounted when it is replaced
+        """
+        status = monitor.get('status', None) if isinstance(monitor, dict) else None
+        return [str(status), cls._is_progress(monitor)]
+
+    def _count(self, meta, increment):
+        status, is_progress = meta
+        n_by_status = self.state['n_by_status']
+        n_by_status[status] = n_by_status.get(status, 0) + increment
+
+        if is_progress:
+            self.state['n_progress'] += increment
+
+    def add(self, seq, name, monitor, replaced_meta=None):
+        """
+        accounts for the record, replacing the record with the same name, if any, which had replaced_meta
+        """
+        if replaced_meta is not None:
+            self._count(replaced_meta, -1)
+
+        self._count(self.record_meta(monitor), 1)
+
+        if self._is_progress(monitor):
+            self.state['last_progress'] = monitor['full_report_dict']
+
+        if seq > self.state['seq']:
+            self.state['seq'] = seq
+            self.state['last_record'] = [seq, name, monitor]
+
+    def records(self, since=None) -> typing.List[typing.Tuple[int, str, typing.Union[dict, None]]]:
+        """
+        returns (seq, name, monitor) for the records written after since
+        """
+        if self._read_records is None:
+            return []
+
+        return self._read_records(since)
+
+    def last_record(self):
+        if self.state['last_record'] is not None:
+            return tuple(self.state['last_record'])
+
+    def full_report_dict_list(self, since=None):
+        return [monitor['full_report_dict']
+                for _, _, monitor in self.records(since)
+                if isinstance(monitor, dict) and 'full_report_dict' in monitor]
+
+
+class JobStateStore:
+    backend_name = None
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} ]"
+
+    def write(self, work_dir, name, monitor: dict):
+        raise NotImplementedError
+
+    def read(self, work_dir, name) -> typing.Union[dict, None]:
+        for _, record_name, monitor in self.records(work_dir):
+            if record_name == name:
+                return monitor
+
+    def read_aggregate(self, work_dir) -> JobStateAggregate:
+        """
+        returns the summary of all the records; its records are read from the store when requested
+        """
+        raise NotImplementedError
+
+    def records(self, work_dir, since=None) -> typing.List[typing.Tuple[int, str, typing.Union[dict, None]]]:
+        """
+        returns (seq, name, monitor) for the records written after since, in which monitor is None for the records
+        which could not be read
+        """
+        raise NotImplementedError
+
+    def read_all_named(self, work_dir) -> typing.List[typing.Tuple[str, typing.Union[dict, None]]]:
+        return [(name, monitor) for _, name, monitor in self.records(work_dir)]
+
+    def read_all(self, work_dir) -> typing.List[typing.Union[dict, None]]:
+        return [monitor for _, _, monitor in self.records(work_dir)]
+
+
+class FileJobStateStore(JobStateStore):
+    backend_name = 'file'
+
+    def write(self, work_dir, name, monitor):
+        with open(os.path.join(work_dir, name), 'w') as outfile:
+            outfile.write(json.dumps(monitor))
+
+    def read(self, work_dir, name):
+        try:
+            with open(os.path.join(work_dir, name), 'r') as infile:
+                return json.load(infile)
+        except Exception as e:
+            logger.warning("unable to read job monitor %s in %s: %s", name, work_dir, e)
+            return None
+
+    def records(self, work_dir, since=None):
+        # the modification time orders the records, as the sequence number
+        job_files_list = []
+        for fn in glob.glob(work_dir + '/job_monitor*.json'):
+            try:
+                job_files_list.append((os.stat(fn).st_mtime_ns, os.path.basename(fn)))
+            except FileNotFoundError:
+                pass
+
+        logger.info("found %s job monitor files in %s", len(job_files_list), work_dir)
+
+        return [(mtime_ns, name, self.read(work_dir, name))
+                for mtime_ns, name in sorted(job_files_list, key=lambda x: x[0])
+                if since is None or mtime_ns > since]
+
+    def read_aggregate(self, work_dir):
+        # all the records are read anyway, they are kept for the report list
+        records = self.records(work_dir)
+
+        def read_records(since=None):
+            return [record for record in records if since is None or record[0] > since]
+
+        aggregate = JobStateAggregate(read_records=read_records)
+        for seq, name, monitor in records:
+            aggregate.add(seq, name, monitor)
+
+        return aggregate
+
+
+class LogJobStateStore(JobStateStore):
+    """
+    writes are appends of one line to the log, independently on the number of records already written;
+    the sequence number of a record is the offset of the end of its line, so that the records written since
+    a sequence number are read from there;
+    the summary is kept in a small state file, and only updated with the part of the log written since;
+    the status and the position in the log of the last record of each name are kept in an index, which is
+    only read when the summary is updated, to discount the replaced records, or when a record is read by name
+    """
+    backend_name = 'log'
+
+    log_file_name = 'job_monitor.log'
+    state_file_name = 'job_monitor_state.json'
+    index_file_name = 'job_monitor_index.json'
+
+    def write(self, work_dir, name, monitor):
+        line = json.dumps({'name': name, 'monitor': monitor}) + '\n'
+        # a single write in append mode: concurrent call_backs do not interleave their lines
+        fd = os.open(os.path.join(work_dir, self.log_file_name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def _load(self, work_dir, file_name, default):
+        try:
+            with open(os.path.join(work_dir, file_name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def _save(self, work_dir, file_name, content):
+        fn = os.path.join(work_dir, file_name)
+        tmp_fn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fn, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp_fn, fn)
+
+    def _read_log(self, work_dir, offset=0):
+        """
+        returns the complete lines of the log after offset, with the offset of their beginning
+        """
+        try:
+            with open(os.path.join(work_dir, self.log_file_name), 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+        except FileNotFoundError:
+            tail = b''
+
+        # a line being written might not be complete yet
+        lines = []
+        for line in tail[:tail.rfind(b'\n') + 1].splitlines(keepends=True):
+            lines.append((offset, line))
+            offset += len(line)
+
+        return lines
+
+    def _update(self, work_dir, state, index=None):
+        """
+        adds the lines written since the state to it, and to the index; returns the index, if it had to be read
+        """
+        lines = self._read_log(work_dir, state['log_offset'])
+        if len(lines) == 0 and index is None:
+            return None
+
+        if index is None:
+            index = self._load(work_dir, self.index_file_name, {'log_offset': 0, 'records': {}})
+
+        if index['log_offset'] != state['log_offset']:
+            # saved by a concurrent reader, before or after the state: both are built again from the whole log
+            state.update(log_offset=0, aggregate=None)
+            index = {'log_offset': 0, 'records': {}}
+            lines = self._read_log(work_dir)
+
+        if len(lines) == 0:
+            return index
+
+        aggregate = JobStateAggregate(state['aggregate'])
+        for offset, line in lines:
+            entry = json.loads(line)
+            name, monitor = entry['name'], entry['monitor']
+
+            replaced = index['records'].get(name)
+            aggregate.add(offset + len(line), name, monitor, replaced_meta=None if replaced is None else replaced[2:])
+            index['records'][name] = [aggregate.seq, offset] + aggregate.record_meta(monitor)
+
+        log_offset = lines[-1][0] + len(lines[-1][1])
+        index['log_offset'] = state['log_offset'] = log_offset
+        state['aggregate'] = aggregate.state
+
+        self._save(work_dir, self.index_file_name, index)
+        self._save(work_dir, self.state_file_name, state)
+
+        return index
+
+    def read_aggregate(self, work_dir):
+        state = self._load(work_dir, self.state_file_name, {'log_offset': 0, 'aggregate': None})
+        self._update(work_dir, state)
+
+        return JobStateAggregate(state['aggregate'],
+                                 read_records=lambda since=None: self.records(work_dir, since))
+
+    def _read_index(self, work_dir):
+        state = self._load(work_dir, self.state_file_name, {'log_offset': 0, 'aggregate': None})
+        index = self._load(work_dir, self.index_file_name, {'log_offset': 0, 'records': {}})
+        return self._update(work_dir, state, index)
+
+    def read(self, work_dir, name):
+        record = self._read_index(work_dir)['records'].get(name)
+        if record is None:
+            return None
+
+        _, offset = record[:2]
+        with open(os.path.join(work_dir, self.log_file_name), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())['monitor']
+
+    def _is_line_end(self, work_dir, offset):
+        if offset == 0:
+            return True
+
+        try:
+            with open(os.path.join(work_dir, self.log_file_name), 'rb') as f:
+                f.seek(offset - 1)
+                return f.read(1) == b'\n'
+        except FileNotFoundError:
+            return False
+
+    def records(self, work_dir, since=None):
+        if since is None or not isinstance(since, int) or since < 0 or not self._is_line_end(work_dir, since):
+            # not a sequence number of this log
+            lines = self._read_log(work_dir)
+        else:
+            lines = self._read_log(work_dir, since)
+
+        last_by_name = {}
+        for offset, line in lines:
+            seq = offset + len(line)
+            if since is None or seq > since:
+                entry = json.loads(line)
+                # in the order of the last write
+                last_by_name.pop(entry['name'], None)
+                last_by_name[entry['name']] = (seq, entry['monitor'])
+
+        return [(seq, name, monitor) for name, (seq, monitor) in last_by_name.items()]
+
+
+class RedisJobStateStore(JobStateStore):
+    """
+    for each work_dir, the records are kept in a hash, and their order in a sorted set; the summary is kept
+    in another hash, with the status of the last record of each name in a third one
+
+    a record is written with its sequence number, and the summary updated, in a single script, which redis runs
+    atomically: the records are visible in the order of their sequence numbers, and a reader which has seen a sequence
+    number can not miss a record with a lower one, written concurrently
+    """
+    backend_name = 'redis'
+
+    # KEYS: records, order, seq, meta, summary
+    # ARGV: name, monitor, expiration, status, 1 if the record is a progress report, progress report
+    write_script = """
+        local seq = redis.call('INCR', KEYS[3])
+        local replaced_meta = redis.call('HGET', KEYS[4], ARGV[1])
+        if replaced_meta then
+            if string.sub(replaced_meta, 1, 1) == '1' then
+                redis.call('HINCRBY', KEYS[5], 'progress', -1)
+            end
+            redis.call('HINCRBY', KEYS[5], 'status:' .. string.sub(replaced_meta, 2), -1)
+        end
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        redis.call('ZADD', KEYS[2], seq, ARGV[1])
+        redis.call('HSET', KEYS[4], ARGV[1], ARGV[5] .. ARGV[4])
+        redis.call('HINCRBY', KEYS[5], 'status:' .. ARGV[4], 1)
+        if ARGV[5] == '1' then
+            redis.call('HINCRBY', KEYS[5], 'progress', 1)
+            redis.call('HSET', KEYS[5], 'last_progress', ARGV[6])
+        end
+        for i = 1, 5 do
+            redis.call('EXPIRE', KEYS[i], ARGV[3])
+        end
+        return seq
+    """
+
+    def __init__(self, url=None, key_prefix='dispatcher:job-state:', expire_s=30 * 24 * 3600):
+        if url is None:
+            from ..flask_app.tasks import celery
+            url = celery.conf.broker_url
+
+        import redis
+
+        self.url = url
+        self.key_prefix = key_prefix
+        self.expire_s = expire_s
+        self.redis = redis.Redis.from_url(url)
+        self._write = self.redis.register_script(self.write_script)
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.url} ]"
+
+    def _keys(self, work_dir):
+        key = self.key_prefix + os.path.abspath(work_dir)
+        return key + ':records', key + ':order', key + ':seq', key + ':meta', key + ':summary'
+
+    def write(self, work_dir, name, monitor):
+        status, is_progress = JobStateAggregate.record_meta(monitor)
+        last_progress = monitor['full_report_dict'] if is_progress else None
+
+        self._write(keys=list(self._keys(work_dir)),
+                    args=[name, json.dumps(monitor), int(self.expire_s),
+                          status, '1' if is_progress else '0', json.dumps(last_progress)])
+
+    def read(self, work_dir, name):
+        records_key = self._keys(work_dir)[0]
+
+        monitor_json = self.redis.hget(records_key, name)
+        if monitor_json is not None:
+            return json.loads(monitor_json)
+
+    def read_aggregate(self, work_dir):
+        records_key, order_key, _, _, summary_key = self._keys(work_dir)
+
+        with self.redis.pipeline() as pipe:
+            pipe.hgetall(summary_key)
+            pipe.zrevrange(order_key, 0, 0, withscores=True)
+            summary, last = pipe.execute()
+
+        summary = {k.decode(): v for k, v in summary.items()}
+
+        aggregate = JobStateAggregate(read_records=lambda since=None: self.records(work_dir, since))
+        aggregate.state['n_by_status'] = {k[len('status:'):]: int(v) for k, v in summary.items() if k.startswith('status:')}
+        aggregate.state['n_progress'] = int(summary.get('progress', 0))
+        if 'last_progress' in summary:
+            aggregate.state['last_progress'] = json.loads(summary['last_progress'])
+
+        if len(last) > 0:
+            name, seq = last[0]
+            monitor_json = self.redis.hget(records_key, name)
+            aggregate.state['seq'] = int(seq)
+            aggregate.state['last_record'] = [int(seq), name.decode(),
+                                              None if monitor_json is None else json.loads(monitor_json)]
+
+        return aggregate
+
+    def records(self, work_dir, since=None):
+        records_key, order_key = self._keys(work_dir)[:2]
+
+        new_records = self.redis.zrangebyscore(order_key, "-inf" if since is None else f"({since}", "+inf",
+                                               withscores=True)
+        if len(new_records) == 0:
+            return []
+
+        monitors_json = self.redis.hmget(records_key, [name for name, _ in new_records])
+
+        return [(int(seq), name.decode(), None if monitor_json is None else json.loads(monitor_json))
+                for (name, seq), monitor_json in zip(new_records, monitors_json)]
+
+
+job_state_store_classes = {c.backend_name: c for c in [FileJobStateStore, LogJobStateStore, RedisJobStateStore]}
+
+_job_state_stores = {}
+
+
+def get_job_state_store(backend_name='file') -> JobStateStore:
+    """
+    returns a store for the backend name, one per process, so that the connections (if any) are reused
+    """
+    if backend_name not in job_state_store_classes:
+        raise KeyError(f"job state backend {backend_name} is not known, "
+                       f"available backends are {list(job_state_store_classes)}")
+
+    if backend_name not in _job_state_stores:
+        _job_state_stores[backend_name] = job_state_store_classes[backend_name]()
+        logger.info("using job state store %s", _job_state_stores[backend_name])
+
+    return _job_state_stores[backend_name]
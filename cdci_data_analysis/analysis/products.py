@@ -20,6 +20,7 @@ __author__ = "Andrea Tramacere"
 # relative import eg: from .mod import f
 
 import json
+import zipfile
 from collections import OrderedDict
 
 import matplotlib
@@ -37,6 +38,7 @@ from .io_helper import FilePath
 from .io_helper import view_traceback, FitsFile
 from .job_manager import Job
 from .json import CustomJSONEncoder
+from .query_output_store import dump_npz, load_npz, load_status
 from .exceptions import ProblemDecodingStoredQueryOut
 
 import traceback
@@ -59,6 +61,9 @@ class QueryOutput(object):
         self.prod_dictionary = {}
         self.status_dictionary = {}
 
+        # set when only the status was read from the stored query output, see deserialize_status
+        self._stored_products_filename = None
+
         self._allowed_status_values_ = [0, 1] # ok or nok?
         self._allowed_job_status_values_ = Job.get_allowed_job_status_values()
 
@@ -233,18 +238,62 @@ class QueryOutput(object):
                   cls=CustomJSONEncoder
                 )
 
+    def serialize_npz(self, filename):
+        dump_npz({
+                    k: v
+                    for k, v in self.__dict__.items()
+                    if not k.startswith("_")
+                 },
+                 filename)
+
     def deserialize(self, readable):
 
         logger = app_logging.getLogger(self.__class__.__name__)
 
         try:
-            for k, v in json.load(readable).items():
-                logger.info("deserializing query_out state: %s : %s (%s)", k , str(v)[:100], len(str(v)))
-                setattr(self, k, v)
+            state = json.load(readable)
         except json.decoder.JSONDecodeError as e:
             logger.error("problem decoding query_out json: race?")
             raise ProblemDecodingStoredQueryOut(f"got {e} trying to read {readable}")
 
+        # the values are not represented: the products can be large
+        logger.info("deserializing query_out state: %s", ', '.join(state))
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def deserialize_npz(self, filename):
+        try:
+            state = load_npz(filename)
+        except (zipfile.BadZipFile, KeyError, ValueError) as e:
+            raise ProblemDecodingStoredQueryOut(f"got {e} trying to read {filename}")
+
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def deserialize_status(self, filename):
+        """
+        reads only the status record of the stored query output: the products are read by load_products
+        """
+        try:
+            record = load_status(filename)
+        except (json.decoder.JSONDecodeError, KeyError) as e:
+            raise ProblemDecodingStoredQueryOut(f"got {e} trying to read {filename}")
+
+        self.status_dictionary = record['status_dictionary']
+        self._stored_products_filename = record['products_filename']
+
+    def load_products(self):
+        if self._stored_products_filename is None:
+            return
+
+        if self._stored_products_filename.endswith('.npz'):
+            self.deserialize_npz(self._stored_products_filename)
+        else:
+            with open(self._stored_products_filename) as f:
+                self.deserialize(f)
+
+        self._stored_products_filename = None
+
 
 class QueryProductList(object):
 
@@ -29,6 +29,7 @@ from .parameters import *
 from .products import SpectralFitProduct, QueryOutput, QueryProductList, ImageProduct
 from .io_helper import FilePath
 from .exceptions import RequestNotUnderstood, UnfortunateRequestResults, BadRequest, InternalError
+from .backend_health import backend_health
 import traceback
 
 @decorator.decorator
@@ -378,17 +379,35 @@ class ProductQuery(BaseQuery):
 
         # print(msg_str)
         logger.info(msg_str)
+        health = backend_health.check(instrument.name) if query_type != 'Dummy' else 'skip'
+
+        if health == 'fail':
+            retry_in = backend_health.retry_in(instrument.name)
+            query_out.set_failed('dataserver communication test',
+                                 logger=logger,
+                                 e_message=f'The backend (instrument: {instrument.name}, product: {self.name}) '
+                                           f'is unavailable, it will be tested again in {retry_in:.0f} s',
+                                 debug_message='circuit open after repeated communication failures')
+            return query_out
+
         try:
 
-            if query_type != 'Dummy':
+            if health == 'probe':
                 test_comm_query_out = instrument.test_communication(config,logger=logger)
                 status = test_comm_query_out.get_status()
+
+                if status == 0:
+                    backend_health.record_success(instrument.name)
+                else:
+                    backend_health.record_failure(instrument.name)
             else:
+                # Dummy, or recently found healthy
                 status = 0
 
             query_out.set_done(message=message, debug_message=str(debug_message),status=status)
 
         except ConnectionError as e:
+            backend_health.record_failure(instrument.name)
             e_message = f'Connection with the backend (instrument: {instrument.name}, product: {self.name}) failed!\n' + repr(e)
 
             if hasattr(e, 'debug_message') and e.debug_message is not None:
@@ -407,6 +426,7 @@ class ProductQuery(BaseQuery):
                                  debug_message=debug_message)
 
         except Exception as e:
+            backend_health.record_failure(instrument.name)
             sentry_sdk.capture_exception(e)
             raise InternalError(f"unexpected error while testing communication with {instrument}, {e!r}")
 
@@ -0,0 +1,219 @@
+"""
+storage of the query outputs in the scratch directories
+
+the query outputs are stored either as one json document (query_output.json), or in a npz archive
+(query_output.npz), where the numpy arrays are stored as raw buffers, next to a json header with the rest of the
+query output. The arrays of the npz archive are loaded memory-mapped, without copy.
+The data of the products (NumpyDataProduct) are stored in the archive too. The products of plain arrays are rebuilt on
+load, with their data memory-mapped. The other products (e.g. with the FITS_rec of the tables, which can not be
+pickled again once unpickled) are loaded in their encoding, as from the json documents, but their pickled data are
+stored as raw buffers, not in base64 in the json header.
+The json documents are read if no npz archive is found.
+
+next to the query output, a small status record (query_output_status.json) holds the status of the query and the name
+of the stored query output: the pollers read it alone, and the products are loaded only once the job is finished.
+"""
+
+import os
+import json
+import uuid
+import base64
+import struct
+import zipfile
+import typing
+
+import numpy as np
+from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
+
+from .json import CustomJSONEncoder
+
+query_output_formats = ('json', 'npz')
+
+json_filename = 'query_output.json'
+npz_filename = 'query_output.npz'
+status_filename = 'query_output_status.json'
+
+# size of the fixed part of the local file header of a zip member
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _add_array(a, arrays: dict):
+    name = f'array_{len(arrays)}'
+    arrays[name] = a
+    return name
+
+
+def _is_plain_array(data):
+    return data is None or (type(data) in (np.ndarray, np.memmap) and not data.dtype.hasobject)
+
+
+def _extract_data_unit(data_unit: NumpyDataUnit, arrays: dict):
+    return {'data': None if data_unit.data is None else _add_array(data_unit.data, arrays),
+            'header': data_unit.header,
+            'meta_data': data_unit.meta_data,
+            'name': data_unit.name,
+            'hdu_type': data_unit.hdu_type,
+            'units_dict': data_unit.units_dict}
+
+
+def _restore_data_unit(o, arrays: dict) -> NumpyDataUnit:
+    return NumpyDataUnit(data=None if o['data'] is None else arrays[o['data']],
+                         data_header=o['header'],
+                         meta_data=o['meta_data'],
+                         name=o['name'],
+                         hdu_type=o['hdu_type'],
+                         units_dict=o['units_dict'])
+
+
+def _extract_arrays(o, arrays: dict):
+    if isinstance(o, np.ndarray) and not o.dtype.hasobject:
+        return {'__ndarray__': _add_array(o, arrays)}
+
+    if isinstance(o, NumpyDataProduct):
+        if all(_is_plain_array(data_unit.data) for data_unit in o.data_unit):
+            return {'__numpy_data_product__': {
+                'name': o.name,
+                'meta_data': o.meta_data,
+                'data_unit_list': [_extract_data_unit(data_unit, arrays) for data_unit in o.data_unit]}}
+
+        encoded = o.encode()
+        for encoded_data_unit in encoded['data_unit_list']:
+            if encoded_data_unit['binarys'] is not None:
+                binarys = np.frombuffer(base64.b64decode(encoded_data_unit['binarys']), dtype=np.uint8)
+                encoded_data_unit['binarys'] = _add_array(binarys, arrays)
+        return {'__encoded_numpy_data_product__': encoded}
+
+    if isinstance(o, dict):
+        return {k: _extract_arrays(v, arrays) for k, v in o.items()}
+
+    if isinstance(o, (list, tuple)):
+        return [_extract_arrays(v, arrays) for v in o]
+
+    return o
+
+
+def _restore_arrays(o, arrays: dict):
+    if isinstance(o, dict):
+        if len(o) == 1 and '__ndarray__' in o:
+            return arrays[o['__ndarray__']]
+        if len(o) == 1 and '__numpy_data_product__' in o:
+            product = o['__numpy_data_product__']
+            return NumpyDataProduct(data_unit=[_restore_data_unit(data_unit, arrays)
+                                               for data_unit in product['data_unit_list']],
+                                    name=product['name'],
+                                    meta_data=product['meta_data'])
+        if len(o) == 1 and '__encoded_numpy_data_product__' in o:
+            encoded = o['__encoded_numpy_data_product__']
+            for encoded_data_unit in encoded['data_unit_list']:
+                if encoded_data_unit['binarys'] is not None:
+                    encoded_data_unit['binarys'] = base64.b64encode(arrays[encoded_data_unit['binarys']]).decode()
+            return encoded
+        return {k: _restore_arrays(v, arrays) for k, v in o.items()}
+
+    if isinstance(o, list):
+        return [_restore_arrays(v, arrays) for v in o]
+
+    return o
+
+
+def _write_atomically(filename, write):
+    # written aside and renamed: the pollers never read a partial file
+    tmp_filename = f"{filename}.tmp-{os.getpid()}-{uuid.uuid4().hex}"
+    try:
+        with open(tmp_filename, 'wb') as f:
+            write(f)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def dump_npz(state: dict, filename):
+    arrays = {}
+    header = json.dumps(_extract_arrays(state, arrays), cls=CustomJSONEncoder).encode()
+
+    _write_atomically(filename, lambda f: np.savez(f, header=np.frombuffer(header, dtype=np.uint8), **arrays))
+
+
+def dump_status(status_dictionary: dict, products_filename, filename):
+    """
+    writes the status record of the query output stored in products_filename, in the same directory
+    """
+    record = json.dumps({'status_dictionary': status_dictionary,
+                         'products_filename': os.path.basename(products_filename)},
+                        cls=CustomJSONEncoder).encode()
+
+    _write_atomically(filename, lambda f: f.write(record))
+
+
+def load_status(filename) -> dict:
+    """
+    the status record, with the full path of the stored query output
+    """
+    with open(filename) as f:
+        record = json.load(f)
+
+    record['products_filename'] = os.path.join(os.path.dirname(filename), record['products_filename'])
+    return record
+
+
+def load_npz_members(filename) -> typing.Dict[str, np.ndarray]:
+    """
+    the arrays of the npz archive, memory-mapped: np.savez stores them uncompressed, at known offsets
+    """
+    members = {}
+
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                members[name] = np.lib.format.read_array(zf.open(info))
+                continue
+
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(ZIP_LOCAL_HEADER_SIZE)[26:30])
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if int(np.prod(shape)) == 0:
+                # nothing to map
+                members[name] = np.empty(shape, dtype=dtype)
+            else:
+                # copy-on-write: the stored archive is never modified
+                members[name] = np.memmap(filename, dtype=dtype, mode='c', shape=shape,
+                                          order='F' if fortran_order else 'C', offset=f.tell())
+
+    return members
+
+
+def load_npz(filename) -> dict:
+    members = load_npz_members(filename)
+    header = json.loads(members.pop('header').tobytes())
+    return _restore_arrays(header, members)
+
+
+def stored_query_output_filename(scratch_dir) -> typing.Union[str, None]:
+    for fn in [npz_filename, json_filename]:
+        if os.path.exists(os.path.join(scratch_dir, fn)):
+            return os.path.join(scratch_dir, fn)
+
+
+def load_query_output_state(scratch_dir) -> dict:
+    """
+    the stored query output, as a dict, whichever the format
+    """
+    filename = stored_query_output_filename(scratch_dir)
+    if filename is None:
+        raise FileNotFoundError(f"no query output stored in {scratch_dir}")
+
+    if filename.endswith('.npz'):
+        return load_npz(filename)
+
+    with open(filename) as f:
+        return json.load(f)
@@ -1,3 +1,8 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
 import jwt
 import oda_api.token
 from marshmallow import ValidationError
@@ -60,11 +65,61 @@ def get_token_user_fail_email(decoded_token):
     return decoded_token.get('msfail', True) # TODO: make server configurable
 
 
+class DecodedTokenCache:
+    """
+    bounded LRU cache of the verified token payloads, the same tokens are used in many requests;
+    the tokens are identified by a hash of the token and of the secret key.
+    a cached payload is only returned until the token expires
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def key(token, secret_key):
+        return hashlib.sha256(f"{secret_key}\0{token}".encode()).digest()
+
+    def clear(self):
+        with self._lock:
+            self._payloads.clear()
+
+    def decode(self, token, secret_key):
+        key = self.key(token, secret_key)
+
+        with self._lock:
+            payload = self._payloads.get(key, None)
+            if payload is not None:
+                if 'exp' in payload and int(payload['exp']) <= time.time():
+                    del self._payloads[key]
+                    raise jwt.exceptions.ExpiredSignatureError('Signature has expired')
+
+                self._payloads.move_to_end(key)
+                self.n_hits += 1
+                return dict(payload)
+
+        payload = jwt.decode(token, secret_key, algorithms=[default_algorithm])
+
+        with self._lock:
+            self.n_misses += 1
+            self._payloads[key] = payload
+            while len(self._payloads) > self.max_size:
+                self._payloads.popitem(last=False)
+
+        return dict(payload)
+
+
+decoded_token_cache = DecodedTokenCache()
+
+
 def get_decoded_token(token, secret_key, validate_token=True):
     # decode the encoded token
     if token is not None:
         if validate_token:
-            return jwt.decode(token, secret_key, algorithms=[default_algorithm])
+            return decoded_token_cache.decode(token, secret_key)
         else:
             return jwt.decode(token, "",
                               algorithms=[default_algorithm],
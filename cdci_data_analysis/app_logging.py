@@ -9,9 +9,11 @@ class AppLogging:
     @level_by_logger.setter
     def level_by_logger(self, level_by_logger: dict):
         self._level_by_logger = level_by_logger
+        # the new levels are applied to the existing loggers on the next setup
+        self._configured_logger_names = set()
 
     def __init__(self):
-        pass
+        self._configured_logger_names = set()
 
     def setup(self, tree=None) -> None:
         if tree is None:
@@ -24,14 +26,39 @@ class AppLogging:
             if n == tree[0]:
                 print(f"\033[33m setting logger \"{n}\" ({tree[1]}) at level {l}\033[0m")
                 tree[1].setLevel(l.upper())
+                self._configured_logger_names.add(n)
 
         for child in tree[2]:
             self.setup(child)
 
-    def getLogger(self, *a, **aa):
-        logger = logging.getLogger(*a, **aa)
-        self.setup()
+    def setup_new_loggers(self) -> None:
+        """
+        sets the levels of the configured loggers which were created since the last setup;
+        unlike setup, the cost does not grow with the number of loggers
+        """
+        if len(self._configured_logger_names) == len(self.level_by_logger):
+            return
+
+        existing_loggers = logging.root.manager.loggerDict
+
+        for n, l in self.level_by_logger.items():
+            if n in self._configured_logger_names:
+                continue
+
+            if n == "":
+                logger = logging.getLogger()
+            elif isinstance(existing_loggers.get(n, None), logging.Logger):
+                logger = existing_loggers[n]
+            else:
+                continue
+
+            print(f"\033[33m setting logger \"{n}\" ({logger}) at level {l}\033[0m")
+            logger.setLevel(l.upper())
+            self._configured_logger_names.add(n)
+
+    def getLogger(self, name=None):
+        logger = logging.getLogger(name)
+        self.setup_new_loggers()
         return logger
 
 app_logging = AppLogging()
-
@@ -248,7 +248,26 @@ class ConfigEnv(object):
                                      disp_dict.get('product_gallery_options', {}).get('converttime_revnum_service_url', 'https://www.astro.unige.ch/mmoda/dispatch-data/gw/timesystem/api/v1.0/converttime/UTC/{}/REVNUM'),
                                      disp_dict.get('renku_options', {}).get('renku_gitlab_repository_url', None),
                                      disp_dict.get('renku_options', {}).get('renku_base_project_url', None),
-                                     disp_dict.get('renku_options', {}).get('ssh_key_path', None)
+                                     disp_dict.get('renku_options', {}).get('ssh_key_path', None),
+                                     disp_dict.get('job_state_backend', 'file'),
+                                     disp_dict.get('sentry_traces_sample_rate', 1.0),
+                                     disp_dict.get('sentry_debug', False),
+                                     disp_dict.get('download_cache_dir', 'download_cache'),
+                                     disp_dict.get('download_cache_max_size', 2 * 1024**3),
+                                     disp_dict.get('use_x_sendfile', False),
+                                     disp_dict.get('query_output_format', 'json'),
+                                     disp_dict.get('async_executor', 'celery'),
+                                     disp_dict.get('async_executor_max_workers', 4),
+                                     disp_dict.get('async_executor_max_queued', 100),
+                                     disp_dict.get('async_executor_instrument_max_workers', {}),
+                                     disp_dict.get('backend_health_ttl', 60),
+                                     disp_dict.get('backend_circuit_failure_threshold', 3),
+                                     disp_dict.get('backend_circuit_open_interval', 30),
+                                     disp_dict.get('backend_http_pool_size', 10),
+                                     disp_dict.get('backend_http_connect_timeout', 10),
+                                     disp_dict.get('backend_http_read_timeout', 300),
+                                     disp_dict.get('js9_cache_dir', 'js9_cache'),
+                                     disp_dict.get('js9_cache_max_size', 1024**3)
                                      )
 
         # not used?
@@ -309,7 +328,26 @@ class ConfigEnv(object):
                             converttime_revnum_service_url,
                             renku_gitlab_repository_url,
                             renku_base_project_url,
-                            renku_gitlab_ssh_key_path
+                            renku_gitlab_ssh_key_path,
+                            job_state_backend='file',
+                            sentry_traces_sample_rate=1.0,
+                            sentry_debug=False,
+                            download_cache_dir='download_cache',
+                            download_cache_max_size=2 * 1024**3,
+                            use_x_sendfile=False,
+                            query_output_format='json',
+                            async_executor='celery',
+                            async_executor_max_workers=4,
+                            async_executor_max_queued=100,
+                            async_executor_instrument_max_workers=None,
+                            backend_health_ttl=60,
+                            backend_circuit_failure_threshold=3,
+                            backend_circuit_open_interval=30,
+                            backend_http_pool_size=10,
+                            backend_http_connect_timeout=10,
+                            backend_http_read_timeout=300,
+                            js9_cache_dir='js9_cache',
+                            js9_cache_max_size=1024**3
                             ):
         # Generic to dispatcher
         #print(dispatcher_url, dispatcher_port)
@@ -344,6 +382,30 @@ class ConfigEnv(object):
         self.renku_gitlab_repository_url = renku_gitlab_repository_url
         self.renku_gitlab_ssh_key_path = renku_gitlab_ssh_key_path
         self.renku_base_project_url = renku_base_project_url
+        self.job_state_backend = job_state_backend
+        self.sentry_traces_sample_rate = sentry_traces_sample_rate
+        self.sentry_debug = sentry_debug
+        self.download_cache_dir = download_cache_dir
+        self.download_cache_max_size = download_cache_max_size
+        self.use_x_sendfile = use_x_sendfile
+        self.query_output_format = query_output_format
+        self.async_executor = async_executor
+        self.async_executor_max_workers = async_executor_max_workers
+        self.async_executor_max_queued = async_executor_max_queued
+        self.async_executor_instrument_max_workers = async_executor_instrument_max_workers or {}
+        self.backend_health_ttl = backend_health_ttl
+        self.backend_circuit_failure_threshold = backend_circuit_failure_threshold
+        self.backend_circuit_open_interval = backend_circuit_open_interval
+        self.backend_http_pool_size = backend_http_pool_size
+        self.backend_http_connect_timeout = backend_http_connect_timeout
+        self.backend_http_read_timeout = backend_http_read_timeout
+        self.js9_cache_max_size = js9_cache_max_size
+
+        # the extracted files are served from the working directory of the dispatcher, as the products
+        if os.path.isabs(js9_cache_dir) or os.path.normpath(js9_cache_dir).split(os.sep)[0] == os.pardir:
+            raise ValueError(f"js9_cache_dir should be a path relative to the working directory of the dispatcher, "
+                             f"inside it, got {js9_cache_dir}")
+        self.js9_cache_dir = js9_cache_dir
 
     def get_data_serve_conf(self, instr_name):
         if instr_name in self.data_server_conf_dict.keys():
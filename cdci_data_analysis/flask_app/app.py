@@ -5,7 +5,6 @@ Created on Wed May 10 10:55:20 2017
 
 @author: Andrea Tramcere, Volodymyr Savchenko
 """
-import glob
 import json
 import re
 import string
@@ -14,12 +13,13 @@ import hashlib
 import jwt
 import sentry_sdk
 
-from raven.contrib.flask import Sentry
 from sentry_sdk.integrations.flask import FlaskIntegration
 from flask import jsonify, send_from_directory, redirect, Response, Flask, request, make_response, g
 
 # restx not really used
 from flask_restx import Api, Resource, reqparse
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable
+from werkzeug.security import safe_join
 
 import time as _time
 from urllib.parse import urlencode
@@ -32,10 +32,18 @@ from marshmallow.exceptions import ValidationError
 from ..plugins import importer
 
 from ..analysis.queries import *
-from ..analysis.io_helper import FitsFile
 from ..analysis.plot_tools import Image
 from .dispatcher_query import InstrumentQueryBackEnd
+from .meta_data_cache import meta_data_response_cache
+from .session_log import clear_current_session_log
+from .product_files import find_scratch_dir, product_etag, is_job_done, send_product_file
+from .js9_extraction import get_js9_extension_cache
 from ..analysis.exceptions import APIerror, MissingRequestParameter
+from ..analysis.job_registry import job_registry
+from ..analysis.job_state_store import get_job_state_store
+from ..analysis import query_output_store
+from ..analysis.backend_health import backend_health
+from ..analysis.backend_sessions import backend_sessions
 from ..app_logging import app_logging
 
 from ..analysis.json import CustomJSONEncoder
@@ -65,6 +73,8 @@ ns_conf = api.namespace('api/v1.0/oda', description='api')
 @app.before_request
 def before_request():
     g.request_start_time = _time.time()
+    # the thread may have handled a request for another job
+    clear_current_session_log()
 
 @app.route('/reload-plugin/<name>')
 def reload_plugin(name):
@@ -77,8 +87,11 @@ def reload_plugin(name):
     
 @app.route("/api/meta-data")
 def run_api_meta_data():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_meta_data()
+    def build_response():
+        query = InstrumentQueryBackEnd(app, get_meta_data=True)
+        return query.get_meta_data()
+
+    return meta_data_response_cache.response(build_response)
 
 
 @app.route("/api/parameters")
@@ -95,14 +108,20 @@ def run_api_instr_list():
 
 @app.route('/meta-data')
 def meta_data():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_meta_data()
+    def build_response():
+        query = InstrumentQueryBackEnd(app, get_meta_data=True)
+        return query.get_meta_data()
+
+    return meta_data_response_cache.response(build_response)
 
 
 @app.route('/api/par-names')
 def get_api_par_names():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_api_par_names()
+    def build_response():
+        query = InstrumentQueryBackEnd(app, get_meta_data=True)
+        return query.get_api_par_names()
+
+    return meta_data_response_cache.response(build_response)
 
 
 @app.route('/check_satus')
@@ -121,8 +140,11 @@ def check_satus():
 
 @app.route('/meta-data-src')
 def meta_data_src():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_meta_data('src_query')
+    def build_response():
+        query = InstrumentQueryBackEnd(app, get_meta_data=True)
+        return query.get_meta_data('src_query')
+
+    return meta_data_response_cache.response(build_response)
 
 
 @app.route("/download_products", methods=['POST', 'GET'])
@@ -183,12 +205,7 @@ def common_exception_payload():
     payload['cdci_data_analysis_version_details'] = os.getenv('DISPATCHER_VERSION_DETAILS', 'unknown')
     payload['oda_api_version'] = oda_api.__version__
      
-    _l = []
-
-    for instrument_factory in importer.instrument_factory_list:
-        _l.append('%s' % instrument_factory().name)
-
-    payload['installed_instruments'] = _l
+    payload['installed_instruments'] = importer.get_instrument_names()
 
     payload['debug_mode'] = os.environ.get(
         'DISPATCHER_DEBUG_MODE', 'no')  # change the default
@@ -254,6 +271,32 @@ def inspect_state():
     return state_data_obj
 
 
+@app.route('/job-status', methods=['GET'])
+def job_status():
+    """
+    lightweight alternative to run_analysis for polling the status of a submitted job:
+    only job_id, session_id, token, and optionally since, query_status and wait (for long polling) are considered
+    """
+    return InstrumentQueryBackEnd.poll_job_status(app)
+
+
+@app.route('/job-status-stream', methods=['GET'])
+def job_status_stream():
+    """
+    server-sent events with the status of a submitted job, pushed as the call_backs are received;
+    each open stream holds a worker thread
+    """
+    return InstrumentQueryBackEnd.stream_job_status(app)
+
+
+@app.route('/backend-health', methods=['GET'])
+def get_backend_health():
+    """
+    state of the circuit breaker of each backend, and the counts of the transitions between states
+    """
+    return jsonify(backend_health.metrics())
+
+
 @app.route('/push-renku-branch', methods=['POST'])
 def push_renku_branch():
     logger.info("request.args: %s ", request.args)
@@ -280,10 +323,9 @@ def push_renku_branch():
     api_code = None
     request_dict = None
     # Get the API code to push to the new renku branch
-    scratch_dir_pattern = f'scratch_sid_*_jid_{job_id}*'
-    list_scratch_folders = glob.glob(scratch_dir_pattern)
+    list_scratch_folders = job_registry.find_scratch_dirs(job_id)
     if len(list_scratch_folders) >= 1:
-        query_output_json_content_original = json.load(open(list_scratch_folders[0] + '/query_output.json'))
+        query_output_json_content_original = query_output_store.load_query_output_state(list_scratch_folders[0])
         prod_dict = query_output_json_content_original['prod_dictionary']
         # remove parameters that should not be shared (eg token)
         api_code = prod_dict.pop('api_code', None)
@@ -370,15 +412,6 @@ def run_analysis():
               repr(e), traceback.format_exc())
         sentry_url = getattr(app.config.get('conf'), 'sentry_url', None)
         if sentry_url is not None:
-            sentry_sdk.init(
-                dsn=sentry_url,
-                # Set traces_sample_rate to 1.0 to capture 100%
-                # of transactions for performance monitoring.
-                # We recommend adjusting this value in production.
-                traces_sample_rate=1.0,
-                debug=True,
-                max_breadcrumbs=50,
-            )
             sentry_sdk.capture_message(f'exception in run_analysis: {str(e)}')
         else:
             logger.warning("sentry not used")
@@ -495,7 +528,23 @@ class Product(Resource):
         serves a locally stored file
         """
         try:
-            return send_from_directory(os.path.abspath('./'), path)
+            root_dir = os.path.abspath('./')
+            file_path = safe_join(root_dir, path)
+            if file_path is None or not os.path.isfile(file_path):
+                raise NotFound()
+
+            scratch_dir, job_id = find_scratch_dir(root_dir, file_path)
+            if job_id is None:
+                return send_product_file(file_path)
+
+            conf = app.config['conf']
+            job_state_store = get_job_state_store(getattr(conf, 'job_state_backend', 'file'))
+
+            return send_product_file(file_path,
+                                     etag=product_etag(job_id, file_path),
+                                     done=is_job_done(scratch_dir, job_state_store))
+        except RequestedRangeNotSatisfiable as e:
+            return e.get_response()
         except Exception as e:
             # print('qui',e)
             raise APIerror('problem with local file delivery: %s' %
@@ -627,16 +676,6 @@ def get_observation_attachments():
     par_dic.pop('token')
 
     sentry_dsn = getattr(app_config, 'sentry_url', None)
-    if sentry_dsn is not None:
-        sentry_sdk.init(
-            dsn=sentry_dsn,
-            # Set traces_sample_rate to 1.0 to capture 100%
-            # of transactions for performance monitoring.
-            # We recommend adjusting this value in production.
-            traces_sample_rate=1.0,
-            debug=True,
-            max_breadcrumbs=50,
-        )
 
     gallery_secret_key = app_config.product_gallery_secret_key
     product_gallery_url = app_config.product_gallery_url
@@ -678,16 +717,6 @@ def get_all_astro_entities():
     par_dic.pop('token')
 
     sentry_dsn = getattr(app_config, 'sentry_url', None)
-    if sentry_dsn is not None:
-        sentry_sdk.init(
-            dsn=sentry_dsn,
-            # Set traces_sample_rate to 1.0 to capture 100%
-            # of transactions for performance monitoring.
-            # We recommend adjusting this value in production.
-            traces_sample_rate=1.0,
-            debug=True,
-            max_breadcrumbs=50,
-        )
 
     gallery_secret_key = app_config.product_gallery_secret_key
     product_gallery_url = app_config.product_gallery_url
@@ -802,16 +831,6 @@ def report_incident():
     secret_key = app_config.secret_key
 
     sentry_dsn = getattr(app_config, 'sentry_url', None)
-    if sentry_dsn is not None:
-        sentry_sdk.init(
-            dsn=sentry_dsn,
-            # Set traces_sample_rate to 1.0 to capture 100%
-            # of transactions for performance monitoring.
-            # We recommend adjusting this value in production.
-            traces_sample_rate=1.0,
-            debug=True,
-            max_breadcrumbs=50,
-        )
 
     output, output_code = tokenHelper.validate_token_from_request(token=token, secret_key=secret_key)
 
@@ -843,15 +862,6 @@ def report_incident():
         logging.warning(f'email sending failed: {e}')
         sentry_url = getattr(app.config.get('conf'), 'sentry_url', None)
         if sentry_url is not None:
-            sentry_sdk.init(
-                dsn=sentry_url,
-                # Set traces_sample_rate to 1.0 to capture 100%
-                # of transactions for performance monitoring.
-                # We recommend adjusting this value in production.
-                traces_sample_rate=1.0,
-                debug=True,
-                max_breadcrumbs=50,
-            )
             sentry_sdk.capture_message(f'sending email failed {e}')
         else:
             logger.warning("sentry not used")
@@ -889,7 +899,12 @@ class JS9(Resource):
 
 @ns_conf.route('/get_js9_plot')
 class GetJS9Plot(Resource):
-    @api.doc(responses={410: 'problem with js9 image generation'}, params={'file_path': 'the file path', 'ext_id': 'extension id'})
+    @api.doc(responses={410: 'problem with js9 image generation'},
+             params={'file_path': 'the file path', 'ext_id': 'extension id',
+                     'max_size': 'maximum width and height of the image, larger images are downsampled',
+                     'cutout_x': 'x of the center of the cutout, in pixels',
+                     'cutout_y': 'y of the center of the cutout, in pixels',
+                     'cutout_size': 'size of the cutout, in pixels'})
     def get(self):
         """
         returns the js9 image display
@@ -907,25 +922,33 @@ class GetJS9Plot(Resource):
         ext_id = int(request.args.get('ext_id', 4))
 
         try:
-            tmp_file = FitsFile(file_path)
-            tmp_file.file_path._set_file_path(
-                tmp_file.file_path.dir_name, 'js9.fits')
-
-            data = FitsFile(file_path).open()[ext_id]
-            print('==>', tmp_file.file_path, ext_id)
-            data.writeto(tmp_file.file_path.path, overwrite=True)
+            # optional cutout (center and size in pixels) and downsampling, for the large mosaics
+            max_size = request.args.get('max_size', None)
+            if max_size is not None:
+                max_size = int(max_size)
+
+            cutout = None
+            if request.args.get('cutout_size', None) is not None:
+                cutout = (float(request.args.get('cutout_x')),
+                          float(request.args.get('cutout_y')),
+                          int(request.args.get('cutout_size')))
+
+            conf = app.config['conf']
+            js9_extension_cache = get_js9_extension_cache(conf.js9_cache_dir, conf.js9_cache_max_size)
+            js9_file_path = js9_extension_cache.get(file_path, ext_id, max_size=max_size, cutout=cutout)
+            print('==>', js9_file_path, ext_id)
         except Exception as e:
             # print('qui',e)
             raise APIerror('problem with input file: %s' % e, status_code=410)
 
         region_file = request.args.get('region_file', None)
         
-        print('file_path, region_file', tmp_file.file_path.path, region_file)
+        print('file_path, region_file', js9_file_path, region_file)
         try:
             img = Image(None, None)
-            #print('get_js9_plot path',tmp_file.file_path.path)
+            #print('get_js9_plot path',js9_file_path)
             img = img.get_js9_html(
-                tmp_file.file_path.path, region_file=region_file)
+                js9_file_path, region_file=region_file)
 
         except Exception as e:
             # print('qui',e)
@@ -973,6 +996,31 @@ class TestJS9Plot(Resource):
 #    # print('get_js9_plot path',file_path)
 #    return img.get_js9_html('dummy_prods/isgri_query_mosaic.fits')
 
+def init_sentry(conf):
+    # once per process: re-initializing the sdk on each request is costly, the call sites only capture
+    global sentry_initialized_dsn
+
+    sentry_dsn = getattr(conf, 'sentry_url', None)
+    if sentry_dsn is None:
+        logger.warning("sentry not used")
+        return
+
+    if sentry_initialized_dsn == sentry_dsn:
+        return
+
+    sentry_sdk.init(
+        dsn=sentry_dsn,
+        traces_sample_rate=getattr(conf, 'sentry_traces_sample_rate', 1.0),
+        debug=getattr(conf, 'sentry_debug', False),
+        max_breadcrumbs=50,
+        integrations=[FlaskIntegration()],
+    )
+    sentry_initialized_dsn = sentry_dsn
+
+
+sentry_initialized_dsn = None
+
+
 def conf_app(conf):
     if isinstance(conf, str):
         logger.info("loading config from %s", conf)
@@ -980,11 +1028,26 @@ def conf_app(conf):
                                         set_by=f'command line {__file__}:{__name__}')
 
     app.config['conf'] = conf
-    if getattr(conf, 'sentry_url', None) is not None:
-        sentry = Sentry(app, dsn=conf.sentry_url)
-        logger.warning("sentry not used")
+    app.config['USE_X_SENDFILE'] = getattr(conf, 'use_x_sendfile', False)
+    init_sentry(conf)
+
+    backend_health.configure(ttl_s=conf.backend_health_ttl,
+                             failure_threshold=conf.backend_circuit_failure_threshold,
+                             open_s=conf.backend_circuit_open_interval)
+    if log_backend_health_transition not in backend_health.listeners:
+        backend_health.listeners.append(log_backend_health_transition)
+
+    backend_sessions.configure(pool_size=conf.backend_http_pool_size,
+                               connect_timeout=conf.backend_http_connect_timeout,
+                               read_timeout=conf.backend_http_read_timeout)
+
     return app
 
+
+def log_backend_health_transition(backend, previous_state, state):
+    logstash_message(app, {'origin': 'dispatcher-backend-health', 'event': 'circuit-transition',
+                           'backend': backend, 'from': previous_state, 'to': state})
+
 def run_app(conf, debug=False, threaded=False):
     conf_app(conf)
 
@@ -0,0 +1,226 @@
+"""
+executors of the async dispatcher queries
+
+the async dispatcher submits the queries to an executor, and polls the state of the submitted task while the query
+output is not stored (see InstrumentQueryBackEnd.request_query_out).
+The executor is selected with the async_executor option of the dispatcher configuration:
+
+* "celery": the queries are sent to the celery worker (and a redis broker), the default
+* "thread", "process": the queries are run by a pool of threads, or of processes, of the dispatcher itself; no broker
+  or worker is needed. The queue is bounded, and the number of queries running at once can be limited per instrument.
+
+the states of the tasks are recorded by the TaskStateTracker, in the same way for all the executors.
+"""
+
+import os
+import uuid
+import logging
+import threading
+import collections
+import multiprocessing
+import typing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from . import tasks
+
+logger = logging.getLogger(__name__)
+
+async_executor_names = ('celery', 'thread', 'process')
+
+
+class AsyncExecutor:
+    name = None
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} ]"
+
+    def submit(self, app, params, url) -> typing.Union[str, None]:
+        """
+        submits the query with params, returns the task id, or None if the query can not be accepted now
+        """
+        raise NotImplementedError
+
+    def state(self, task_id) -> str:
+        """
+        the celery name of the state of the task, or UNEXISTENT if it is not known
+        """
+        raise NotImplementedError
+
+
+class CeleryAsyncExecutor(AsyncExecutor):
+    name = 'celery'
+
+    def submit(self, app, params, url):
+        if os.environ.get("DISPATCHER_ASYNC_LOOPBACK", "no") == "yes":
+            r = tasks.request_dispatcher.apply_async(args=[url], kwargs=params)
+        else:
+            # the worker falls back to the request to url if it can not run the query itself
+            r = tasks.run_dispatcher_query.apply_async(
+                kwargs=dict(params=params,
+                            conf_file=conf_file_path(app.config.get('conf')),
+                            cwd=os.getcwd(),
+                            url=url)
+            )
+
+        # the worker may already have started it
+        tasks.task_state_tracker.record(r.id, "PENDING", replace=False)
+
+        return r.id
+
+    def state(self, task_id):
+        # as recorded on submission and by the worker: flower is only checked for the PENDING tasks,
+        # and UNEXISTENT if flower does not know them
+        return tasks.task_state_tracker.state(task_id)
+
+
+class LocalAsyncExecutor(AsyncExecutor):
+    """
+    runs the queries in a pool of threads, or of processes, of the dispatcher
+
+    at most max_queued queries are queued or running, and at most instrument_max_workers[instrument] queries
+    of each instrument run at once
+    """
+
+    def __init__(self, max_workers=4, max_queued=100, instrument_max_workers=None, use_processes=False):
+        self.name = 'process' if use_processes else 'thread'
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.instrument_max_workers = instrument_max_workers or {}
+
+        if use_processes:
+            # forking a threaded dispatcher is not safe
+            self.pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-dispatcher')
+
+        self._queued = collections.deque()
+        self._running_by_instrument = collections.Counter()
+        self._task_ids = set()
+        # the callbacks of the futures already done are called while scheduling
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__}: {self.name} max_workers={self.max_workers} max_queued={self.max_queued} ]"
+
+    @property
+    def n_running(self):
+        return sum(self._running_by_instrument.values())
+
+    def submit(self, app, params, url):
+        task_id = uuid.uuid4().hex
+        instrument = params.get('instrument')
+
+        with self._lock:
+            if len(self._queued) + self.n_running >= self.max_queued:
+                logger.warning("%s: %s queries queued or running, not accepting more", self, self.max_queued)
+                return None
+
+            tasks.task_state_tracker.record(task_id, "PENDING", pid=os.getpid())
+            self._task_ids.add(task_id)
+            self._queued.append((task_id, instrument, app, params))
+
+        self._schedule()
+
+        return task_id
+
+    def _schedule(self):
+        with self._lock:
+            for queued in list(self._queued):
+                if self.n_running >= self.max_workers:
+                    break
+
+                task_id, instrument, app, params = queued
+
+                if self._running_by_instrument[instrument] >= self.instrument_max_workers.get(instrument, self.max_workers):
+                    continue
+
+                self._queued.remove(queued)
+                self._running_by_instrument[instrument] += 1
+                tasks.task_state_tracker.record(task_id, "STARTED", pid=os.getpid())
+
+                if isinstance(self.pool, ProcessPoolExecutor):
+                    future = self.pool.submit(tasks.run_query_in_worker_app, conf_file_path(app.config.get('conf')), params)
+                else:
+                    future = self.pool.submit(tasks.run_query_in_app, app, params)
+
+                future.add_done_callback(lambda f, task_id=task_id, instrument=instrument: self._done(task_id, instrument, f))
+
+    def _done(self, task_id, instrument, future):
+        if future.exception() is None:
+            tasks.task_state_tracker.record(task_id, "SUCCESS", pid=os.getpid())
+        else:
+            logger.error("%s: query %s failed: %s", self, task_id, repr(future.exception()))
+            tasks.task_state_tracker.record(task_id, "FAILURE", pid=os.getpid())
+
+        with self._lock:
+            self._running_by_instrument[instrument] -= 1
+            self._task_ids.discard(task_id)
+
+        self._schedule()
+
+    def state(self, task_id):
+        record = tasks.task_state_tracker.read(task_id)
+
+        if record is None:
+            return "UNEXISTENT"
+
+        if record['state'] in ["PENDING", "STARTED"] and task_id not in self._task_ids:
+            # queued by another dispatcher process, which may be gone with its queue
+            if record.get('pid') == os.getpid() or not pid_exists(record.get('pid')):
+                return "UNEXISTENT"
+
+        return record['state']
+
+
+def pid_exists(pid) -> bool:
+    if pid is None:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def conf_file_path(conf) -> typing.Union[str, None]:
+    origin = getattr(conf, 'origin', None)
+    if isinstance(origin, dict) and origin.get('filepath') is not None:
+        return os.path.abspath(origin['filepath'])
+
+
+_async_executors = {}
+
+
+def get_async_executor(conf) -> AsyncExecutor:
+    """
+    the executor selected in the configuration, one per dispatcher process
+
+    raises ValueError if the configuration does not allow to use it
+    """
+    name = getattr(conf, 'async_executor', 'celery')
+    key = (os.getpid(), name)
+
+    if key not in _async_executors:
+        if name not in async_executor_names:
+            raise ValueError(f"async_executor option {name} is not one of {async_executor_names}")
+
+        if name == 'process' and conf_file_path(conf) is None:
+            # the processes of the pool configure the dispatcher from the same file
+            raise ValueError("the process async_executor needs the dispatcher configuration to be loaded from a file")
+
+        if name == 'celery':
+            executor = CeleryAsyncExecutor()
+        else:
+            executor = LocalAsyncExecutor(max_workers=conf.async_executor_max_workers,
+                                          max_queued=conf.async_executor_max_queued,
+                                          instrument_max_workers=conf.async_executor_instrument_max_workers,
+                                          use_processes=name == 'process')
+
+        logger.info("created async executor %s", executor)
+        _async_executors[key] = executor
+
+    return _async_executors[key]
@@ -21,13 +21,11 @@ import glob
 import string
 import random
 
-from flask import jsonify, send_from_directory, make_response
+from flask import jsonify, make_response, Response
 from flask import request, g
 import time as time_
 
 import tempfile
-import tarfile
-import gzip
 import socket
 import logstash
 import shutil
@@ -43,12 +41,19 @@ from ..analysis.instrument import params_not_to_be_included
 from ..analysis.hash import make_hash
 from ..analysis.hash import default_kw_black_list
 from ..analysis.job_manager import job_factory
+from ..analysis.job_state_store import get_job_state_store
+from ..analysis.job_registry import job_registry
+from ..analysis import query_output_store
 from ..analysis.io_helper import FilePath
+from .job_status_notifier import job_status_notifier
+from .session_log import attach_session_log_handler, set_current_session_log
+from .download_cache import get_download_cache, iter_download_archive, select_compression
+from .product_files import is_job_done, not_modified, send_product_file, set_cache_control
 from .mock_data_server import mock_query
 from ..analysis.products import QueryOutput
 from ..configurer import DataServerConf
 from ..analysis.exceptions import BadRequest, APIerror, MissingRequestParameter, RequestNotUnderstood, RequestNotAuthorized, ProblemDecodingStoredQueryOut, InternalError
-from . import tasks
+from . import async_executor, tasks
 
 from oda_api.api import DispatcherAPI
 
@@ -156,6 +161,13 @@ class InstrumentQueryBackEnd:
 
 
             self.client_name = self.par_dic.pop('client-name', 'unknown')
+
+            # sequence number of the last job monitor record known to the client, only newer progress reports are returned
+            since = self.par_dic.pop('since', None)
+            try:
+                self.since = None if since is None else int(since)
+            except ValueError:
+                raise RequestNotUnderstood(f"since must be an integer sequence number, got {since}")
             if os.environ.get("DISPATCHER_ASYNC_ENABLED", "no") == "yes":  # TODO: move to config!
                 self.async_dispatcher = self.par_dic.pop(
                     'async_dispatcher', 'True') == 'True'  # why string true?? else false anyway
@@ -357,7 +369,12 @@ class InstrumentQueryBackEnd:
 
         records = []
 
-        for scratch_dir in glob.glob("scratch_sid_*_jid_*"):
+        if job_id is not None:
+            scratch_dir_list = [r['scratch_dir'] for r in job_registry.list_scratch_dirs(job_id_prefix=job_id)]
+        else:
+            scratch_dir_list = [r['scratch_dir'] for r in job_registry.list_scratch_dirs()]
+
+        for scratch_dir in scratch_dir_list:
             r = re.match(
                 r"scratch_sid_(?P<session_id>[A-Z0-9]{16})_jid_(?P<job_id>[a-z0-9]{16})(?P<aliased_marker>_aliased|)",
                 scratch_dir)
@@ -366,10 +383,11 @@ class InstrumentQueryBackEnd:
                     if r.group('job_id')[:8] != job_id:
                         continue
 
-                if (time_.time() - os.stat(scratch_dir).st_mtime) < recent_days * 24 * 3600:
+                scratch_dir_stat = os.stat(scratch_dir)
+                if (time_.time() - scratch_dir_stat.st_mtime) < recent_days * 24 * 3600:
                     records.append(dict(
-                        mtime=os.stat(scratch_dir).st_mtime,
-                        ctime=os.stat(scratch_dir).st_ctime,
+                        mtime=scratch_dir_stat.st_mtime,
+                        ctime=scratch_dir_stat.st_ctime,
                         session_id=r.group('session_id'),
                         job_id=r.group('job_id'),
                         aliased_marker=r.group('aliased_marker'),
@@ -381,6 +399,173 @@ class InstrumentQueryBackEnd:
         # TODO adaption to the QueryOutJSON schema is needed
         return jsonify(dict(records=records))
 
+    @staticmethod
+    def build_status_poll_job(app):
+        """
+        builds the job for a status poll from the job state store, without constructing the query:
+        no instrument is built, and no temporary or scratch directory is touched.
+        the job is checked to belong to the token user, as in validate_job_id
+
+        returns (job, since, None), or (None, None, error response)
+        """
+        job_id = request.args.get('job_id', None)
+        session_id = request.args.get('session_id', None)
+        if job_id is None or session_id is None:
+            return None, None, (make_response('job_id and session_id must be provided.'), 400)
+
+        # with server-sent events, a reconnecting client provides the last received event id
+        since = request.args.get('since', request.headers.get('Last-Event-ID', None))
+        try:
+            since = None if since is None else int(since)
+        except ValueError:
+            return None, None, (make_response(f'since must be an integer sequence number, got {since}.'), 400)
+
+        token = request.args.get('token', None)
+        decoded_token = None
+        if token is not None:
+            try:
+                decoded_token = tokenHelper.get_decoded_token(token, app.config.get('conf').secret_key)
+            except jwt.exceptions.ExpiredSignatureError:
+                return None, None, (make_response('The token provided is expired.'), 403)
+            except jwt.exceptions.InvalidTokenError:
+                return None, None, (make_response('The token provided is not valid.'), 403)
+
+        job_par_dic = job_registry.get_analysis_parameters(job_id)
+        if job_par_dic is None:
+            return None, None, (make_response(f'unable to find any record for {job_id}.'), 400)
+
+        job_par_dic = {**job_par_dic, 'token': token}
+        if decoded_token is not None:
+            job_par_dic['sub'] = tokenHelper.get_token_user_email_address(decoded_token)
+
+        if make_hash(InstrumentQueryBackEnd.restricted_par_dic(job_par_dic)) != job_id:
+            return None, None, (make_response(f'The job {job_id} was not submitted with this token.'), 403)
+
+        # the job monitor is written in the scratch directory of the session which submitted the job,
+        # requests from other sessions are aliased to it
+        scratch_dir_list = job_registry.find_scratch_dirs(job_id, session_id=session_id, aliased=False) or \
+                           job_registry.find_scratch_dirs(job_id, aliased=False)
+        if len(scratch_dir_list) == 0:
+            return None, None, (make_response(f'unable to find any scratch directory for {job_id}.'), 400)
+
+        job = job_factory(job_par_dic.get('instrument'),
+                          scratch_dir_list[0],
+                          None,
+                          None,
+                          None,
+                          session_id,
+                          job_id,
+                          job_par_dic,
+                          token=token,
+                          state_store=get_job_state_store(
+                              getattr(app.config.get('conf'), 'job_state_backend', 'file')))
+
+        return job, since, None
+
+    @staticmethod
+    def read_job_status(job, since=None, query_status='submitted') -> dict:
+        job_monitor = job.updated_dataserver_monitor(since=since)
+
+        if job_monitor['status'] == 'done':
+            job.set_ready()
+
+        if job_monitor['status'] not in ['unaccessible', 'unknown']:
+            query_status = job.get_status()
+
+        return dict(
+            query_status=query_status,
+            job_status=job_monitor['status'],
+            job_monitor=job_monitor,
+            session_id=job.session_id,
+            job_id=job.job_id,
+        )
+
+    @staticmethod
+    def job_status_fingerprint(job_status):
+        return job_status['query_status'], job_status['job_monitor'].get('seq', None)
+
+    @staticmethod
+    def poll_job_status(app):
+        """
+        answers a status poll for a submitted job;
+        with wait=<seconds>, the response is delayed until the status differs from query_status, or
+        new records are written since the sequence number since (as known to the client), or, if neither are provided,
+        until the status changes
+        """
+        t0 = time_.time()
+
+        job, since, error_response = InstrumentQueryBackEnd.build_status_poll_job(app)
+        if error_response is not None:
+            return error_response
+
+        client_query_status = request.args.get('query_status', None)
+        job_status = InstrumentQueryBackEnd.read_job_status(job, since, client_query_status or 'submitted')
+
+        wait_s = request.args.get('wait', 0, type=float)
+        if wait_s > 0:
+            query_status, seq = InstrumentQueryBackEnd.job_status_fingerprint(job_status)
+            reference_fingerprint = (client_query_status or query_status,
+                                     since if since is not None else seq)
+
+            def has_changed():
+                nonlocal job_status
+                job_status = InstrumentQueryBackEnd.read_job_status(job, since, reference_fingerprint[0])
+                return InstrumentQueryBackEnd.job_status_fingerprint(job_status) != reference_fingerprint
+
+            job_status_notifier.wait(job.job_id, has_changed, wait_s)
+
+        logger.info("poll_job_status for %s took %.3g ms", job.job_id, (time_.time() - t0) * 1000)
+
+        return jsonify(job_status)
+
+    @staticmethod
+    def stream_job_status(app):
+        """
+        streams the status of a submitted job as server-sent events: the current status, and then each change,
+        until the job is finished or the stream lasted stream_s (at most job_status_notifier.max_stream_s);
+        the id of each event is the sequence number of the last record, to be used as since
+        """
+        job, since, error_response = InstrumentQueryBackEnd.build_status_poll_job(app)
+        if error_response is not None:
+            return error_response
+
+        query_status = request.args.get('query_status', 'submitted')
+        stream_s = min(request.args.get('stream_s', job_status_notifier.max_stream_s, type=float),
+                       job_status_notifier.max_stream_s)
+
+        def events():
+            nonlocal since
+
+            deadline = time_.time() + stream_s
+            job_status = InstrumentQueryBackEnd.read_job_status(job, since, query_status)
+
+            while True:
+                since = job_status['job_monitor'].get('seq', since)
+                yield f"id: {since}\nevent: job_status\ndata: {json.dumps(job_status)}\n\n"
+
+                if job_status['query_status'] in ['ready', 'failed'] or time_.time() > deadline:
+                    return
+
+                fingerprint = InstrumentQueryBackEnd.job_status_fingerprint(job_status)
+
+                def has_changed():
+                    nonlocal job_status
+                    job_status = InstrumentQueryBackEnd.read_job_status(job, since, fingerprint[0])
+                    return InstrumentQueryBackEnd.job_status_fingerprint(job_status) != fingerprint
+
+                while not job_status_notifier.wait(job.job_id,
+                                                   has_changed,
+                                                   min(job_status_notifier.keep_alive_s, deadline - time_.time())):
+                    if time_.time() > deadline:
+                        return
+
+                    # keeps proxies from closing the idle connection
+                    yield ": keep-alive\n\n"
+
+        return Response(events(),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     @staticmethod
     def read_scratch_dir(scratch_dir):
         result = {}
@@ -440,10 +625,20 @@ class InstrumentQueryBackEnd:
             if k not in kw_black_list and v is not None
         })
 
+    def decode_token(self, token):
+        """
+        decodes the token once per request, it is needed several times when the job_id is calculated and validated
+        """
+        decoded_tokens = self.__dict__.setdefault('_decoded_tokens', {})
+        if token not in decoded_tokens:
+            secret_key = self.app.config.get('conf').secret_key
+            decoded_tokens[token] = tokenHelper.get_decoded_token(token, secret_key)
+
+        return decoded_tokens[token]
+
     def user_specific_par_dic(self, par_dic):
         if par_dic.get('token') is not None:
-            secret_key = self.app.config.get('conf').secret_key
-            decoded_token = tokenHelper.get_decoded_token(par_dic['token'], secret_key)
+            decoded_token = self.decode_token(par_dic['token'])
             return {
                 **par_dic,
                 "sub": tokenHelper.get_token_user_email_address(decoded_token)
@@ -455,13 +650,23 @@ class InstrumentQueryBackEnd:
                          par_dic: dict,
                          kw_black_list: typing.Union[None,dict]=None) -> str:
         """
-        restricts parameter list to those relevant for request content, and makes string hash
+        restricts parameter list to those relevant for request content, and makes string hash;
+        the job_id computed for the same parameters are kept for the duration of the request
         """
 
         user_par_dict = self.user_specific_par_dic(par_dic)
         user_restricted_par_dict = self.restricted_par_dic(user_par_dict, kw_black_list)
 
-        return make_hash(user_restricted_par_dict)
+        try:
+            key = json.dumps(user_restricted_par_dict, sort_keys=True)
+        except (TypeError, ValueError):
+            return make_hash(user_restricted_par_dict)
+
+        job_ids = self.__dict__.setdefault('_job_ids', {})
+        if key not in job_ids:
+            job_ids[key] = make_hash(user_restricted_par_dict)
+
+        return job_ids[key]
 
     def generate_job_id(self, kw_black_list=None):
         self.logger.info("\033[31m---> GENERATING JOB ID <---\033[0m")
@@ -504,22 +709,9 @@ class InstrumentQueryBackEnd:
 
         session_log_filename = os.path.join(scratch_dir, 'session.log')
 
-        have_handler = False
-        for handler in logger.handlers:
-            if isinstance(handler, logging.FileHandler):
-                logger.info("found FileHandler: %s : %s",
-                            handler, handler.baseFilename)
-                have_handler = True
-                #handler.baseFilename == session_log_filename
-
-        if not have_handler:
-
-            fileh = logging.FileHandler(session_log_filename, 'a')
-            formatter = logging.Formatter(
-                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            fileh.setFormatter(formatter)
-
-            logger.addHandler(fileh)  # set the new handler
+        # the records of this request, in this thread, are written to the session.log of this job
+        attach_session_log_handler(logger)
+        set_current_session_log(scratch_dir)
 
         if verbose:
             print('logfile set to dir=', scratch_dir,
@@ -546,18 +738,7 @@ class InstrumentQueryBackEnd:
         return _logger
 
     def set_sentry_sdk(self, sentry_dsn=None):
-
-        if sentry_dsn is not None:
-            sentry_sdk.init(
-                dsn=sentry_dsn,
-                # Set traces_sample_rate to 1.0 to capture 100%
-                # of transactions for performance monitoring.
-                # We recommend adjusting this value in production.
-                traces_sample_rate=1.0,
-                debug=True,
-                max_breadcrumbs=50,
-            )
-
+        # the sdk is initialized once, in conf_app: here it is only recorded whether the messages should be captured
         self.sentry_dsn = sentry_dsn
 
     def get_current_ip(self):
@@ -646,9 +827,11 @@ class InstrumentQueryBackEnd:
         if alias_workdir is not None:
             wd = wd+'_aliased'
 
+        work_dir_mtime_ns = job_registry.stat_work_dir()
         wd = FilePath(file_dir=wd)
         wd.mkdir()
         self.scratch_dir = wd.path
+        job_registry.register(self.scratch_dir, work_dir_mtime_ns_before=work_dir_mtime_ns)
 
     def set_temp_dir(self, session_id, job_id=None, verbose=False):
         if verbose:
@@ -677,39 +860,60 @@ class InstrumentQueryBackEnd:
         if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir):
             shutil.rmtree(self.temp_dir)
 
-    def prepare_download(self, file_list, file_name, scratch_dir):
+    def prepare_download(self, file_list, file_name, scratch_dir, compression='gzip'):
+        """
+        returns the response with the archive of the files: from the cache if it was already built,
+        otherwise it is compressed while it is sent, and cached
+        """
         file_name = file_name.replace(' ', '_')
 
-        if hasattr(file_list, '__iter__'):
-            print('file_list is iterable')
-        else:
-            file_list = [file_list]
+        mimetype = 'application/gzip'
+        if compression == 'zstd':
+            mimetype = 'application/zstd'
+            if file_name.endswith('.gz'):
+                file_name = file_name[:-len('.gz')]
+            file_name += '.zst'
 
-        for ID, f in enumerate(file_list):
-            file_list[ID] = os.path.join(scratch_dir + '/', f)
+        if isinstance(file_list, str):
+            file_list = [file_list]
 
-        tmp_dir = tempfile.mkdtemp(prefix='download_', dir='./')
+        file_list = [os.path.join(scratch_dir + '/', f) for f in file_list]
 
-        file_path = os.path.join(tmp_dir, file_name)
         out_dir = file_name.replace('.tar', '')
         out_dir = out_dir.replace('.gz', '')
+        out_dir = out_dir.replace('.zst', '')
 
-        if len(file_list) > 1:
-            tar = tarfile.open("%s" % (file_path), "w:gz")
-            for name in file_list:
-                #print('add to tar', file_name,name)
-                if name is not None:
-                    tar.add(name, arcname='%s/%s' %
-                            (out_dir, os.path.basename(name)))
-            tar.close()
-        else:
-            in_data = open(file_list[0], "rb").read()
-            with gzip.open(file_path, 'wb') as f:
-                f.write(in_data)
+        conf = self.app.config['conf']
+        download_cache = get_download_cache(conf.download_cache_dir, conf.download_cache_max_size)
+
+        # the archives are built deterministically: the key identifies the content, even before it is built
+        key = download_cache.key(self.job_id, file_list, out_dir=out_dir, compression=compression)
+        done = is_job_done(scratch_dir, self.job_state_store)
+
+        response = not_modified(key, done)
+        if response is not None:
+            return response
+
+        cached_path = download_cache.get(key)
 
-        tmp_dir = os.path.abspath(tmp_dir)
+        if cached_path is None and request.range is not None:
+            # an interrupted download is resumed: the archive is completed before the requested range is sent
+            cached_path = download_cache.build(key, iter_download_archive(file_list, out_dir, compression=compression))
 
-        return tmp_dir, file_name
+        if cached_path is not None:
+            return send_product_file(os.path.abspath(cached_path),
+                                     etag=key,
+                                     done=done,
+                                     mimetype=mimetype,
+                                     as_attachment=True,
+                                     download_name=file_name)
+
+        response = Response(download_cache.stream(key, iter_download_archive(file_list, out_dir, compression=compression)),
+                            mimetype=mimetype)
+        response.headers.set('Content-Disposition', 'attachment', filename=file_name)
+        response.set_etag(key)
+        response.accept_ranges = 'bytes'
+        return set_cache_control(response, done)
 
     def resolve_job_url(self):
         expected_pars = set(['job_id', 'session_id', 'token'])
@@ -821,15 +1025,16 @@ class InstrumentQueryBackEnd:
             file_list = self.args.get('file_list').split(',')
             file_name = self.args.get('download_file_name')
 
-            tmp_dir, target_file = self.prepare_download(
-                file_list, file_name, self.scratch_dir)
-            return send_from_directory(directory=tmp_dir, path=target_file, attachment_filename=target_file,
-                                       as_attachment=True)
+            compression = select_compression(self.args.get('compression', None))
+
+            return self.prepare_download(file_list, file_name, self.scratch_dir, compression=compression)
         except RequestNotAuthorized as e:
             return self.build_response_failed('oda_api permissions failed',
                                               e.message,
                                               status_code=e.status_code,
                                               debug_message=e.debug_message)
+        except RequestNotUnderstood:
+            raise
         except Exception as e:
             return e
 
@@ -877,11 +1082,7 @@ class InstrumentQueryBackEnd:
         return jsonify(self.par_dic)
 
     def get_instr_list(self, name=None):
-        _l = []
-        for instrument_factory in importer.instrument_factory_list:
-            _l.append(instrument_factory().name)
-
-        return jsonify(_l)
+        return jsonify(importer.get_instrument_names())
 
     @property
     def dispatcher_callback_url_base(self):
@@ -898,6 +1099,10 @@ class InstrumentQueryBackEnd:
         return getattr(self, '_dispatcher_port',
                        getattr(self.config, 'bind_port', None))
 
+    @property
+    def job_state_store(self):
+        return get_job_state_store(getattr(self.app.config.get('conf'), 'job_state_backend', 'file'))
+
     def run_call_back(self, status_kw_name='action') -> typing.Tuple[str, typing.Union[QueryOutput, None]]:
         self.config, self.config_data_server = self.set_config()
 
@@ -918,7 +1123,8 @@ class InstrumentQueryBackEnd:
                           self.job_id,
                           self.par_dic,
                           token=self.token,
-                          time_request=time_original_request)
+                          time_request=time_original_request,
+                          state_store=self.job_state_store)
 
         self.logger.info("%s.run_call_back with args %s", self, self.par_dic)
         self.logger.info("%s.run_call_back built job %s", self, job)
@@ -1008,6 +1214,10 @@ class InstrumentQueryBackEnd:
                                         full_dict=self.par_dic,
                                         call_back_status=f'parameter missing during call back: {e.message}')
             logging.warning(f'parameter missing during call back: {e}')
+
+        finally:
+            # requests waiting for the status of this job are answered right away
+            job_status_notifier.notify(self.job_id)
         # TODO for a future implementation
         # except RequestNotAuthorized as e:
         #     job.write_dataserver_status(status_dictionary_value=status,
@@ -1035,11 +1245,7 @@ class InstrumentQueryBackEnd:
         returns parameters from current job and any session
         """
 
-        scratch_dir_parameters = glob.glob(f'scratch*_jid_{job_id}*/analysis_parameters.json')
-        if len(scratch_dir_parameters) == 0:
-            return None
-        else:
-            return json.load(open(scratch_dir_parameters[0]))
+        return job_registry.get_analysis_parameters(job_id)
 
     def set_use_scws(self, par_dict):
         par_dict = par_dict.copy()
@@ -1168,21 +1374,15 @@ class InstrumentQueryBackEnd:
         return out_dict
 
     def set_instrument(self, instrument_name):
-        known_instruments = []
-
         new_instrument = None
         # TODO to get rid of the mock instrument option, we now have the empty instrument
         if instrument_name == 'mock':
             new_instrument = 'mock'
         else:
-            for instrument_factory in importer.instrument_factory_list:
-                instrument = instrument_factory()
-                if instrument.name == instrument_name:
-                    new_instrument = instrument  # multiple assignment? TODO
-
-                known_instruments.append(instrument.name)
+            new_instrument = importer.get_instrument(instrument_name)
 
         if new_instrument is None:
+            known_instruments = importer.get_instrument_names()
             raise InstrumentNotRecognized(f'instrument: "{instrument_name}", known: {known_instruments}')
         else:
             self.instrument = new_instrument
@@ -1229,10 +1429,7 @@ class InstrumentQueryBackEnd:
 
     def get_existing_job_ID_path(self, wd):
         # exist same job_ID, different session ID
-        dir_list = glob.glob('*_jid_%s' % (self.job_id))
-        # print('dirs',dir_list)
-        if dir_list != []:
-            dir_list = [d for d in dir_list if 'aliased' not in d]
+        dir_list = job_registry.find_scratch_dirs(self.job_id, aliased=False)
 
         if len(dir_list) == 1:
             if dir_list[0] != wd:
@@ -1293,8 +1490,7 @@ class InstrumentQueryBackEnd:
         """
         # decode the token
         # self.decoded_token = self.get_decoded_token()
-        secret_key = self.app.config.get('conf').secret_key
-        self.decoded_token = tokenHelper.get_decoded_token(self.token, secret_key)
+        self.decoded_token = self.decode_token(self.token)
         self.logger.info("==> token %s", self.decoded_token)
         return True
 
@@ -1309,7 +1505,8 @@ class InstrumentQueryBackEnd:
                            self.par_dic,
                            aliased=False,
                            token=self.token,
-                           time_request=self.time_request)
+                           time_request=self.time_request,
+                           state_store=self.job_state_store)
 
     def build_response_failed(self, message, extra_message, status_code=None, debug_message=''):
         job = self.build_job()
@@ -1364,7 +1561,19 @@ class InstrumentQueryBackEnd:
 
     @property
     def response_filename(self):
-        return os.path.join(self.scratch_dir, "query_output.json")
+        return os.path.join(self.scratch_dir, query_output_store.json_filename)
+
+    @property
+    def response_npz_filename(self):
+        return os.path.join(self.scratch_dir, query_output_store.npz_filename)
+
+    @property
+    def response_status_filename(self):
+        return os.path.join(self.scratch_dir, query_output_store.status_filename)
+
+    @property
+    def query_output_format(self):
+        return getattr(self.app.config.get('conf'), 'query_output_format', 'json')
 
     @property
     def response_log_filename(self):
@@ -1379,18 +1588,33 @@ class InstrumentQueryBackEnd:
         return os.path.join(self.scratch_dir, "query_output_request.json")
 
     def find_stored_response(self) -> QueryOutput:
-        if os.path.exists(self.response_filename):
+        """
+        the stored query output, with only the status loaded if the status record is found: see load_products
+        """
+        if os.path.exists(self.response_status_filename):
+            stored_filename = self.response_status_filename
+        else:
+            # stored without status record
+            # the npz archive, if any, is the latest stored: see store_response
+            stored_filename = query_output_store.stored_query_output_filename(self.scratch_dir)
+
+        if stored_filename is not None:
             self.logger.info(
-                "\033[32mstored query out FOUND at %s\033[0m", self.response_filename)
+                "\033[32mstored query out FOUND at %s\033[0m", stored_filename)
             Q = QueryOutput()
 
             try:
-                Q.deserialize(open(self.response_filename, "r"))
+                if stored_filename == self.response_status_filename:
+                    Q.deserialize_status(stored_filename)
+                elif stored_filename == self.response_npz_filename:
+                    Q.deserialize_npz(stored_filename)
+                else:
+                    Q.deserialize(open(stored_filename, "r"))
                 j = json.load(open(self.response_filename +
                                    ".job-monitor", "r"))  # modify!
             except (ProblemDecodingStoredQueryOut, FileNotFoundError, json.decoder.JSONDecodeError) as e:
                 self.logger.info(
-                    "\033[31mstored query out corrupt (race?) or NOT FOUND at %s\033[0m", self.response_filename)
+                    "\033[31mstored query out corrupt (race?) or NOT FOUND at %s\033[0m", stored_filename)
                 return
 
             return Q, j
@@ -1399,30 +1623,26 @@ class InstrumentQueryBackEnd:
             "\033[31mstored query out NOT FOUND at %s\033[0m", self.response_filename)
 
     def request_query_out(self, overwrite=False):
+        executor = async_executor.get_async_executor(self.app.config.get('conf'))
+
         if os.path.exists(self.response_request):
             r_json = json.load(open(self.response_request))
+            # requests stored before the executors were introduced only have the celery-id
+            task_id = r_json.get('task-id', r_json.get('celery-id'))
 
-            r = tasks.celery.AsyncResult(r_json['celery-id'])
-            r_state = r.state
-
-            self.logger.info("found celery job: %s state: %s", r.id, r_state)
-            self.logger.info("celery job: %s state: %s", r, r.__dict__)
+            r_state = executor.state(task_id)
 
-            if r_state == "PENDING":
-                flower_task = tasks.flower_task(r_json['celery-id'])
-                if flower_task is None:
-                    self.logger.info("PENDING celery job: %s does not exist in flower, marking UNEXISTENT", r)
-                    r_state = "UNEXISTENT"
+            self.logger.info("found %s job: %s state: %s", executor.name, task_id, r_state)
 
             if r_state in ["FAILURE"]:
-                self.logger.info("celery job state failure, will overwrite")
+                self.logger.info("%s job state failure, will overwrite", executor.name)
                 overwrite = True
 
             if not overwrite:
                 self.logger.info("not overwriting, fine with the job")
                 return
             else:
-                if r_state in ["PENDING", "RUNNING"]:
+                if r_state in ["PENDING", "STARTED", "RETRY", "RUNNING"]:
                     self.logger.info(
                         "even with overwriting, will not touch running/pending active job: %s", r_state) # sometimes job is stuck??
                     return
@@ -1431,29 +1651,61 @@ class InstrumentQueryBackEnd:
                         "overwriting request for this job: %s", r_state)
 
         # TODO: here we might as well query from minio etc, but only if ready
-        r = tasks.request_dispatcher.apply_async(
-            args=[self.dispatcher_callback_url_base + "/run_analysis"],
-            kwargs={**self.par_dic, 'async_dispatcher': False}
-        )
-        self.logger.info("submitted celery job with pars %s", self.par_dic)
-        self.logger.info("submitted celery job: %s state: %s", r.id, r.state)
-        json.dump({'celery-id': r.id},
+        task_id = executor.submit(self.app,
+                                  {**self.par_dic, 'async_dispatcher': False},
+                                  self.dispatcher_callback_url_base + "/run_analysis")
+
+        if task_id is None:
+            # the job stays submitted, and is requested again on the next poll
+            self.logger.warning("%s job not accepted by the executor, will request again", executor.name)
+            return
+
+        self.logger.info("submitted %s job with pars %s", executor.name, self.par_dic)
+        self.logger.info("submitted %s job: %s", executor.name, task_id)
+        json.dump({'task-id': task_id, 'executor': executor.name},
                   open(self.response_request, "w"))
 
+    def forget_query_out_request(self):
+        """
+        the job is finished: the state of the task which ran it is no longer needed
+        """
+        try:
+            r_json = json.load(open(self.response_request))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+
+        task_id = r_json.get('task-id', r_json.get('celery-id'))
+        if task_id is not None:
+            tasks.task_state_tracker.forget(task_id)
+
     def store_response(self, query_out, job_monitor):
         self.logger.info("storing query output: %s, %s",
                          self.response_filename, self.response_log_filename)
-        if os.path.exists(self.response_filename):
-            if not os.path.exists(self.query_log_dir):
-                os.makedirs(self.query_log_dir)
-            os.rename(self.response_filename, self.response_log_filename)
-            self.logger.info("renamed query log log %s => %s",
-                             self.response_filename, self.response_log_filename)
-
-        query_out.serialize(open(self.response_filename, "w"))
+        # until the new status record is written, the pollers read nothing
+        if os.path.exists(self.response_status_filename):
+            os.remove(self.response_status_filename)
+
+        for stored_filename, log_filename in [(self.response_filename, self.response_log_filename),
+                                              (self.response_npz_filename, self.response_log_filename[:-len('.json')] + '.npz')]:
+            if os.path.exists(stored_filename):
+                if not os.path.exists(self.query_log_dir):
+                    os.makedirs(self.query_log_dir)
+                os.rename(stored_filename, log_filename)
+                self.logger.info("renamed query log log %s => %s",
+                                 stored_filename, log_filename)
+
+        if self.query_output_format == 'npz':
+            stored_filename = self.response_npz_filename
+            query_out.serialize_npz(stored_filename)
+        else:
+            stored_filename = self.response_filename
+            query_out.serialize(open(stored_filename, "w"))
         json.dump(job_monitor, open(
             self.response_filename + ".job-monitor", "w"))
 
+        # written last, once the query output is complete
+        query_output_store.dump_status(query_out.status_dictionary, stored_filename, self.response_status_filename)
+
     def load_config(self):
         try:
             config, self.config_data_server = self.set_config()
@@ -1581,7 +1833,8 @@ class InstrumentQueryBackEnd:
                           self.par_dic,
                           aliased=job_is_aliased,
                           token=self.token,
-                          time_request=self.time_request)
+                          time_request=self.time_request,
+                          state_store=self.job_state_store)
 
         job_monitor = job.monitor
 
@@ -1775,7 +2028,7 @@ class InstrumentQueryBackEnd:
             else:
                 query_out = QueryOutput()
 
-                job_monitor = job.updated_dataserver_monitor()
+                job_monitor = job.updated_dataserver_monitor(since=self.since)
 
                 self.logger.info('-----------------> job monitor from data server: %s', job_monitor['status'])
 
@@ -1838,10 +2091,28 @@ class InstrumentQueryBackEnd:
                                               api=api)
         return resp
 
+    def stored_job_status(self, query_out) -> str:
+        if query_out.status_dictionary['status'] == 0:
+            return query_out.status_dictionary['job_status']
+
+        self.logger.warning(
+            "why is status not 0? it is %s", query_out.status_dictionary['status'])
+        return "failed"
+
     def async_dispatcher_query(self, query_status: str) -> tuple:
         self.logger.info("async dispatcher enabled, for %s", query_status)
 
         R = self.find_stored_response()
+        job_status = None if R is None else self.stored_job_status(R[0])
+
+        if job_status in ['done', 'failed']:
+            # only now the products are needed
+            try:
+                R[0].load_products()
+            except (ProblemDecodingStoredQueryOut, FileNotFoundError) as e:
+                # the status record may be visible before the products are renamed in place: not ready yet
+                self.logger.info("\033[31mstored query out products corrupt (race?) or NOT FOUND: %s\033[0m", e)
+                R = None
 
         if R is None:
             query_new_status = 'submitted'
@@ -1865,19 +2136,14 @@ class InstrumentQueryBackEnd:
                              query_out.status_dictionary['job_status'],
                              )
 
-            if query_out.status_dictionary['status'] == 0:
-                job_status = query_out.status_dictionary['job_status']
-            else:
-                job_status = "failed"
-                self.logger.warning(
-                    "why is status not 0? it is %s", query_out.status_dictionary['status'])
-
             # if job_status in ['done', 'ready']: #two??
             if job_status in ['done']:
                 query_new_status = 'done'
+                self.forget_query_out_request()
 
             elif job_status == 'failed':
                 query_new_status = 'failed'
+                self.forget_query_out_request()
 
             else:
                 if job_status in ["progress", "ready"]:
@@ -0,0 +1,357 @@
+"""
+archives of the products, for /download_products
+
+the archives are compressed while they are streamed to the client, reading the products by chunks,
+so that the memory used by a download does not depend on the size of the products.
+Besides the usual gzip stream, the archives can be compressed by blocks in parallel, as a series of gzip members
+which the standard decoders concatenate, or with zstd, if the zstandard module is available.
+The finished archives are kept in a cache directory, keyed by the job, the list of files and their state,
+and the least recently used ones are removed when the cache exceeds its size.
+"""
+
+import os
+import json
+import uuid
+import zlib
+import tarfile
+import hashlib
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from ..analysis.exceptions import RequestNotUnderstood
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+compression_engines = ('gzip', 'parallel_gzip', 'zstd')
+
+# gzip, bzip2, xz, zstd, zip
+compressed_magic_numbers = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'\x28\xb5\x2f\xfd', b'PK\x03\x04')
+
+
+def is_compressed(path) -> bool:
+    with open(path, 'rb') as f:
+        head = f.read(6)
+
+    return head.startswith(compressed_magic_numbers)
+
+
+def iter_file(path, size=None, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def iter_tar(members, chunk_size=CHUNK_SIZE):
+    """
+    yields the tar archive of the members, a list of (path, arcname), as (data, compressible) segments;
+    the data of the members which are already compressed are not compressible
+    """
+    offset = 0
+
+    for path, arcname in members:
+        st = os.stat(path)
+
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = st.st_size
+        tarinfo.mtime = int(st.st_mtime)
+        tarinfo.mode = st.st_mode & 0o7777
+
+        header = tarinfo.tobuf(format=tarfile.DEFAULT_FORMAT, encoding='utf-8', errors='surrogateescape')
+        offset += len(header)
+        yield header, None
+
+        compressible = not is_compressed(path)
+        for chunk in iter_file(path, size=st.st_size, chunk_size=chunk_size):
+            yield chunk, compressible
+
+        padding = -st.st_size % tarfile.BLOCKSIZE
+        offset += st.st_size + padding
+        yield tarfile.NUL * padding, None
+
+    # end of archive: two empty blocks, padded to the record size, as written by tarfile
+    offset += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -offset % tarfile.RECORDSIZE), None
+
+
+def iter_gzip(segments, compresslevel=9):
+    """
+    compresses the (data, compressible) segments to gzip: the data which are not compressible are only stored,
+    in separate gzip members, which the gzip decoders concatenate; compressible=None follows the current member
+    """
+    compressor = None
+    current_level = None
+
+    for data, compressible in segments:
+        if compressible is None:
+            level = compresslevel if current_level is None else current_level
+        else:
+            level = compresslevel if compressible else 0
+
+        if level != current_level:
+            if compressor is not None:
+                yield compressor.flush()
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            current_level = level
+
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+
+    if compressor is None:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+
+    yield compressor.flush()
+
+
+def iter_blocks(segments, block_size=BLOCK_SIZE):
+    """
+    groups the (data, compressible) segments in blocks of about block_size, with the same compressibility
+    """
+    parts = []
+    size = 0
+    current = None
+
+    for data, compressible in segments:
+        if compressible is None:
+            compressible = True if current is None else current
+
+        if compressible != current and len(parts) > 0:
+            yield b''.join(parts), current
+            parts = []
+            size = 0
+
+        current = compressible
+        parts.append(data)
+        size += len(data)
+
+        if size >= block_size:
+            yield b''.join(parts), current
+            parts = []
+            size = 0
+
+    if len(parts) > 0:
+        yield b''.join(parts), current
+
+
+def compress_gzip_member(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+_compression_executor = None
+_compression_executor_max_workers = None
+_compression_executor_pid = None
+_compression_executor_lock = threading.Lock()
+
+
+def get_compression_executor() -> ThreadPoolExecutor:
+    # shared by the downloads, to bound the threads compressing in a process; workers may be forked after the import
+    global _compression_executor, _compression_executor_max_workers, _compression_executor_pid
+
+    with _compression_executor_lock:
+        if _compression_executor_pid != os.getpid():
+            _compression_executor_max_workers = os.cpu_count() or 1
+            _compression_executor = ThreadPoolExecutor(max_workers=_compression_executor_max_workers,
+                                                       thread_name_prefix='download-compression')
+            _compression_executor_pid = os.getpid()
+
+        return _compression_executor
+
+
+def iter_gzip_parallel(segments, compresslevel=9, block_size=BLOCK_SIZE, max_pending=None):
+    """
+    compresses each block in a separate gzip member, in the threads of the compression executor
+    (zlib releases the GIL); at most max_pending blocks are kept in memory
+    """
+    executor = get_compression_executor()
+    if max_pending is None:
+        max_pending = 2 * _compression_executor_max_workers
+
+    pending = deque()
+    n_blocks = 0
+
+    for block, compressible in iter_blocks(segments, block_size):
+        pending.append(executor.submit(compress_gzip_member, block, compresslevel if compressible else 0))
+        n_blocks += 1
+
+        while len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+    if n_blocks == 0:
+        yield compress_gzip_member(b'', compresslevel)
+
+
+def iter_zstd(segments, level=3):
+    compressor = zstandard.ZstdCompressor(level=level, threads=-1).compressobj()
+
+    for data, _ in segments:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def select_compression(compression):
+    """
+    the requested compression engine if it can be used, else gzip
+    """
+    if compression in [None, '', 'None']:
+        return 'gzip'
+
+    if compression not in compression_engines:
+        raise RequestNotUnderstood(f"unknown compression {compression}, expected one of {list(compression_engines)}")
+
+    if compression == 'zstd' and zstandard is None:
+        logger.warning("zstd compression requested, but the zstandard module is not available: using gzip")
+        return 'gzip'
+
+    return compression
+
+
+def iter_download_archive(file_list, out_dir, compression='gzip', compresslevel=None):
+    """
+    a single file is compressed, several files are archived in a compressed tar, in out_dir;
+    by default, gzip uses the level of tarfile, and parallel_gzip that of pigz, several times faster
+    """
+    if len(file_list) > 1:
+        segments = iter_tar([(name, f'{out_dir}/{os.path.basename(name)}') for name in file_list])
+    else:
+        compressible = not is_compressed(file_list[0])
+        segments = ((chunk, compressible) for chunk in iter_file(file_list[0]))
+
+    if compression == 'parallel_gzip':
+        return iter_gzip_parallel(segments, compresslevel=6 if compresslevel is None else compresslevel)
+    elif compression == 'zstd':
+        return iter_zstd(segments)
+    else:
+        return iter_gzip(segments, compresslevel=9 if compresslevel is None else compresslevel)
+
+
+class DownloadCache:
+
+    def __init__(self, cache_dir, max_size_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._evict_lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.cache_dir} ]"
+
+    @staticmethod
+    def key(job_id, file_list, **options):
+        # the products of a job are not expected to change, but if they do, the archive is rebuilt
+        files_state = []
+        for name in file_list:
+            st = os.stat(name)
+            files_state.append([os.path.basename(name), st.st_mtime_ns, st.st_size])
+
+        return hashlib.sha224(json.dumps(dict(job_id=job_id, files=files_state, **options),
+                                         sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, key)
+        try:
+            # access time is not reliably updated, the modification time keeps the order of use
+            os.utime(path)
+        except FileNotFoundError:
+            self.n_misses += 1
+            return None
+
+        self.n_hits += 1
+        return path
+
+    def stream(self, key, chunks):
+        """
+        yields the chunks, and stores them in the cache as they are sent;
+        the archive is only cached once complete
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex}"
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+
+            os.replace(tmp_path, path)
+            logger.info("cached download archive %s", path)
+        finally:
+            if os.path.exists(tmp_path):
+                # the client disconnected, or the archive could not be built
+                os.remove(tmp_path)
+
+        self.evict()
+
+    def build(self, key, chunks):
+        """
+        stores the complete archive in the cache, and returns its path
+        """
+        for _ in self.stream(key, chunks):
+            pass
+
+        return self.get(key)
+
+    def evict(self):
+        with self._evict_lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if '.tmp-' in entry.name:
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+            total_size = sum(size for _, size, _ in entries)
+
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    logger.info("evicted download archive %s", path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+_download_caches = {}
+_download_caches_lock = threading.Lock()
+
+
+def get_download_cache(cache_dir, max_size_bytes) -> DownloadCache:
+    with _download_caches_lock:
+        if cache_dir not in _download_caches:
+            _download_caches[cache_dir] = DownloadCache(cache_dir, max_size_bytes)
+            logger.info("constructed download cache %s", _download_caches[cache_dir])
+
+        download_cache = _download_caches[cache_dir]
+        download_cache.max_size_bytes = max_size_bytes
+
+        return download_cache
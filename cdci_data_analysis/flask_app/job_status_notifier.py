@@ -0,0 +1,59 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatusNotifier:
+    """
+    lets requests wait for the status of a job to change, instead of polling it repeatedly:
+    call_backs handled in this process wake up the waiting requests immediately,
+    and the job state is re-checked every check_interval_s, for the call_backs handled by other processes
+    """
+
+    def __init__(self, check_interval_s=1.0, max_wait_s=60.0, max_stream_s=3600.0, keep_alive_s=15.0):
+        self.check_interval_s = check_interval_s
+        self.max_wait_s = max_wait_s
+        self.max_stream_s = max_stream_s
+        self.keep_alive_s = keep_alive_s
+        self._condition = threading.Condition()
+        self._generations = {}
+        self.n_waiting = 0
+
+    def notify(self, job_id):
+        with self._condition:
+            if self.n_waiting > 0:
+                self._generations[job_id] = self._generations.get(job_id, 0) + 1
+                self._condition.notify_all()
+
+    def wait(self, job_id, has_changed, timeout_s):
+        """
+        returns the result of has_changed() as soon as it is true, or when timeout_s (at most max_wait_s) is elapsed
+        """
+        deadline = time.time() + min(timeout_s, self.max_wait_s)
+
+        with self._condition:
+            self.n_waiting += 1
+
+        try:
+            while True:
+                with self._condition:
+                    generation = self._generations.get(job_id, 0)
+
+                changed = has_changed()
+                remaining_s = deadline - time.time()
+                if changed or remaining_s <= 0:
+                    return changed
+
+                with self._condition:
+                    if self._generations.get(job_id, 0) == generation:
+                        self._condition.wait(min(self.check_interval_s, remaining_s))
+        finally:
+            with self._condition:
+                self.n_waiting -= 1
+                if self.n_waiting == 0:
+                    self._generations = {}
+
+
+job_status_notifier = JobStatusNotifier()
@@ -0,0 +1,256 @@
+"""
+extraction of the FITS extensions displayed by JS9
+
+each extension is extracted once, in the cache directory, in a file named after the source file, its modification
+time, the extension and the variant: repeated requests only check that the file exists.
+The source is read memory-mapped, and the extracted file is written under a temporary name, then renamed,
+so that concurrent viewers never see a partial file.
+For the very large mosaics, a cutout and a downsampled variant can be extracted, with the WCS adapted accordingly.
+
+the variants are requested by the clients: their sizes are rounded to a coarse grid, the cutouts outside of the image
+are rejected, and the least recently used files are removed when the cache is larger than max_size_bytes.
+"""
+
+import os
+import json
+import math
+import uuid
+import hashlib
+import logging
+import threading
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.nddata import Cutout2D
+
+logger = logging.getLogger(__name__)
+
+# about the memory used for each strip of the image being downsampled
+DOWNSAMPLE_STRIP_SIZE = 16 * 1024 * 1024
+
+# the requested max_size is rounded down to one of these, and the cutout centers and sizes to multiples of CUTOUT_GRID
+MAX_SIZES = (256, 512, 1024, 2048, 4096)
+CUTOUT_GRID = 64
+
+
+def downsample_image(data, factor):
+    """
+    mean of the factor x factor blocks of pixels, ignoring NaNs; computed by strips, to keep memory-mapped data on disk
+    """
+    ny, nx = data.shape[0] // factor, data.shape[1] // factor
+    downsampled = np.empty((ny, nx), dtype=np.float32)
+
+    n_rows = max(1, DOWNSAMPLE_STRIP_SIZE // (8 * factor * factor * max(nx, 1)))
+
+    with warnings.catch_warnings():
+        # blocks with only NaNs
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        for i in range(0, ny, n_rows):
+            i_end = min(ny, i + n_rows)
+            strip = np.asarray(data[i * factor:i_end * factor, :nx * factor], dtype=np.float64)
+            downsampled[i:i_end] = np.nanmean(strip.reshape(i_end - i, factor, nx, factor), axis=(1, 3))
+
+    return downsampled
+
+
+def image_header(header, wcs):
+    header = header.copy()
+    for k in ['BSCALE', 'BZERO', 'BLANK']:
+        header.remove(k, ignore_missing=True)
+
+    if wcs is not None:
+        header.update(wcs.to_header())
+
+    return header
+
+
+class JS9ExtensionCache:
+
+    def __init__(self, cache_dir='js9_cache', max_size_bytes=1024**3):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._evict_lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.cache_dir} ]"
+
+    @staticmethod
+    def normalized_max_size(max_size):
+        if max_size is None:
+            return None
+
+        if max_size <= 0:
+            raise ValueError(f"max_size should be positive, got {max_size}")
+
+        return max([s for s in MAX_SIZES if s <= max_size], default=MAX_SIZES[0])
+
+    @staticmethod
+    def normalized_cutout(cutout):
+        """
+        returns the cutout (x, y, size) on the grid
+        """
+        if cutout is None:
+            return None
+
+        x, y, size = cutout
+        if not all(math.isfinite(v) for v in cutout) or size <= 0 or x < 0 or y < 0:
+            raise ValueError(f"invalid cutout {cutout}")
+
+        return (int(round(x / CUTOUT_GRID)) * CUTOUT_GRID,
+                int(round(y / CUTOUT_GRID)) * CUTOUT_GRID,
+                int(math.ceil(size / CUTOUT_GRID)) * CUTOUT_GRID)
+
+    @staticmethod
+    def clamped_cutout(file_path, ext_id, cutout, normalized_cutout):
+        """
+        returns the normalized cutout, limited to the image, or None if the extension is not an image;
+        cutout is the requested one, which should be centered in the image
+        """
+        if cutout is None:
+            return None
+
+        header = fits.getheader(file_path, ext_id)
+        if header.get('NAXIS') != 2:
+            return None
+
+        x, y, _ = cutout
+        nx, ny = header['NAXIS1'], header['NAXIS2']
+        if not (x < nx and y < ny):
+            raise ValueError(f"cutout center ({x}, {y}) is outside of the image of {nx} x {ny} pixels")
+
+        grid_x, grid_y, grid_size = normalized_cutout
+        return (min(grid_x, nx - 1),
+                min(grid_y, ny - 1),
+                min(grid_size, int(math.ceil(max(nx, ny) / CUTOUT_GRID)) * CUTOUT_GRID))
+
+    def extracted_file_path(self, file_path, ext_id, max_size=None, cutout=None):
+        st = os.stat(file_path)
+        key = hashlib.sha224(json.dumps([os.path.abspath(file_path), st.st_mtime_ns, st.st_size,
+                                         ext_id, max_size, cutout]).encode()).hexdigest()[:32]
+
+        return os.path.join(self.cache_dir, f'js9_ext{ext_id}_{key}.fits')
+
+    def cached(self, extracted_file_path):
+        try:
+            # access time is not reliably updated, the modification time keeps the order of use
+            os.utime(extracted_file_path)
+            self.n_hits += 1
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get(self, file_path, ext_id, max_size=None, cutout=None):
+        """
+        returns the path of the file with the extension ext_id of file_path, extracting it if needed;
+        cutout is (x, y, size), in pixels; the downsampled image is at most max_size pixels wide and high,
+        both rounded to the grid
+
+        the file is looked up with the requested variant, on the grid: the header of the source is only read
+        when the file is not found, to limit the cutout to the image
+        """
+        max_size = self.normalized_max_size(max_size)
+        normalized_cutout = self.normalized_cutout(cutout)
+
+        extracted_file_path = self.extracted_file_path(file_path, ext_id, max_size=max_size, cutout=normalized_cutout)
+        if self.cached(extracted_file_path):
+            return extracted_file_path
+
+        clamped_cutout = self.clamped_cutout(file_path, ext_id, cutout, normalized_cutout)
+        if clamped_cutout != normalized_cutout:
+            extracted_file_path = self.extracted_file_path(file_path, ext_id, max_size=max_size, cutout=clamped_cutout)
+            if self.cached(extracted_file_path):
+                return extracted_file_path
+
+        self.n_misses += 1
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        tmp_file_path = f"{extracted_file_path}.tmp-{os.getpid()}-{uuid.uuid4().hex}.fits"
+        try:
+            with fits.open(file_path, memmap=True) as hdul:
+                hdu = hdul[ext_id]
+
+                if (max_size is None and clamped_cutout is None) or not hdu.is_image or hdu.data is None or hdu.data.ndim != 2:
+                    hdu.writeto(tmp_file_path)
+                else:
+                    self.extracted_image_hdu(hdu, max_size=max_size, cutout=clamped_cutout).writeto(tmp_file_path)
+
+            os.replace(tmp_file_path, extracted_file_path)
+            logger.info("extracted extension %s of %s to %s", ext_id, file_path, extracted_file_path)
+        finally:
+            if os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+
+        self.evict()
+
+        return extracted_file_path
+
+    def evict(self):
+        with self._evict_lock:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if '.tmp-' in entry.name:
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+            total_size = sum(size for _, size, _ in entries)
+
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    logger.info("evicted JS9 extension %s", path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+    @staticmethod
+    def extracted_image_hdu(hdu, max_size=None, cutout=None):
+        data = hdu.data
+
+        with warnings.catch_warnings():
+            # non-standard WCS keywords are frequent in the products
+            warnings.simplefilter('ignore')
+            wcs = WCS(hdu.header)
+
+        if not wcs.has_celestial:
+            wcs = None
+
+        if cutout is not None:
+            x, y, size = cutout
+            cutout2d = Cutout2D(data, (x, y), size, wcs=wcs, mode='trim', copy=False)
+            data, wcs = cutout2d.data, cutout2d.wcs
+
+        if max_size is not None and max(data.shape) > max_size:
+            factor = int(np.ceil(max(data.shape) / max_size))
+            data = downsample_image(data, factor)
+            if wcs is not None:
+                wcs = wcs[::factor, ::factor]
+
+        return fits.ImageHDU(data=np.asarray(data), header=image_header(hdu.header, wcs))
+
+
+_js9_extension_caches = {}
+_js9_extension_caches_lock = threading.Lock()
+
+
+def get_js9_extension_cache(cache_dir, max_size_bytes) -> JS9ExtensionCache:
+    with _js9_extension_caches_lock:
+        if cache_dir not in _js9_extension_caches:
+            _js9_extension_caches[cache_dir] = JS9ExtensionCache(cache_dir, max_size_bytes)
+            logger.info("constructed JS9 extension cache %s", _js9_extension_caches[cache_dir])
+
+        js9_extension_cache = _js9_extension_caches[cache_dir]
+        js9_extension_cache.max_size_bytes = max_size_bytes
+
+        return js9_extension_cache
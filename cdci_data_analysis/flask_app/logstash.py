@@ -1,35 +1,177 @@
+import os
 import time
 import json
+import queue
+import atexit
+import socket
 import logging
-import pylogstash
+import threading
+from collections.abc import Mapping, Iterable
 
 logger = logging.getLogger(__name__)
 
-def logstash_message(app, message_dict: dict):
-    t0 = time.time()
 
-    logger.warning("logstash_message at %s s", t0)
-    conf = app.config['conf']
+def flatten(d, parent_key='', sep='.'):
+    # the nested fields are flattened into dotted names, as pylogstash_context did
+    items = []
+    for k, v in d.items():
+        new_key = str(parent_key) + sep + str(k) if parent_key else k
+        if isinstance(v, Mapping):
+            items.extend(flatten(v, new_key, sep=sep).items())
+        elif isinstance(v, Iterable) and not isinstance(v, str):
+            items.extend(flatten(dict(enumerate(v)), new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
 
-    logger.warning("logstash_message before encoding %s in %s s", t0, time.time() - t0)
-    message_json = json.dumps(message_dict)
-    logger.warning("logstash_message after encoding %s size %s in %s s", t0, len(message_json), time.time() - t0)    
-    
-    if conf.logstash_host not in [None, "None"] and conf.logstash_port not in [None, "None"]:
-        url = f"{conf.logstash_host}:{conf.logstash_port}"
 
-        LS = pylogstash.LogStasher(url)
+class LogstashShipper:
+    """
+    sends the messages to logstash from a background thread, over a persistent connection,
+    one json document per line, in batches; the requests only put the messages in a bounded queue.
+    when the queue is full, the new messages are dropped, and counted
+    """
+
+    def __init__(self, url, max_queue_size=10000, batch_size=100, batch_interval_s=0.5, timeout_s=5.):
+        self.url = url
+        self.host, port = url.rsplit(":", 1)
+        self.port = int(port)
+        self.batch_size = batch_size
+        self.batch_interval_s = batch_interval_s
+        self.timeout_s = timeout_s
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._socket = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # the counts are updated by the requests and by the shipper thread
+        self._counts_lock = threading.Lock()
+
+        self.n_queued = 0
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_failed = 0
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.url} ]"
+
+    def _ensure_started(self):
+        # the thread is started in the process which sends: workers may be forked after the module is imported
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._pid != os.getpid() or not self._thread.is_alive():
+                    self._socket = None
+                    self._thread = threading.Thread(target=self._run, name='logstash-shipper', daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def send(self, message_dict: dict):
+        # encoded right away: the message may be modified after it is queued
+        line = json.dumps(flatten(message_dict)).encode() + b"\n"
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(line)
+            self._count('n_queued')
+        except queue.Full:
+            self._count('n_dropped')
+
+    def _count(self, name, n=1):
+        with self._counts_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def flush(self, timeout_s=5.):
+        """
+        waits for the queued messages to be sent
+        """
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            done = threading.Event()
+            try:
+                self._queue.put(done, timeout=timeout_s)
+            except queue.Full:
+                return
+            done.wait(timeout_s)
+
+    def _connect(self):
+        if self._socket is None:
+            self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout_s)
+        return self._socket
+
+    def _close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+    def _send_batch(self, batch):
+        data = b"".join(batch)
+        # a connection closed by logstash is only noticed when sending: the batch is tried once more
+        for attempt in range(2):
+            try:
+                self._connect().sendall(data)
+                self._count('n_sent', len(batch))
+                return
+            except OSError as e:
+                logger.warning("failed to send %s messages to logstash %s: %s", len(batch), self.url, repr(e))
+                self._close()
+
+        self._count('n_failed', len(batch))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            flush_events = []
+            deadline = time.time() + self.batch_interval_s
 
-        logger.warning("logstash_message constructed at %s in %s s", t0, time.time() - t0)
+            while True:
+                if isinstance(item, threading.Event):
+                    flush_events.append(item)
+                else:
+                    batch.append(item)
 
-        LS.log(
-            message_dict
-        )
+                if len(batch) >= self.batch_size or len(flush_events) > 0:
+                    break
 
-        logger.warning("logstash_message sent at %s in %s s", t0, time.time() - t0)
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - time.time()))
+                except queue.Empty:
+                    break
+
+            if len(batch) > 0:
+                self._send_batch(batch)
+
+            for event in flush_events:
+                event.set()
+
+
+_shippers = {}
+_shippers_lock = threading.Lock()
+
+
+def get_logstash_shipper(url) -> LogstashShipper:
+    with _shippers_lock:
+        if url not in _shippers:
+            _shippers[url] = LogstashShipper(url)
+            logger.info("constructed logstash shipper %s", _shippers[url])
+
+        return _shippers[url]
+
+
+@atexit.register
+def flush_logstash_shippers():
+    for shipper in list(_shippers.values()):
+        shipper.flush()
+
+
+def logstash_message(app, message_dict: dict):
+    conf = app.config['conf']
+
+    if conf.logstash_host not in [None, "None"] and conf.logstash_port not in [None, "None"]:
+        get_logstash_shipper(f"{conf.logstash_host}:{conf.logstash_port}").send(message_dict)
 
     logger.debug(f"\033[35m stashing to {conf.logstash_host}:{conf.logstash_port}\033[0m")
     logger.debug("\033[35m%s\033[0m", message_dict)
-
-    logger.warning("logstash_message done at %s in %s s", t0, time.time() - t0)
-    
@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import threading
+
+from flask import request, make_response
+
+from ..plugins import importer
+
+logger = logging.getLogger(__name__)
+
+
+class MetaDataResponseCache:
+    """
+    stores the responses of the requests describing the instruments (meta-data, parameters names),
+    which only depend on the instrument, the product_type and the version of the plugin providing the instrument;
+    the cached responses carry an ETag, so that clients can avoid downloading them again
+    """
+
+    def __init__(self):
+        self._responses = {}
+        self._plugins_generation = None
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._responses = {}
+
+    def key_from_request(self):
+        instrument_name = request.values.get('instrument', None)
+        plugin_version = importer.get_instrument_plugin_version(instrument_name)
+        if plugin_version is None:
+            # unknown or missing instrument, the error will be produced by the usual request handling
+            return None
+
+        return (request.path, instrument_name, request.values.get('product_type', None), plugin_version)
+
+    def response(self, build_response):
+        """
+        returns the cached response for the current request, or builds it with build_response() if not cached yet
+        """
+        # tokens are validated when a request is handled, this can not be skipped
+        if request.values.get('token', None) not in [None, "", "None"]:
+            return build_response()
+
+        with self._lock:
+            if self._plugins_generation != importer.plugins_generation:
+                self._responses = {}
+                self._plugins_generation = importer.plugins_generation
+
+        key = self.key_from_request()
+        if key is None:
+            return build_response()
+
+        cached = self._responses.get(key, None)
+        if cached is None:
+            self.n_misses += 1
+            response = make_response(build_response())
+            if response.status_code != 200:
+                return response
+
+            data = response.get_data()
+            cached = dict(data=data,
+                          mimetype=response.mimetype,
+                          etag=hashlib.sha224(data).hexdigest())
+
+            with self._lock:
+                self._responses[key] = cached
+
+            logger.info("cached meta-data response for %s", key)
+        else:
+            self.n_hits += 1
+
+        response = make_response(cached['data'])
+        response.mimetype = cached['mimetype']
+        response.set_etag(cached['etag'])
+
+        return response.make_conditional(request)
+
+
+meta_data_response_cache = MetaDataResponseCache()
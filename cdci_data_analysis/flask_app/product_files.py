@@ -0,0 +1,81 @@
+"""
+delivery of the product files, found in the scratch directories
+
+a job_id is a hash of the request, so the files of a done job do not change: they are served with strong ETags,
+derived from the job_id and the state of each file, and, once the job is done, they can be cached by the clients
+and the proxies for long. The files of the other jobs, including the failed ones which may be submitted again and
+rewrite them, are revalidated with the ETag. Range requests let the clients resume interrupted downloads.
+The files are sent with the file wrapper of the server (sendfile, for gunicorn), or by the front-end server,
+if X-Sendfile is enabled.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+
+from flask import send_file, request, Response
+
+logger = logging.getLogger(__name__)
+
+DONE_JOB_MAX_AGE_S = 365 * 24 * 3600
+
+scratch_dir_pattern = re.compile(r'^scratch_sid_[A-Z0-9]+_jid_(?P<job_id>[a-z0-9]+)(_aliased)?$')
+
+
+def find_scratch_dir(root_dir, file_path):
+    """
+    returns the scratch directory containing the file, and the job_id of the scratch directory, if any
+    """
+    scratch_dir = root_dir
+    for part in os.path.relpath(file_path, root_dir).split(os.sep)[:-1]:
+        scratch_dir = os.path.join(scratch_dir, part)
+        m = scratch_dir_pattern.match(part)
+        if m is not None:
+            return scratch_dir, m.group('job_id')
+
+    return None, None
+
+
+def product_etag(job_id, file_path):
+    st = os.stat(file_path)
+    return hashlib.sha224(json.dumps([job_id, os.path.basename(file_path), st.st_mtime_ns, st.st_size]).encode()).hexdigest()
+
+
+def is_job_done(scratch_dir, job_state_store) -> bool:
+    n_by_status = job_state_store.read_aggregate(scratch_dir).n_by_status
+    return n_by_status.get('done', 0) > 0 and n_by_status.get('failed', 0) == 0
+
+
+def set_cache_control(response, done):
+    if done:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = DONE_JOB_MAX_AGE_S
+        response.cache_control.immutable = True
+    else:
+        # the file may still be replaced: the clients revalidate it with the ETag
+        response.cache_control.no_cache = True
+
+    return response
+
+
+def send_product_file(file_path, etag=None, done=False, **kwargs) -> Response:
+    """
+    sends the file, answering the conditional and the Range requests
+    """
+    response = send_file(file_path, etag=True if etag is None else etag, conditional=True, **kwargs)
+    # only set by werkzeug on the partial responses
+    response.accept_ranges = 'bytes'
+    return set_cache_control(response, done)
+
+
+def not_modified(etag, done=False):
+    """
+    returns the 304 response if the client already has the version identified by the etag, else None
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return set_cache_control(response, done)
@@ -0,0 +1,150 @@
+"""
+session.log of each job, in its scratch directory
+
+a single handler, attached once, routes the records of each request to the session.log of the job of the request:
+the records are queued, and written by a background thread, which keeps a bounded pool of open files,
+closing the least recently used ones. Request threads never wait for the log files.
+"""
+
+import os
+import queue
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+_current = threading.local()
+
+
+def set_current_session_log(scratch_dir):
+    _current.filename = os.path.join(scratch_dir, 'session.log')
+
+
+def clear_current_session_log():
+    _current.filename = None
+
+
+def get_current_session_log():
+    return getattr(_current, 'filename', None)
+
+
+class SessionLogWriter:
+
+    def __init__(self, max_open_files=64, max_queue_size=10000):
+        self.max_open_files = max_open_files
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._files = OrderedDict()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_errors = 0
+
+    def _ensure_started(self):
+        # the thread is started in the process which writes: workers may be forked after the module is imported
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='session-log-writer', daemon=True)
+                    self._thread.start()
+
+    def write(self, filename, line):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((filename, line))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def flush(self, timeout_s=5.):
+        """
+        waits for the queued records to be written
+        """
+        if self._thread is not None and self._thread.is_alive():
+            done = threading.Event()
+            try:
+                self._queue.put((None, done), timeout=timeout_s)
+            except queue.Full:
+                return
+            done.wait(timeout_s)
+
+    def _get_file(self, filename):
+        f = self._files.pop(filename, None)
+        if f is None:
+            f = open(filename, 'a')
+            while len(self._files) >= self.max_open_files:
+                _, lru_f = self._files.popitem(last=False)
+                lru_f.close()
+
+        self._files[filename] = f
+        return f
+
+    def _run(self):
+        while True:
+            filename, line = self._queue.get()
+            written_files = set()
+
+            # writes all the records queued so far, before flushing the files
+            while True:
+                if filename is None:
+                    self._flush(written_files)
+                    written_files = set()
+                    line.set()
+                else:
+                    try:
+                        f = self._get_file(filename)
+                        f.write(line)
+                        written_files.add(f)
+                        self.n_written += 1
+                    except OSError:
+                        # e.g. the scratch directory was removed
+                        self.n_errors += 1
+
+                try:
+                    filename, line = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            self._flush(written_files)
+
+    def _flush(self, files):
+        for f in files:
+            if f.closed:
+                # closed as least recently used, and flushed then
+                continue
+
+            try:
+                f.flush()
+            except OSError:
+                self.n_errors += 1
+
+
+class SessionLogHandler(logging.Handler):
+    """
+    sends the records to the session.log of the request being handled by the current thread, if any
+    """
+
+    def __init__(self, writer: SessionLogWriter, level=logging.NOTSET):
+        super().__init__(level)
+        self.writer = writer
+        self.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    def emit(self, record):
+        filename = get_current_session_log()
+        if filename is None:
+            return
+
+        try:
+            self.writer.write(filename, self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+
+session_log_writer = SessionLogWriter()
+session_log_handler = SessionLogHandler(session_log_writer)
+
+atexit.register(session_log_writer.flush)
+
+
+def attach_session_log_handler(logger: logging.Logger):
+    if session_log_handler not in logger.handlers:
+        logger.addHandler(session_log_handler)
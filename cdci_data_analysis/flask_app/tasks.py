@@ -1,10 +1,18 @@
 from celery import Celery
 from celery.result import AsyncResult
+from celery import signals
 import typing
 import requests
 
 import os
+import json
+import uuid
+import hashlib
 import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
 
 def make_celery():
     celery = Celery(
@@ -38,10 +46,78 @@ def request_dispatcher(url, **params):
 
     return url + str(params)
 
-def flower_task(task_id: str) -> typing.Union[None, dict]:
+
+_worker_app_conf_file = None
+
+
+def get_worker_app(conf_file):
+    """
+    the dispatcher app, configured once per worker process
+
+    there is a single dispatcher app per process: it is configured again only if the configuration file changes
+    """
+    global _worker_app_conf_file
+
+    # the app depends on this module
+    from .app import app, conf_app
+
+    if conf_file != _worker_app_conf_file:
+        conf_app(conf_file)
+        _worker_app_conf_file = conf_file
+
+    return app
+
+
+@celery.task()
+def run_dispatcher_query(params, conf_file=None, cwd=None, url=None):
+    """
+    runs the query in the worker, as /run_analysis would, and stores the query output in the scratch directory
+
+    the scratch directories are relative to the working directory of the dispatcher: if the worker runs elsewhere,
+    or the configuration of the dispatcher can not be loaded, the query is sent to the dispatcher at url, as request_dispatcher
+    """
+    if conf_file is None or cwd != os.getcwd():
+        logger.warning("unable to run the query in the worker (conf_file: %s, dispatcher cwd: %s, worker cwd: %s), "
+                       "requesting the dispatcher", conf_file, cwd, os.getcwd())
+        return request_dispatcher(url, **params)
+
+    try:
+        app = get_worker_app(conf_file)
+    except Exception as e:
+        logger.warning("unable to configure the dispatcher in the worker: %s, requesting the dispatcher", e)
+        return request_dispatcher(url, **params)
+
+    run_query_in_app(app, params)
+
+    return str(params)
+
+
+def run_query_in_worker_app(conf_file, params):
+    # the responses can not be returned from the worker processes, the query output is stored
+    run_query_in_app(get_worker_app(conf_file), params)
+
+
+def run_query_in_app(app, params):
+    """
+    runs the query as /run_analysis would, in a request context built from the params
+    """
+    from .dispatcher_query import InstrumentQueryBackEnd
+
+    with app.test_request_context('/run_analysis', query_string=params):
+        app.preprocess_request()
+
+        query = InstrumentQueryBackEnd(app, query_id=hashlib.sha224(str(params).encode()).hexdigest()[:8])
+        r = query.run_query(disp_conf=app.config['conf'])
+
+    logger.debug("query in app returned: %s", str(r)[:200])
+
+    return r
+
+def flower_task(task_id: str, timeout=5) -> typing.Union[None, dict]:
     # same pod, port is fixed
     r = requests.get(os.environ.get("CELERY_FLOWER", "http://localhost:5555") +
-                     "/api/task/info/" + task_id)
+                     "/api/task/info/" + task_id,
+                     timeout=timeout)
 
     if r.status_code == 404:
         return None
@@ -52,3 +128,184 @@ def flower_task(task_id: str) -> typing.Union[None, dict]:
         # log and complan here TODO
         raise
 
+
+
+class TaskStateTracker:
+    """
+    states of the request_dispatcher and run_dispatcher_query tasks, recorded in one file per task: PENDING when the dispatcher sends the task,
+    then each transition pushed by the worker (see the signal handlers below)
+
+    the dispatcher polls read these files; the celery result backend, and then flower, are only consulted
+    for the tasks without record, or still PENDING, and flower at most once per task and per flower_check_interval_s
+
+    the record of a task is removed when its job is finished (see forget); the records of the ended tasks which are
+    left behind, e.g. pushed by the worker after the job was found finished, are removed after prune_age_s
+    """
+
+    ended_states = ("SUCCESS", "FAILURE", "REVOKED")
+
+    def __init__(self, state_dir, flower_check_interval_s=60, flower_timeout_s=5, prune_age_s=86400):
+        self.state_dir = state_dir
+        self.flower_check_interval_s = flower_check_interval_s
+        self.flower_timeout_s = flower_timeout_s
+        self.prune_age_s = prune_age_s
+
+        self._flower_checks = {}
+        self._flower_checks_lock = threading.Lock()
+        self._pruned_at = None
+
+    def state_filename(self, task_id):
+        return os.path.join(self.state_dir, f"{task_id}.json")
+
+    def record(self, task_id, state, replace=True, **extra):
+        """
+        with replace=False, the state is only recorded if the worker has not recorded one yet
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        filename = self.state_filename(task_id)
+        tmp_filename = f"{filename}.tmp-{os.getpid()}-{uuid.uuid4().hex}"
+        try:
+            with open(tmp_filename, "w") as f:
+                json.dump({'state': state, 'time': time.time(), **extra}, f)
+
+            if replace:
+                os.replace(tmp_filename, filename)
+            else:
+                try:
+                    os.link(tmp_filename, filename)
+                except FileExistsError:
+                    pass
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def read(self, task_id) -> typing.Union[None, dict]:
+        try:
+            with open(self.state_filename(task_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+    def forget(self, task_id):
+        """
+        removes the record of the task, once its job is finished; the old records of the ended tasks are pruned
+        at most once per prune_age_s / 10
+        """
+        try:
+            os.remove(self.state_filename(task_id))
+        except FileNotFoundError:
+            pass
+
+        with self._flower_checks_lock:
+            self._flower_checks.pop(task_id, None)
+
+        now = time.time()
+        if self._pruned_at is None or now - self._pruned_at > self.prune_age_s / 10:
+            self._pruned_at = now
+            self.prune()
+
+    def prune(self):
+        """
+        removes the records of the tasks which ended more than prune_age_s ago
+        """
+        now = time.time()
+
+        try:
+            filenames = os.listdir(self.state_dir)
+        except FileNotFoundError:
+            return
+
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+
+            record = self.read(filename[:-len(".json")])
+            if record is not None and record['state'] in self.ended_states and now - record['time'] > self.prune_age_s:
+                try:
+                    os.remove(os.path.join(self.state_dir, filename))
+                except FileNotFoundError:
+                    pass
+
+    def exists_in_flower(self, task_id) -> bool:
+        """
+        whether flower knows the task; checked at most once per flower_check_interval_s, the task is assumed
+        to exist if flower does not answer
+        """
+        now = time.time()
+
+        with self._flower_checks_lock:
+            # forget the old checks, of the tasks no longer polled
+            for k, (checked_at, _) in list(self._flower_checks.items()):
+                if now - checked_at > self.flower_check_interval_s:
+                    del self._flower_checks[k]
+
+            if task_id in self._flower_checks:
+                return self._flower_checks[task_id][1]
+
+        try:
+            exists = flower_task(task_id, timeout=self.flower_timeout_s) is not None
+        except Exception as e:
+            logger.warning("unable to check task %s in flower: %s", task_id, e)
+            exists = True
+
+        with self._flower_checks_lock:
+            self._flower_checks[task_id] = (now, exists)
+
+        return exists
+
+    def state(self, task_id) -> str:
+        record = self.read(task_id)
+
+        if record is not None:
+            state = record['state']
+        else:
+            state = celery.AsyncResult(task_id).state
+
+        if state == "PENDING" and not self.exists_in_flower(task_id):
+            return "UNEXISTENT"
+
+        return state
+
+
+task_state_tracker = TaskStateTracker(
+    os.environ.get("CELERY_TASK_STATE_DIR", ".dispatcher-task-state"),
+    flower_check_interval_s=float(os.environ.get("CELERY_FLOWER_CHECK_INTERVAL", 60)),
+    flower_timeout_s=float(os.environ.get("CELERY_FLOWER_TIMEOUT", 5)),
+    prune_age_s=float(os.environ.get("CELERY_TASK_STATE_PRUNE_AGE", 86400)),
+)
+
+
+def _record_task_state(task_id, state, sender_name):
+    if sender_name not in (request_dispatcher.name, run_dispatcher_query.name) or task_id is None:
+        return
+
+    try:
+        task_state_tracker.record(task_id, state)
+    except Exception as e:
+        logger.warning("unable to record state %s of task %s: %s", state, task_id, e)
+
+
+@signals.task_prerun.connect
+def task_started(sender=None, task_id=None, **kwargs):
+    _record_task_state(task_id, "STARTED", getattr(sender, 'name', None))
+
+
+@signals.task_success.connect
+def task_succeeded(sender=None, **kwargs):
+    _record_task_state(sender.request.id, "SUCCESS", sender.name)
+
+
+@signals.task_failure.connect
+def task_failed(sender=None, task_id=None, **kwargs):
+    _record_task_state(task_id, "FAILURE", getattr(sender, 'name', None))
+
+
+@signals.task_retry.connect
+def task_retried(sender=None, request=None, **kwargs):
+    _record_task_state(getattr(request, 'id', None), "RETRY", getattr(sender, 'name', None))
+
+
+@signals.task_revoked.connect
+def task_revoked(sender=None, request=None, **kwargs):
+    _record_task_state(getattr(request, 'id', None), "REVOKED", getattr(sender, 'name', None))
@@ -33,10 +33,13 @@ __author__ = "Andrea Tramacere"
 # Project
 # relative import eg: from .mod import f
 import importlib
+import importlib.metadata
 import pkgutil
 import traceback
 import os
+import copy
 import logging
+import threading
 from pscolors import render
 logger = logging.getLogger(__name__)
 import sys
@@ -76,10 +79,88 @@ def build_instrument_factory_list():
 
 instrument_factory_list = build_instrument_factory_list()
 
+# instruments built once per process from instrument_factory_list, by name, with the version of their plugin;
+# requests get copies of them, since running a query sets the parameters values and other state in the instrument
+_instrument_templates = None
+_instrument_templates_lock = threading.Lock()
+# incremented each time the plugins are reloaded, for anything derived from the instruments to be invalidated
+plugins_generation = 0
+
+
+def get_instrument_templates():
+    global _instrument_templates
+
+    instrument_templates = _instrument_templates
+    if instrument_templates is None:
+        with _instrument_templates_lock:
+            if _instrument_templates is None:
+                instrument_templates = {}
+                for instrument_factory in instrument_factory_list:
+                    instrument = instrument_factory()
+                    # as before, if two factories build an instrument with the same name, the last one is used
+                    instrument_templates[instrument.name] = (instrument_factory, instrument,
+                                                             factory_plugin_version(instrument_factory))
+
+                logger.info("built %s instrument templates: %s", len(instrument_templates), list(instrument_templates))
+                _instrument_templates = instrument_templates
+            else:
+                instrument_templates = _instrument_templates
+
+    return instrument_templates
+
+
+def get_instrument_names():
+    return list(get_instrument_templates())
+
+
+def get_instrument(instrument_name):
+    """
+    returns a new instrument instance, copied from the template, or None if the instrument is not known
+    """
+    if instrument_name not in get_instrument_templates():
+        return None
+
+    instrument_factory, instrument, _ = get_instrument_templates()[instrument_name]
+    try:
+        return copy.deepcopy(instrument)
+    except Exception as e:
+        logger.warning("unable to copy the instrument template for %s, building it from the factory: %s",
+                       instrument_name, repr(e))
+        return instrument_factory()
+
+
+def get_instrument_plugin_version(instrument_name):
+    """
+    returns the version of the package providing the instrument, or None if the instrument is not known
+    """
+    if instrument_name not in get_instrument_templates():
+        return None
+
+    _, _, plugin_version = get_instrument_templates()[instrument_name]
+    return plugin_version
+
+
+def factory_plugin_version(instrument_factory):
+    package_name = instrument_factory.__module__.split('.')[0]
+
+    try:
+        return importlib.metadata.version(package_name)
+    except importlib.metadata.PackageNotFoundError:
+        return getattr(sys.modules.get(package_name), '__version__', 'unknown')
+
+
+def invalidate_instrument_templates():
+    global _instrument_templates, plugins_generation
+    with _instrument_templates_lock:
+        _instrument_templates = None
+        plugins_generation += 1
+
+
 def reload_plugin(plugin_name):
     global instrument_factory_list
     if plugin_name not in cdci_plugins_dict.keys():
         raise ModuleNotFoundError(plugin_name)
     reload(cdci_plugins_dict[plugin_name])
     reload(sys.modules[cdci_plugins_dict[plugin_name].__name__+'.exposer'])
-    instrument_factory_list = build_instrument_factory_list()
\ No newline at end of file
+    instrument_factory_list = build_instrument_factory_list()
+    invalidate_instrument_templates()
\ No newline at end of file
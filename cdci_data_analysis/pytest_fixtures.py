@@ -8,6 +8,7 @@ import cdci_data_analysis.flask_app.app
 from cdci_data_analysis.analysis.exceptions import BadRequest
 from cdci_data_analysis.flask_app.dispatcher_query import InstrumentQueryBackEnd
 from cdci_data_analysis.analysis.hash import make_hash
+from cdci_data_analysis.analysis import query_output_store
 from cdci_data_analysis.configurer import ConfigEnv
 
 import re
@@ -368,10 +369,29 @@ dispatcher:
     products_url: PRODUCTS_URL
     dispatcher_callback_url_base: http://0.0.0.0:8011
     sentry_url: "https://2ba7e5918358439485632251fa73658c@sentry.io/1467382"
+    sentry_traces_sample_rate: 1.0
+    sentry_debug: false
     logstash_host: 
     logstash_port: 
     secret_key: 'secretkey_test'
     token_max_refresh_interval: 604800
+    job_state_backend: file
+    query_output_format: json
+    async_executor: celery
+    async_executor_max_workers: 4
+    async_executor_max_queued: 100
+    async_executor_instrument_max_workers: {}
+    backend_health_ttl: 60
+    backend_circuit_failure_threshold: 3
+    backend_circuit_open_interval: 30
+    backend_http_pool_size: 10
+    backend_http_connect_timeout: 10
+    backend_http_read_timeout: 300
+    download_cache_dir: download_cache
+    download_cache_max_size: 2147483648
+    js9_cache_dir: js9_cache
+    js9_cache_max_size: 1073741824
+    use_x_sendfile: false
     bind_options:
         bind_host: 0.0.0.0
         bind_port: 8011
@@ -856,16 +876,15 @@ class DispatcherJobState:
     @staticmethod
     def extract_api_code(session_id, job_id):
         # check query output are generated
-        query_output_json_fn = f'scratch_sid_{session_id}_jid_{job_id}/query_output.json'
+        scratch_dir = f'scratch_sid_{session_id}_jid_{job_id}'
         # the aliased version might have been created
-        query_output_json_fn_aliased = f'scratch_sid_{session_id}_jid_{job_id}_aliased/query_output.json'
+        scratch_dir_aliased = f'scratch_sid_{session_id}_jid_{job_id}_aliased'
         # get the query output
-        if os.path.exists(query_output_json_fn):
-            f = open(query_output_json_fn)
+        if query_output_store.stored_query_output_filename(scratch_dir) is not None:
+            query_output_data = query_output_store.load_query_output_state(scratch_dir)
         else:
-            f = open(query_output_json_fn_aliased)
+            query_output_data = query_output_store.load_query_output_state(scratch_dir_aliased)
 
-        query_output_data = json.load(f)
         extracted_api_code = None
         if 'prod_dictionary' in query_output_data and 'api_code' in query_output_data['prod_dictionary']:
             extracted_api_code = query_output_data['prod_dictionary']['api_code']
@@ -20,7 +20,6 @@ import json
 
 install_req = [
     'oda_api>=1.1.31',
-    'pylogstash_context>=0.1.19',
     "numpy",
     "pyyaml",
     "simplejson",
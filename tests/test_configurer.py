@@ -102,3 +102,15 @@ def test_config_no_resolver_urls(dispatcher_test_conf_with_gallery_no_resolver_f
     assert conf.name_resolver_url is not None
     assert hasattr(conf, 'entities_portal_url')
     assert conf.entities_portal_url is not None
+
+
+@pytest.mark.parametrize("js9_cache_dir", ["/tmp/js9_cache", "../js9_cache", "js9_cache/../../js9_cache"])
+def test_config_js9_cache_dir_outside_cwd(dispatcher_test_conf_fn, js9_cache_dir):
+    with open(dispatcher_test_conf_fn) as f:
+        config = f.read()
+
+    with open(dispatcher_test_conf_fn, "w") as f:
+        f.write(config.replace("js9_cache_dir: js9_cache", f"js9_cache_dir: {js9_cache_dir}"))
+
+    with pytest.raises(ValueError, match="js9_cache_dir"):
+        ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
@@ -7,6 +7,7 @@ import json
 import os
 import re
 import time
+import threading
 import jwt
 import logging
 import email
@@ -98,6 +99,145 @@ def test_public_async_request(dispatcher_live_fixture, dispatcher_local_mail_ser
     assert 'email_status' not in jdata['exit_status']
 
 
+def test_poll_job_status(dispatcher_live_fixture):
+    DispatcherJobState.remove_scratch_folders()
+
+    server = dispatcher_live_fixture
+    logger.info("constructed server: %s", server)
+
+    DataServerQuery.set_status('submitted')
+
+    encoded_token = jwt.encode(default_token_payload, secret_key, algorithm='HS256')
+
+    c = requests.get(server + "/run_analysis",
+                     params=dict(
+                         query_status="new",
+                         query_type="Real",
+                         instrument="empty-async",
+                         product_type="dummy",
+                         token=encoded_token
+                     ))
+    assert c.status_code == 200
+
+    dispatcher_job_state = DispatcherJobState.from_run_analysis_response(c.json())
+    poll_params = dict(job_id=dispatcher_job_state.job_id,
+                       session_id=dispatcher_job_state.session_id,
+                       token=encoded_token)
+
+    c = requests.get(server + "/job-status", params=poll_params)
+    assert c.status_code == 200
+    jdata = c.json()
+    assert jdata['query_status'] == 'submitted'
+    assert jdata['job_monitor']['job_id'] == dispatcher_job_state.job_id
+
+    for message in 'started', 'running':
+        c = requests.get(server + "/call_back",
+                         params=dict(
+                             job_id=dispatcher_job_state.job_id,
+                             session_id=dispatcher_job_state.session_id,
+                             instrument_name="empty-async",
+                             action='progress',
+                             node_id='node_1',
+                             message=message,
+                             token=encoded_token,
+                             progressing='yes',
+                         ))
+        assert c.status_code == 200
+
+        c = requests.get(server + "/job-status", params=poll_params)
+        jdata = c.json()
+        assert jdata['query_status'] == 'progress'
+        assert jdata['job_monitor']['n_progress'] >= 1
+
+    # only the reports written since the last poll
+    c = requests.get(server + "/job-status", params={**poll_params, 'since': jdata['job_monitor']['seq']})
+    assert c.json()['job_monitor']['full_report_dict_list'] == []
+
+    # the job does not belong to another user
+    other_token = jwt.encode({**default_token_payload, 'sub': 'other@mtmco.net'}, secret_key, algorithm='HS256')
+    c = requests.get(server + "/job-status", params={**poll_params, 'token': other_token})
+    assert c.status_code == 403
+
+    c = requests.get(server + "/job-status", params={**poll_params, 'token': None})
+    assert c.status_code == 403
+
+    c = requests.get(server + "/job-status", params={**poll_params, 'token': 'invalid_token'})
+    assert c.status_code == 403
+    assert c.text == 'The token provided is not valid.'
+
+
+def test_wait_job_status(gunicorn_dispatcher_live_fixture):
+    DispatcherJobState.remove_scratch_folders()
+
+    # long polls and streams hold a worker
+    server = gunicorn_dispatcher_live_fixture
+    logger.info("constructed server: %s", server)
+
+    DataServerQuery.set_status('submitted')
+
+    encoded_token = jwt.encode(default_token_payload, secret_key, algorithm='HS256')
+
+    c = requests.get(server + "/run_analysis",
+                     params=dict(
+                         query_status="new",
+                         query_type="Real",
+                         instrument="empty-async",
+                         product_type="dummy",
+                         token=encoded_token
+                     ))
+    assert c.status_code == 200
+
+    dispatcher_job_state = DispatcherJobState.from_run_analysis_response(c.json())
+    poll_params = dict(job_id=dispatcher_job_state.job_id,
+                       session_id=dispatcher_job_state.session_id,
+                       token=encoded_token)
+
+    def call_back(action, delay_s):
+        time.sleep(delay_s)
+        c = requests.get(server + "/call_back",
+                         params=dict(
+                             job_id=dispatcher_job_state.job_id,
+                             session_id=dispatcher_job_state.session_id,
+                             instrument_name="empty-async",
+                             action=action,
+                             node_id='node_1',
+                             message=action,
+                             token=encoded_token,
+                             progressing='yes',
+                         ))
+        assert c.status_code == 200
+
+    # nothing happens: the long poll returns after the wait
+    t0 = time.time()
+    c = requests.get(server + "/job-status", params={**poll_params, 'query_status': 'submitted', 'wait': 2})
+    assert c.json()['query_status'] == 'submitted'
+    assert time.time() - t0 > 2
+
+    # the long poll returns as soon as the call_back is received
+    threading.Thread(target=call_back, args=('progress', 1)).start()
+    t0 = time.time()
+    c = requests.get(server + "/job-status", params={**poll_params, 'query_status': 'submitted', 'wait': 30})
+    assert c.json()['query_status'] == 'progress'
+    assert time.time() - t0 < 10
+
+    DataServerQuery.set_status('done')
+    try:
+        threading.Thread(target=call_back, args=('done', 1)).start()
+        with requests.get(server + "/job-status-stream",
+                          params={**poll_params, 'query_status': 'progress', 'stream_s': 30},
+                          stream=True) as c:
+            assert c.headers['Content-Type'].startswith('text/event-stream')
+            events = [json.loads(line[len('data: '):])
+                      for line in c.iter_lines(decode_unicode=True)
+                      if line.startswith('data: ')]
+    finally:
+        # sets the expected default for other tests
+        DataServerQuery.set_status('submitted')
+
+    assert [event['query_status'] for event in events] == ['progress', 'ready']
+    assert events[-1]['job_monitor']['full_report_dict_list'][-1]['action'] == 'done'
+
+
 # we want to be able to view, in browser, fully formed emails. So storing templates does not do.
 # but every test will generate them a bit differently, due to time embedded in them
 # so just this time recored should be adapted for every test
@@ -18,6 +18,8 @@ from urllib import parse
 import nbformat as nbf
 import yaml
 import gzip
+import tarfile
+import io
 import random
 import string
 
@@ -81,6 +83,40 @@ def test_js9(dispatcher_live_fixture):
     r = requests.get(f'{dispatcher_live_fixture.rstrip("/")}/api/v1.0/oda/get_js9_plot', params={'file_path': 'js9.fits'})
     assert r.status_code == 200
 
+
+@pytest.mark.fast
+def test_js9_extension_variants(dispatcher_live_fixture, empty_products_files_fixture):
+    from astropy.io import fits
+    import numpy as np
+
+    server = dispatcher_live_fixture
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    file_path = f'scratch_sid_{session_id}_jid_{job_id}/mosaic.fits'
+
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.ones((400, 300)))]).writeto(file_path)
+
+    js9_file_paths = []
+    for params in [{}, {}, {'max_size': 256}, {'cutout_x': 130, 'cutout_y': 120, 'cutout_size': 50}]:
+        r = requests.get(f'{server.rstrip("/")}/api/v1.0/oda/get_js9_plot',
+                         params={'file_path': file_path, 'ext_id': 1, **params})
+        assert r.status_code == 200
+        js9_file_paths.append(re.search(r'JS9.Preload\("product/(.*?)"', r.text).group(1))
+
+    assert js9_file_paths[0] == js9_file_paths[1]
+    assert len(set(js9_file_paths)) == 3
+
+    assert fits.getdata(js9_file_paths[2], 1).shape == (200, 150)
+    # on the grid of the cutouts
+    assert fits.getdata(js9_file_paths[3], 1).shape == (64, 64)
+
+    # outside of the image
+    r = requests.get(f'{server.rstrip("/")}/api/v1.0/oda/get_js9_plot',
+                     params={'file_path': file_path, 'ext_id': 1, 'cutout_x': 1000, 'cutout_y': 100, 'cutout_size': 50})
+    assert r.status_code >= 400
+    assert 'outside of the image' in r.text
+
 @pytest.fixture
 def safe_dummy_plugin_conf():
     from cdci_data_analysis.plugins.dummy_plugin import conf_file
@@ -123,6 +159,42 @@ def test_reload_plugin(safe_dummy_plugin_conf, dispatcher_live_fixture):
     assert 'empty-async' not in jdata
     assert 'empty-semi-async' not in jdata
 
+@pytest.mark.fast
+@pytest.mark.parametrize("endpoint", ["api/meta-data", "meta-data", "meta-data-src", "api/par-names"])
+def test_meta_data_etag(safe_dummy_plugin_conf, dispatcher_live_fixture, endpoint):
+    server = dispatcher_live_fixture
+
+    params = {'instrument': 'empty', 'product_type': 'numerical'}
+
+    c = requests.get(os.path.join(server, endpoint), params=params)
+    assert c.status_code == 200
+    etag = c.headers['ETag']
+
+    c_cached = requests.get(os.path.join(server, endpoint), params=params)
+    assert c_cached.status_code == 200
+    assert c_cached.headers['ETag'] == etag
+    assert c_cached.json() == c.json()
+
+    c_not_modified = requests.get(os.path.join(server, endpoint), params=params, headers={'If-None-Match': etag})
+    assert c_not_modified.status_code == 304
+    assert c_not_modified.content == b''
+
+    if endpoint != "meta-data-src":
+        c_other_product = requests.get(os.path.join(server, endpoint),
+                                       params={**params, 'product_type': 'echo'})
+        assert c_other_product.status_code == 200
+        assert c_other_product.headers['ETag'] != etag
+
+    with open(safe_dummy_plugin_conf, 'w') as fd:
+        fd.write('instruments: []\n')
+
+    c = requests.get(server + "/reload-plugin/dummy_plugin")
+    assert c.status_code == 200
+
+    c = requests.get(os.path.join(server, endpoint), params=params, headers={'If-None-Match': etag})
+    assert c.status_code == 400
+
+
 @pytest.mark.fast
 def test_empty_request(dispatcher_live_fixture):
     server = dispatcher_live_fixture
@@ -400,6 +472,152 @@ def test_download_products_public(dispatcher_long_living_fixture, empty_products
     assert data_downloaded == empty_products_files_fixture['content']
 
 
+@pytest.mark.fast
+def test_download_products_archive(dispatcher_live_fixture, empty_products_files_fixture):
+    server = dispatcher_live_fixture
+
+    logger.info("constructed server: %s", server)
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
+
+    spectrum_content = os.urandom(1000) + b'\0' * 100000
+    with open(scratch_dir_path + '/spectrum.fits', 'wb') as fout:
+        fout.write(spectrum_content)
+
+    params = {
+            'instrument': 'empty',
+            'query_status': 'ready',
+            'file_list': 'test.fits.gz,spectrum.fits',
+            'download_file_name': 'spectra.tar.gz',
+            'session_id': session_id,
+            'job_id': job_id
+        }
+
+    # the second archive is the one cached during the first download
+    contents = []
+    for i in range(2):
+        c = requests.get(server + "/download_products",
+                         params=params)
+        assert c.status_code == 200
+        assert c.headers['Content-Disposition'] == 'attachment; filename=spectra.tar.gz'
+        contents.append(c.content)
+
+    assert contents[0] == contents[1]
+
+    with tarfile.open(fileobj=io.BytesIO(contents[0]), mode='r:gz') as tar:
+        assert tar.getnames() == ['spectra/test.fits.gz', 'spectra/spectrum.fits']
+        assert tar.extractfile('spectra/test.fits.gz').read() == empty_products_files_fixture['content']
+        assert tar.extractfile('spectra/spectrum.fits').read() == spectrum_content
+
+    c = requests.get(server + "/download_products",
+                     params={**params, 'compression': 'parallel_gzip'})
+    assert c.status_code == 200
+
+    with tarfile.open(fileobj=io.BytesIO(c.content), mode='r:gz') as tar:
+        assert tar.extractfile('spectra/spectrum.fits').read() == spectrum_content
+
+    c = requests.get(server + "/download_products",
+                     params={**params, 'compression': 'rar'})
+    assert c.status_code == 400
+
+
+@pytest.mark.fast
+def test_download_products_resume(dispatcher_live_fixture, empty_products_files_fixture):
+    server = dispatcher_live_fixture
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
+
+    with open(scratch_dir_path + '/spectrum.fits', 'wb') as fout:
+        fout.write(os.urandom(100000))
+
+    params = {
+            'instrument': 'empty',
+            'query_status': 'ready',
+            'file_list': 'test.fits.gz,spectrum.fits',
+            'download_file_name': 'spectra.tar.gz',
+            'session_id': session_id,
+            'job_id': job_id
+        }
+
+    # the download is interrupted, and resumed: the archive is built before the range is sent
+    c = requests.get(server + "/download_products", params=params, headers={'Range': 'bytes=1000-'})
+    assert c.status_code == 206
+    etag = c.headers['ETag']
+    assert not etag.startswith('W/')
+
+    c_full = requests.get(server + "/download_products", params=params)
+    assert c_full.status_code == 200
+    assert c_full.headers['ETag'] == etag
+    assert c_full.headers['Accept-Ranges'] == 'bytes'
+    assert c_full.content[1000:] == c.content
+
+    c = requests.get(server + "/download_products", params=params, headers={'If-None-Match': etag})
+    assert c.status_code == 304
+
+    # not done: the clients revalidate
+    assert 'no-cache' in c_full.headers['Cache-Control']
+
+
+@pytest.mark.fast
+def test_product_file_conditional_range(dispatcher_live_fixture, empty_products_files_fixture):
+    server = dispatcher_live_fixture
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
+
+    content = os.urandom(1000)
+    with open(scratch_dir_path + '/spectrum.fits', 'wb') as fout:
+        fout.write(content)
+
+    url = server + f"/api/v1.0/oda/product/{scratch_dir_path}/spectrum.fits"
+
+    c = requests.get(url)
+    assert c.status_code == 200
+    assert c.content == content
+    assert c.headers['Accept-Ranges'] == 'bytes'
+    etag = c.headers['ETag']
+    assert not etag.startswith('W/')
+    assert 'no-cache' in c.headers['Cache-Control']
+
+    c = requests.get(url, headers={'Range': 'bytes=5-9'})
+    assert c.status_code == 206
+    assert c.content == content[5:10]
+    assert c.headers['Content-Range'] == f'bytes 5-9/{len(content)}'
+
+    c = requests.get(url, headers={'If-None-Match': etag})
+    assert c.status_code == 304
+
+    c = requests.get(url, headers={'Range': f'bytes={len(content) + 10}-'})
+    assert c.status_code == 416
+
+    # a failed job may be submitted again, and rewrite the file: the clients revalidate
+    with open(os.path.join(scratch_dir_path, 'job_monitor_node_failed.json'), 'w') as f:
+        json.dump({'status': 'failed', 'job_id': job_id, 'full_report_dict': {}}, f)
+
+    c = requests.get(url)
+    assert c.status_code == 200
+    assert c.headers['ETag'] == etag
+    assert 'no-cache' in c.headers['Cache-Control']
+    assert 'immutable' not in c.headers['Cache-Control']
+
+    os.remove(os.path.join(scratch_dir_path, 'job_monitor_node_failed.json'))
+
+    # once the job is done, the file can be cached for long
+    with open(os.path.join(scratch_dir_path, 'job_monitor_node_done.json'), 'w') as f:
+        json.dump({'status': 'done', 'job_id': job_id, 'full_report_dict': {}}, f)
+
+    c = requests.get(url)
+    assert c.status_code == 200
+    assert c.headers['ETag'] == etag
+    assert 'immutable' in c.headers['Cache-Control']
+    assert 'max-age=31536000' in c.headers['Cache-Control']
+
+
 @pytest.mark.fast
 def test_download_products_authorized_user(dispatcher_live_fixture, empty_products_user_files_fixture):
     server = dispatcher_live_fixture
@@ -23,6 +23,11 @@ from cdci_data_analysis.analysis.parameters import (
 )
 
 import numpy as np
+import os
+import glob
+import json
+import shutil
+import time
 
 
 @pytest.mark.fast
@@ -342,3 +347,1267 @@ def test_parameter_from_owl_uri_extra_param(caplog):
                            units='d', # wrong parameter
                            name='example')
     assert "parameter units with value d not used to construct <class 'cdci_data_analysis.analysis.parameters.Time'>" in caplog.text
+
+
+@pytest.mark.fast
+def test_job_registry(tmpdir):
+    from cdci_data_analysis.analysis.job_registry import JobRegistry
+
+    work_dir = str(tmpdir)
+    registry = JobRegistry(registry_path=os.path.join(work_dir, '.registry', 'jobs.sqlite'), work_dir=work_dir)
+
+    assert registry.find_scratch_dirs('aaaabbbbccccdddd') == []
+
+    # created by the dispatcher
+    mtime_ns = registry.stat_work_dir()
+    os.mkdir(os.path.join(work_dir, 'scratch_sid_01234567890123AB_jid_aaaabbbbccccdddd'))
+    registry.register(os.path.join(work_dir, 'scratch_sid_01234567890123AB_jid_aaaabbbbccccdddd'),
+                      work_dir_mtime_ns_before=mtime_ns)
+
+    # created behind the back of the registry
+    os.mkdir(os.path.join(work_dir, 'scratch_sid_01234567890123CD_jid_aaaabbbbccccdddd_aliased'))
+    with open(os.path.join(work_dir, 'scratch_sid_01234567890123CD_jid_aaaabbbbccccdddd_aliased',
+                           'analysis_parameters.json'), 'w') as f:
+        json.dump({'instrument': 'empty'}, f)
+    os.mkdir(os.path.join(work_dir, 'scratch_sid_01234567890123CD_jid_eeeeffff00001111'))
+
+    assert registry.find_scratch_dirs('aaaabbbbccccdddd') == [
+        os.path.join(work_dir, 'scratch_sid_01234567890123AB_jid_aaaabbbbccccdddd'),
+        os.path.join(work_dir, 'scratch_sid_01234567890123CD_jid_aaaabbbbccccdddd_aliased'),
+    ]
+    assert registry.find_scratch_dirs('aaaabbbbccccdddd', aliased=False) == [
+        os.path.join(work_dir, 'scratch_sid_01234567890123AB_jid_aaaabbbbccccdddd'),
+    ]
+    assert registry.find_scratch_dirs('eeeeffff00001111') == [
+        os.path.join(work_dir, 'scratch_sid_01234567890123CD_jid_eeeeffff00001111'),
+    ]
+    assert registry.get_analysis_parameters('aaaabbbbccccdddd') == {'instrument': 'empty'}
+    assert registry.get_analysis_parameters('eeeeffff00001111') is None
+
+    assert [r['job_id'] for r in registry.list_scratch_dirs(job_id_prefix='eeee')] == ['eeeeffff00001111']
+
+    shutil.rmtree(os.path.join(work_dir, 'scratch_sid_01234567890123AB_jid_aaaabbbbccccdddd'))
+    assert registry.find_scratch_dirs('aaaabbbbccccdddd', aliased=False) == []
+
+    # a new registry in the same location sees the same content
+    assert JobRegistry(registry_path=registry.registry_path, work_dir=work_dir).rebuild() == 2
+
+
+@pytest.mark.fast
+def test_instrument_templates(monkeypatch):
+    from cdci_data_analysis.plugins import importer
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument
+
+    n_built = []
+
+    def counting_factory():
+        n_built.append(1)
+        return empty_instrument.my_instr_factory()
+
+    monkeypatch.setattr(importer, 'instrument_factory_list', [counting_factory])
+    importer.invalidate_instrument_templates()
+
+    try:
+        assert importer.get_instrument_names() == ['empty']
+        assert importer.get_instrument('unknown') is None
+
+        instrument_1 = importer.get_instrument('empty')
+        instrument_2 = importer.get_instrument('empty')
+        assert len(n_built) == 1
+
+        # the version of the plugin is found once, with the templates
+        plugin_version = importer.get_instrument_plugin_version('empty')
+        assert plugin_version is not None
+        with monkeypatch.context() as m:
+            m.setattr(importer.importlib.metadata, 'version', lambda package_name: pytest.fail("version looked up again"))
+            assert importer.get_instrument_plugin_version('empty') == plugin_version
+        assert instrument_1 is not instrument_2
+
+        instrument_1.set_pars_from_dic({'product_type': 'numerical', 'p': 5.})
+        assert instrument_1.get_par_by_name('p').value == 5.
+        assert instrument_2.get_par_by_name('p').value == 10.
+        assert importer.get_instrument('empty').get_par_by_name('p').value == 10.
+
+        importer.invalidate_instrument_templates()
+        importer.get_instrument('empty')
+        assert len(n_built) == 2
+    finally:
+        importer.invalidate_instrument_templates()
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("backend", ["file", "log", "redis"])
+def test_job_state_store(tmpdir, monkeypatch, backend):
+    from cdci_data_analysis.analysis.job_state_store import get_job_state_store
+    from cdci_data_analysis.analysis.job_manager import job_factory
+
+    state_store = get_job_state_store(backend)
+    if backend == "redis":
+        import redis
+        try:
+            state_store.redis.ping()
+        except redis.exceptions.ConnectionError:
+            pytest.skip("redis is not available")
+    work_dir = str(tmpdir)
+
+    def make_job(par_dic):
+        return job_factory('empty-async', work_dir, 'localhost', 8000, None, 'SESSIONID', 'JOBID', par_dic,
+                           state_store=state_store)
+
+    job = make_job({})
+    job.set_submitted()
+    job.write_dataserver_status()
+    assert job.updated_dataserver_monitor()['status'] == 'submitted'
+
+    for node_id, message in [('node_1', 'started'), ('node_2', 'started'), ('node_1', 'started'), ('node_1', 'done')]:
+        par_dic = {'node_id': node_id, 'message': message, 'action': 'progress', 'progressing': 'yes'}
+        make_job(par_dic).write_dataserver_status(status_dictionary_value='progress', full_dict=par_dic)
+        time.sleep(0.01)
+
+    job_monitor = make_job({}).updated_dataserver_monitor()
+    assert job_monitor['status'] == 'progress'
+    # repeated records replace the previous ones
+    assert [(r['node_id'], r['message']) for r in job_monitor['full_report_dict_list']] == [
+        ('node_2', 'started'), ('node_1', 'started'), ('node_1', 'done')]
+    seq = job_monitor['seq']
+    assert job_monitor['n_progress'] == 3
+    assert job_monitor['last_progress']['node_id'] == 'node_1'
+
+    time.sleep(0.01)
+    par_dic = {'node_id': 'node_2', 'message': 'done', 'action': 'done'}
+    make_job(par_dic).write_dataserver_status(status_dictionary_value='done', full_dict=par_dic)
+
+    job_monitor = make_job({}).updated_dataserver_monitor()
+    assert job_monitor['status'] == 'done'
+    assert len(job_monitor['full_report_dict_list']) == 4
+    assert job_monitor['n_progress'] == 3
+
+    # only the records written since the previous poll
+    job_monitor = make_job({}).updated_dataserver_monitor(since=seq)
+    assert job_monitor['status'] == 'done'
+    assert [(r['node_id'], r['message']) for r in job_monitor['full_report_dict_list']] == [('node_2', 'done')]
+
+    job_monitor = make_job({}).updated_dataserver_monitor(since=job_monitor['seq'])
+    assert job_monitor['full_report_dict_list'] == []
+
+    if backend == "log":
+        # the log is only read from the sequence number on
+        read_offsets = []
+        read_log = state_store._read_log
+        monkeypatch.setattr(state_store, '_read_log',
+                            lambda work_dir, offset=0: read_offsets.append(offset) or read_log(work_dir, offset))
+        assert len(state_store.records(work_dir, since=seq)) == 1
+        assert read_offsets == [seq]
+        monkeypatch.undo()
+
+    assert state_store.read(work_dir, 'job_monitor.json')['status'] == 'submitted'
+    assert [name for name, _ in state_store.read_all_named(work_dir)] == [
+        'job_monitor.json', 'job_monitor_node_2_started_.json', 'job_monitor_node_1_started_.json',
+        'job_monitor_node_1_done_.json', 'job_monitor_node_2_done_.json']
+
+    if backend != "file":
+        # the summary is read without the records
+        with monkeypatch.context() as m:
+            m.setattr(state_store, 'records', lambda *args, **kwargs: pytest.fail("records read with the summary"))
+            aggregate = state_store.read_aggregate(work_dir)
+
+        assert aggregate.n_by_status == {'submitted': 1, 'progress': 3, 'done': 1}
+        assert aggregate.last_record()[1] == 'job_monitor_node_2_done_.json'
+        assert aggregate.last_record()[2]['status'] == 'done'
+
+
+def test_job_state_aggregate():
+    from cdci_data_analysis.analysis.job_state_store import JobStateAggregate
+
+    records = [(1, 'a', {'status': 'submitted'}),
+               (2, 'b', {'status': 'progress', 'full_report_dict': {'progressing': 'yes', 'n': 1}}),
+               (3, 'a', {'status': 'progress', 'full_report_dict': {'progressing': 'yes', 'n': 2}}),
+               (4, 'c', None)]
+
+    aggregate = JobStateAggregate(read_records=lambda since=None: [r for r in records[1:] if since is None or r[0] > since])
+    replaced_meta = {}
+    for seq, name, monitor in records:
+        aggregate.add(seq, name, monitor, replaced_meta=replaced_meta.get(name))
+        replaced_meta[name] = JobStateAggregate.record_meta(monitor)
+
+    assert aggregate.seq == 4
+    assert aggregate.n_by_status == {'submitted': 0, 'progress': 2, 'None': 1}
+    assert aggregate.n_progress == 2
+    assert aggregate.last_progress == {'progressing': 'yes', 'n': 2}
+    assert aggregate.last_record() == (4, 'c', None)
+    assert aggregate.full_report_dict_list(since=2) == [{'progressing': 'yes', 'n': 2}]
+
+    # the state is json-serializable, to be persisted by the stores, without the records
+    assert JobStateAggregate(json.loads(json.dumps(aggregate.state))).state == aggregate.state
+    assert JobStateAggregate(json.loads(json.dumps(aggregate.state))).records() == []
+
+
+def test_job_status_notifier():
+    import threading
+    from cdci_data_analysis.flask_app.job_status_notifier import JobStatusNotifier
+
+    notifier = JobStatusNotifier(check_interval_s=10)
+    state = {'status': 'submitted'}
+
+    def call_back():
+        time.sleep(0.2)
+        state['status'] = 'progress'
+        notifier.notify('JOBID')
+
+    threading.Thread(target=call_back).start()
+
+    # woken up by the notification, well before the check interval
+    t0 = time.time()
+    assert notifier.wait('JOBID', lambda: state['status'] != 'submitted', timeout_s=5)
+    assert time.time() - t0 < 2
+
+    t0 = time.time()
+    assert not notifier.wait('JOBID', lambda: state['status'] == 'done', timeout_s=0.3)
+    assert time.time() - t0 >= 0.3
+    assert notifier.n_waiting == 0
+
+
+@pytest.mark.parametrize("o, expected_hash", [
+    (None, '6b407c3954f3cd40'),
+    (True, 'da488af1c131a849'),
+    (1, '4d8a15e3cc35750f'),
+    (2.5, 'bdb3ea40d00d91ad'),
+    ("", 'e9a9fd681183b22e'),
+    ("ab", '8f66f44ffbe49e3b'),
+    ("ba", '8f66f44ffbe49e3b'),
+    ("é", 'b2a08bce15b7c034'),
+    ('quote"and\\slash', 'f0bd26f03f360827'),
+    ([], 'd751713988987e93'),
+    ({}, 'd751713988987e93'),
+    ((3, 2, 1), '1e3a801e6c417cd2'),
+    ({1, 2, 3}, '1e3a801e6c417cd2'),
+    (["1", 1], 'a56b4392ee8a20ed'),
+    ({"a": 1}, '5ba809418aab2f76'),
+    ({"a": "1"}, 'e9525e411874dc26'),
+    ({"b": [1, {"c": None}]}, 'cd2aface5e594631'),
+    ({'instrument': 'empty-async', 'product_type': 'dummy', 'query_type': 'Real', 'RA': 83.633080, 'DEC': 22.01450,
+      'T1': '2001-12-11T00:00:00.000', 'scw_list': ['066500330010.001', '066500340010.001'], 'sub': 'mtm@mtmco.net'},
+     '4ce230bccba88806'),
+])
+def test_make_hash_compatibility(o, expected_hash):
+    from cdci_data_analysis.analysis.hash import make_hash
+
+    # the job_id of the existing jobs are made with these hashes
+    assert make_hash(o) == expected_hash
+    assert make_hash(o) == expected_hash
+
+
+def test_make_hash_random_corpus():
+    import hashlib
+    import random
+    from cdci_data_analysis.analysis.hash import make_hash
+
+    def reference_make_hash(o):
+        def format_hash(x): return hashlib.md5(
+            json.dumps(sorted(x)).encode()
+        ).hexdigest()[:16]
+
+        if isinstance(o, (set, tuple, list)):
+            return format_hash(tuple(map(reference_make_hash, o)))
+
+        elif isinstance(o, dict):
+            return reference_make_hash(tuple(o.items()))
+
+        return format_hash(json.dumps(o))
+
+    rng = random.Random(0)
+
+    def random_object(depth=0):
+        kind = rng.choice(['str', 'int', 'float', 'bool', 'none'] + (['list', 'tuple', 'dict'] if depth < 3 else []))
+        if kind == 'str':
+            return ''.join(rng.choice('aZ0 _-.:"\\é\n') for _ in range(rng.randint(0, 8)))
+        elif kind == 'int':
+            return rng.randint(-1000, 1000)
+        elif kind == 'float':
+            return rng.uniform(-1e3, 1e3)
+        elif kind == 'bool':
+            return rng.choice([True, False])
+        elif kind == 'none':
+            return None
+        elif kind == 'list':
+            return [random_object(depth + 1) for _ in range(rng.randint(0, 4))]
+        elif kind == 'tuple':
+            return tuple(random_object(depth + 1) for _ in range(rng.randint(0, 4)))
+        else:
+            return {str(random_object(depth + 1)): random_object(depth + 1) for _ in range(rng.randint(0, 4))}
+
+    for _ in range(1000):
+        o = random_object()
+        assert make_hash(o) == reference_make_hash(o)
+
+
+def test_decoded_token_cache():
+    import jwt
+    from cdci_data_analysis.analysis.tokenHelper import DecodedTokenCache
+
+    cache = DecodedTokenCache(max_size=2)
+    secret_key = 'secretkey_test'
+
+    token = jwt.encode({'sub': 'mtm@mtmco.net', 'exp': int(time.time()) + 5000}, secret_key, algorithm='HS256')
+
+    assert cache.decode(token, secret_key)['sub'] == 'mtm@mtmco.net'
+    assert cache.decode(token, secret_key)['sub'] == 'mtm@mtmco.net'
+    assert (cache.n_hits, cache.n_misses) == (1, 1)
+
+    # the payload is verified again with another secret key
+    with pytest.raises(jwt.exceptions.InvalidSignatureError):
+        cache.decode(token, 'another_secret_key')
+
+    # the expiration is checked for the cached payloads
+    short_lived_token = jwt.encode({'sub': 'mtm@mtmco.net', 'exp': int(time.time()) + 1}, secret_key, algorithm='HS256')
+    cache.decode(short_lived_token, secret_key)
+    time.sleep(1.1)
+    with pytest.raises(jwt.exceptions.ExpiredSignatureError):
+        cache.decode(short_lived_token, secret_key)
+
+    # least recently used tokens are dropped
+    for i in range(3):
+        cache.decode(jwt.encode({'sub': f'user{i}@mtmco.net'}, secret_key, algorithm='HS256'), secret_key)
+    n_misses = cache.n_misses
+    cache.decode(token, secret_key)
+    assert cache.n_misses == n_misses + 1
+
+
+def test_session_log(tmpdir):
+    import logging
+    import threading
+    from cdci_data_analysis.flask_app.session_log import (
+        SessionLogWriter, SessionLogHandler, set_current_session_log, clear_current_session_log)
+
+    writer = SessionLogWriter(max_open_files=2)
+    logger = logging.getLogger('test_session_log')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(SessionLogHandler(writer))
+
+    scratch_dirs = [str(tmpdir.mkdir(f'scratch_{i}')) for i in range(4)]
+
+    def request(i):
+        set_current_session_log(scratch_dirs[i])
+        for j in range(10):
+            logger.info("request %s record %s", i, j)
+        clear_current_session_log()
+        logger.info("request %s done", i)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    writer.flush()
+
+    # each request writes in its own session log, even with fewer open files than sessions
+    for i, scratch_dir in enumerate(scratch_dirs):
+        with open(os.path.join(scratch_dir, 'session.log')) as f:
+            lines = f.readlines()
+        assert len(lines) == 10
+        assert all(f"request {i} record" in line for line in lines)
+
+    assert len(writer._files) <= 2
+    assert writer.n_written == 40
+
+
+def test_app_logging_get_logger_benchmark():
+    import logging
+    import timeit
+    from cdci_data_analysis.app_logging import AppLogging
+
+    app_logging = AppLogging()
+    app_logging.level_by_logger = {"": "info", "test_app_logging.configured": "debug"}
+
+    def time_get_logger():
+        return min(timeit.repeat(lambda: app_logging.getLogger('test_app_logging.get_logger'), number=1000, repeat=5))
+
+    t_few_loggers = time_get_logger()
+
+    for i in range(5000):
+        logging.getLogger(f'test_app_logging.many.logger_{i}')
+
+    t_many_loggers = time_get_logger()
+
+    print(f"getLogger x1000: {t_few_loggers:.3g} s with few loggers, {t_many_loggers:.3g} s with 5000 more loggers")
+
+    # walking the logging tree would take time proportional to the number of loggers
+    assert t_many_loggers < 5 * t_few_loggers + 1e-3
+
+    # the levels are applied to the loggers created after the setup
+    assert app_logging.getLogger('test_app_logging.configured').level == logging.DEBUG
+
+
+def test_logstash_shipper():
+    import socket
+    import threading
+    from cdci_data_analysis.flask_app.logstash import LogstashShipper
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+
+    received = {'connections': 0, 'data': b''}
+
+    def serve():
+        while True:
+            try:
+                connection, _ = server_socket.accept()
+            except OSError:
+                return
+            received['connections'] += 1
+            with connection:
+                while True:
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    received['data'] += data
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    shipper = LogstashShipper(f"127.0.0.1:{server_socket.getsockname()[1]}", max_queue_size=1000)
+
+    for i in range(250):
+        shipper.send({'origin': 'test', 'event': i, 'details': {'list': [1, 2]}})
+
+    shipper.flush()
+    time.sleep(0.2)
+    server_socket.close()
+
+    messages = [json.loads(line) for line in received['data'].splitlines()]
+    assert [m['event'] for m in messages] == list(range(250))
+    assert messages[0]['details.list.1'] == 2
+    assert received['connections'] == 1
+    assert (shipper.n_sent, shipper.n_dropped, shipper.n_failed) == (250, 0, 0)
+
+    # when the queue is full, new messages are dropped
+    shipper = LogstashShipper("127.0.0.1:1", max_queue_size=1)
+    shipper._ensure_started = lambda: None
+    shipper.send({'event': 1})
+    shipper.send({'event': 2})
+    assert (shipper.n_queued, shipper.n_dropped) == (1, 1)
+
+
+def test_init_sentry_once(monkeypatch):
+    from types import SimpleNamespace
+    import sentry_sdk
+    from cdci_data_analysis.flask_app import app as flask_app_module
+
+    init_kwargs = []
+    monkeypatch.setattr(sentry_sdk, 'init', lambda **kwargs: init_kwargs.append(kwargs))
+    monkeypatch.setattr(flask_app_module, 'sentry_initialized_dsn', None)
+
+    conf = SimpleNamespace(sentry_url="https://key@sentry.example/1",
+                           sentry_traces_sample_rate=0.05,
+                           sentry_debug=False)
+
+    for i in range(3):
+        flask_app_module.init_sentry(conf)
+
+    assert len(init_kwargs) == 1
+    assert init_kwargs[0]['traces_sample_rate'] == 0.05
+    assert init_kwargs[0]['debug'] is False
+
+    flask_app_module.init_sentry(SimpleNamespace(sentry_url=None))
+    assert len(init_kwargs) == 1
+
+
+def test_download_archive(tmpdir):
+    import gzip
+    import tarfile
+    import io
+    from cdci_data_analysis.flask_app.download_cache import DownloadCache, iter_download_archive
+
+    fits_content = os.urandom(1000) + b'\0' * 3000000
+    compressed_content = gzip.compress(os.urandom(5000))
+
+    file_list = []
+    for name, content in [('spectrum.fits', fits_content), ('image.fits.gz', compressed_content)]:
+        file_list.append(os.path.join(tmpdir, name))
+        with open(file_list[-1], 'wb') as f:
+            f.write(content)
+
+    cache = DownloadCache(os.path.join(tmpdir, 'download_cache'))
+
+    # single file, gzipped
+    data = b''.join(iter_download_archive(file_list[:1], 'single'))
+    assert gzip.decompress(data) == fits_content
+    assert len(data) < 100000
+
+    # already compressed file: only stored, not compressed again
+    data = b''.join(iter_download_archive(file_list[1:], 'single'))
+    assert gzip.decompress(data) == compressed_content
+    assert len(data) < len(compressed_content) + 100
+
+    # several files, in a tar.gz readable by tarfile
+    key = cache.key('job_id', file_list, out_dir='spectra')
+    assert cache.get(key) is None
+
+    data = b''.join(cache.stream(key, iter_download_archive(file_list, 'spectra')))
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        assert tar.getnames() == ['spectra/spectrum.fits', 'spectra/image.fits.gz']
+        assert tar.extractfile('spectra/spectrum.fits').read() == fits_content
+        assert tar.extractfile('spectra/image.fits.gz').read() == compressed_content
+
+    cached_path = cache.get(key)
+    assert open(cached_path, 'rb').read() == data
+
+    # interrupted download: nothing is cached
+    other_key = cache.key('other_job_id', file_list, out_dir='spectra')
+    stream = cache.stream(other_key, iter_download_archive(file_list, 'spectra'))
+    next(stream)
+    stream.close()
+    assert cache.get(other_key) is None
+    assert os.listdir(cache.cache_dir) == [key]
+
+    # the files changed: the archive is rebuilt
+    time.sleep(0.01)
+    with open(file_list[0], 'ab') as f:
+        f.write(b'more')
+    assert cache.key('job_id', file_list, out_dir='spectra') != key
+
+    # the least recently used archives are evicted above the size limit
+    cache.max_size_bytes = int(len(data) * 2.5)
+    keys = [key]
+    for i in range(3):
+        time.sleep(0.01)
+        keys.append(cache.key(f'job_id_{i}', file_list, out_dir='spectra'))
+        b''.join(cache.stream(keys[-1], iter_download_archive(file_list, 'spectra')))
+
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[-1]) is not None
+    assert len(os.listdir(cache.cache_dir)) == 2
+
+
+def test_download_archive_parallel_gzip(tmpdir):
+    import gzip
+    import tarfile
+    import io
+    from cdci_data_analysis.flask_app.download_cache import iter_download_archive, iter_gzip_parallel, select_compression
+    from cdci_data_analysis.analysis.exceptions import RequestNotUnderstood
+
+    contents = {'spectrum.fits': os.urandom(100) + b'\1' * 3500000,
+                'image.fits.gz': gzip.compress(os.urandom(300000)),
+                'empty.fits': b''}
+
+    file_list = []
+    for name, content in contents.items():
+        file_list.append(os.path.join(tmpdir, name))
+        with open(file_list[-1], 'wb') as f:
+            f.write(content)
+
+    # several gzip members, concatenated by the standard decoders
+    data = b''.join(iter_download_archive(file_list, 'spectra', compression='parallel_gzip'))
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        for name, content in contents.items():
+            assert tar.extractfile(f'spectra/{name}').read() == content
+
+    data = b''.join(iter_download_archive(file_list[:1], 'single', compression='parallel_gzip'))
+    assert gzip.decompress(data) == contents['spectrum.fits']
+    assert data.count(b'\x1f\x8b\x08') >= 4
+
+    assert gzip.decompress(b''.join(iter_gzip_parallel(iter([])))) == b''
+
+    assert select_compression(None) == 'gzip'
+    assert select_compression('parallel_gzip') == 'parallel_gzip'
+    with pytest.raises(RequestNotUnderstood):
+        select_compression('rar')
+
+
+def test_download_archive_compression_benchmark(tmpdir):
+    import gzip
+    from cdci_data_analysis.flask_app import download_cache
+
+    # an image-like product: noisy values, partly compressible
+    rng = np.random.default_rng(0)
+    product_fn = os.path.join(tmpdir, 'mosaic.fits')
+    with open(product_fn, 'wb') as f:
+        f.write(np.round(rng.normal(100, 10, 1024 * 1024)).astype('>i4').tobytes())
+
+    size = os.path.getsize(product_fn)
+
+    for compression in ['gzip', 'parallel_gzip'] + (['zstd'] if download_cache.zstandard is not None else []):
+        t0 = time.time()
+        data = b''.join(download_cache.iter_download_archive([product_fn], 'mosaic', compression=compression))
+        dt = time.time() - t0
+
+        print(f"{compression}: {size / dt / 1024**2:.3g} MB/s, compressed to {len(data) / size:.3g} "
+              f"with {os.cpu_count()} cpus")
+
+        if compression != 'zstd':
+            assert len(gzip.decompress(data)) == size
+
+
+def test_js9_extension_cache(tmpdir, monkeypatch):
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from cdci_data_analysis.flask_app.js9_extraction import JS9ExtensionCache
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [83.6, 22.0]
+    wcs.wcs.crpix = [500.5, 300.5]
+    wcs.wcs.cdelt = [-0.01, 0.01]
+
+    image = np.arange(600 * 1000, dtype=np.float32).reshape(600, 1000)
+    image[:4, :4] = np.nan
+
+    file_path = os.path.join(tmpdir, 'mosaic.fits')
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(np.zeros((2, 2))),
+                  fits.ImageHDU(image, header=wcs.to_header())]).writeto(file_path)
+
+    cache = JS9ExtensionCache(os.path.join(tmpdir, 'js9_cache'))
+
+    js9_file_path = cache.get(file_path, 2)
+    assert os.path.dirname(js9_file_path) == cache.cache_dir
+    assert np.array_equal(fits.getdata(js9_file_path, 1), image, equal_nan=True)
+    assert cache.get(file_path, 2) == js9_file_path
+    assert (cache.n_hits, cache.n_misses) == (1, 1)
+
+    # downsampled: the sky position of the pixels is kept
+    downsampled_file_path = cache.get(file_path, 2, max_size=300)
+    assert downsampled_file_path != js9_file_path
+    # on the grid of the sizes
+    assert cache.get(file_path, 2, max_size=256) == downsampled_file_path
+    with fits.open(downsampled_file_path) as hdul:
+        data = hdul[1].data
+        assert data.shape == (150, 250)
+        assert np.isnan(data[0, 0])
+        assert data[1, 1] == np.mean(image[4:8, 4:8])
+        downsampled_wcs = WCS(hdul[1].header)
+
+    assert np.allclose(downsampled_wcs.pixel_to_world_values(0, 0), wcs.pixel_to_world_values(1.5, 1.5))
+
+    # cutout, in pixels, on the grid
+    cutout_file_path = cache.get(file_path, 2, cutout=(130, 190, 50))
+    assert cache.get(file_path, 2, cutout=(120, 200, 64)) == cutout_file_path
+    with fits.open(cutout_file_path) as hdul:
+        assert np.array_equal(hdul[1].data, image[160:224, 96:160])
+        assert np.allclose(WCS(hdul[1].header).pixel_to_world_values(0, 0), wcs.pixel_to_world_values(96, 160))
+
+    # found without reading the source
+    with monkeypatch.context() as m:
+        m.setattr(fits, 'getheader', lambda *args: pytest.fail("header read on a cache hit"))
+        assert cache.get(file_path, 2, cutout=(130, 190, 50)) == cutout_file_path
+
+    # limited to the image
+    assert cache.get(file_path, 2, cutout=(970, 590, 4000)) == cache.get(file_path, 2, cutout=(960, 580, 1024))
+
+    for cutout in [(1000, 10, 64), (10, -1, 64), (10, 10, 0), (10, float('nan'), 64)]:
+        with pytest.raises(ValueError):
+            cache.get(file_path, 2, cutout=cutout)
+
+    with pytest.raises(ValueError):
+        cache.get(file_path, 2, max_size=0)
+
+    # the least recently used are removed
+    cache.get(file_path, 2)
+    cache.max_size_bytes = os.path.getsize(js9_file_path) + 1
+    time.sleep(0.01)
+    cache.get(file_path, 2, cutout=(500, 300, 512))
+    assert sorted(os.listdir(cache.cache_dir)) == [os.path.basename(cache.get(file_path, 2, cutout=(500, 300, 512)))]
+    cache.max_size_bytes = 1024**3
+
+    # the source changed
+    time.sleep(0.01)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.ones((3, 3)))]).writeto(file_path, overwrite=True)
+    assert np.array_equal(fits.getdata(cache.get(file_path, 1), 1), np.ones((3, 3)))
+
+    assert not any('.tmp-' in fn for fn in os.listdir(tmpdir))
+
+
+def test_query_output_npz(tmpdir):
+    import io
+    from astropy.io import fits
+    from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
+    from cdci_data_analysis.analysis.products import QueryOutput
+    from cdci_data_analysis.analysis.exceptions import ProblemDecodingStoredQueryOut
+    from cdci_data_analysis.analysis.json import CustomJSONEncoder
+    from cdci_data_analysis.analysis import query_output_store
+
+    table_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='TIME', format='D', array=np.arange(1000.)),
+        fits.Column(name='RATE', format='E', array=np.ones(1000), unit='count/s'),
+        fits.Column(name='SPECTRUM', format='PE()', array=[np.ones(i % 5 + 1) for i in range(1000)]),
+    ], name='LC')
+    table_hdu.writeto(os.path.join(tmpdir, 'lc.fits'))
+
+    light_curve = NumpyDataProduct.from_fits_file(os.path.join(tmpdir, 'lc.fits'), meta_data={'product': 'lc'})
+
+    image = NumpyDataProduct(data_unit=[NumpyDataUnit(data=None, name='primary', hdu_type='primary'),
+                                        NumpyDataUnit(data=np.random.normal(size=(200, 300)).astype('>f4'),
+                                                      data_header={'EXTNAME': 'IMAGE', 'BUNIT': 'ct'},
+                                                      meta_data={'src': 'Crab'},
+                                                      name='image',
+                                                      hdu_type='image')],
+                             name='image',
+                             meta_data={'product': 'image'})
+
+    query_out = QueryOutput()
+    query_out.set_done(message="done", debug_message="", job_status='done')
+    query_out.prod_dictionary = {
+        'numpy_data_product_list': [
+            NumpyDataProduct(data_unit=[NumpyDataUnit(data=np.linspace(0, 1, 1000), name='spectrum')], name='spectrum'),
+            image,
+            light_curve,
+        ],
+        'image': {'data': np.random.normal(size=(100, 50)), 'units': ['ct', 's']},
+        'empty': np.zeros(0),
+        'analysis_parameters': {'RA': 83.6, 'product_type': 'image'},
+    }
+
+    json_buffer = io.StringIO()
+    query_out.serialize(json_buffer)
+
+    npz_filename = os.path.join(tmpdir, query_output_store.npz_filename)
+    query_out.serialize_npz(npz_filename)
+
+    restored = QueryOutput()
+    restored.deserialize_npz(npz_filename)
+
+    # arrays are kept as arrays, memory-mapped
+    assert isinstance(restored.prod_dictionary['image']['data'], np.memmap)
+    assert np.array_equal(restored.prod_dictionary['image']['data'], query_out.prod_dictionary['image']['data'])
+    assert restored.status_dictionary['job_status'] == 'done'
+
+    # the products are rebuilt, with their data out of the json header
+    assert len(query_output_store.load_npz_members(npz_filename)['header']) < 10000
+
+    restored_image = restored.prod_dictionary['numpy_data_product_list'][1]
+    assert isinstance(restored_image, NumpyDataProduct)
+    assert restored_image.name == 'image'
+    assert restored_image.meta_data == {'product': 'image'}
+    assert restored_image.data_unit[0].data is None
+    restored_image_unit = restored_image.data_unit[1]
+    assert isinstance(restored_image_unit.data, np.memmap)
+    assert np.array_equal(restored_image_unit.data, image.data_unit[1].data)
+    assert restored_image_unit.data.dtype == np.dtype('>f4')
+    assert (restored_image_unit.header, restored_image_unit.meta_data, restored_image_unit.name,
+            restored_image_unit.hdu_type) == ({'EXTNAME': 'IMAGE', 'BUNIT': 'ct'}, {'src': 'Crab'}, 'image', 'image')
+
+    # the tables are loaded in their encoding, and keep their columns definitions once decoded
+    restored_light_curve = NumpyDataProduct.decode(restored.prod_dictionary['numpy_data_product_list'][2])
+    assert restored_light_curve.meta_data == {'product': 'lc'}
+    restored_lc_hdu = restored_light_curve.get_data_unit_by_name('LC').to_fits_hdu()
+    assert restored_lc_hdu.columns['RATE'].unit == 'count/s'
+    assert np.array_equal(restored_lc_hdu.data['TIME'], np.arange(1000.))
+    assert np.array_equal(restored_lc_hdu.data['SPECTRUM'][3], np.ones(4))
+
+    # the responses built from either format are the same, the products once decoded
+    def decoded_products(response):
+        return [NumpyDataProduct.decode(p) for p in response['prod_dictionary'].pop('numpy_data_product_list')]
+
+    def same_data(a, b):
+        if a is None or b is None:
+            return a is None and b is None
+        if a.dtype.names is None:
+            return np.array_equal(a, b)
+        return all(np.array_equal(x, y) for n in a.dtype.names for x, y in zip(a[n], b[n]))
+
+    restored_state = {k: v for k, v in restored.__dict__.items() if not k.startswith("_")}
+    restored_response = json.loads(json.dumps(restored_state, cls=CustomJSONEncoder))
+    json_response = json.loads(json_buffer.getvalue())
+
+    for restored_product, json_product in zip(decoded_products(restored_response), decoded_products(json_response)):
+        assert (restored_product.name, restored_product.meta_data) == (json_product.name, json_product.meta_data)
+        for restored_unit, json_unit in zip(restored_product.data_unit, json_product.data_unit):
+            assert (restored_unit.name, restored_unit.header, restored_unit.meta_data, restored_unit.hdu_type) == \
+                   (json_unit.name, json_unit.header, json_unit.meta_data, json_unit.hdu_type)
+            assert same_data(restored_unit.data, json_unit.data)
+
+    assert restored_response == json_response
+
+    assert query_output_store.load_query_output_state(str(tmpdir))['status_dictionary']['job_status'] == 'done'
+
+    # json fallback
+    os.remove(npz_filename)
+    with open(os.path.join(tmpdir, query_output_store.json_filename), 'w') as f:
+        f.write(json_buffer.getvalue())
+    assert query_output_store.load_query_output_state(str(tmpdir))['prod_dictionary']['image']['units'] == ['ct', 's']
+
+    # truncated archive
+    with open(npz_filename, 'wb') as f:
+        f.write(b'PK\x03\x04')
+    with pytest.raises(ProblemDecodingStoredQueryOut):
+        QueryOutput().deserialize_npz(npz_filename)
+
+
+@pytest.mark.parametrize("query_output_format", ["json", "npz"])
+def test_query_output_status_record(tmpdir, query_output_format):
+    from cdci_data_analysis.analysis.products import QueryOutput
+    from cdci_data_analysis.analysis.exceptions import ProblemDecodingStoredQueryOut
+    from cdci_data_analysis.analysis import query_output_store
+
+    query_out = QueryOutput()
+    query_out.set_done(message="done", debug_message="", job_status='done')
+    query_out.prod_dictionary = {'image': {'data': np.random.normal(size=(100, 50))}, 'api_code': 'print(1)'}
+
+    if query_output_format == 'npz':
+        stored_filename = os.path.join(tmpdir, query_output_store.npz_filename)
+        query_out.serialize_npz(stored_filename)
+    else:
+        stored_filename = os.path.join(tmpdir, query_output_store.json_filename)
+        with open(stored_filename, 'w') as f:
+            query_out.serialize(f)
+
+    status_filename = os.path.join(tmpdir, query_output_store.status_filename)
+    query_output_store.dump_status(query_out.status_dictionary, stored_filename, status_filename)
+
+    restored = QueryOutput()
+    restored.deserialize_status(status_filename)
+    assert restored.get_job_status() == 'done'
+    assert restored.prod_dictionary == {}
+
+    restored.load_products()
+    assert restored.prod_dictionary['api_code'] == 'print(1)'
+    assert np.array_equal(restored.prod_dictionary['image']['data'], query_out.prod_dictionary['image']['data'])
+
+    # loaded once
+    os.remove(stored_filename)
+    restored.load_products()
+
+    restored = QueryOutput()
+    restored.deserialize_status(status_filename)
+    with pytest.raises(FileNotFoundError):
+        restored.load_products()
+
+    with open(status_filename, 'w') as f:
+        f.write('{"status_dictionary": ')
+    with pytest.raises(ProblemDecodingStoredQueryOut):
+        QueryOutput().deserialize_status(status_filename)
+
+
+def test_async_dispatcher_query_products_not_in_place(tmpdir):
+    import logging
+    from cdci_data_analysis.analysis.products import QueryOutput
+    from cdci_data_analysis.analysis import query_output_store
+    from cdci_data_analysis.flask_app.dispatcher_query import InstrumentQueryBackEnd
+
+    query = InstrumentQueryBackEnd.__new__(InstrumentQueryBackEnd)
+    query.scratch_dir = str(tmpdir)
+    query.logger = logging.getLogger('test')
+
+    requests_query_out = []
+    query.request_query_out = lambda overwrite=False: requests_query_out.append(overwrite)
+
+    query_out = QueryOutput()
+    query_out.set_done(message="done", debug_message="", job_status='done')
+    query_out.prod_dictionary = {'api_code': 'print(1)'}
+
+    with open(query.response_filename + ".job-monitor", 'w') as f:
+        json.dump({'status': 'done'}, f)
+
+    # the status record is written, the products are not renamed in place yet
+    query_output_store.dump_status(query_out.status_dictionary, query.response_npz_filename,
+                                   query.response_status_filename)
+
+    _, job_monitor, query_new_status = query.async_dispatcher_query('submitted')
+    assert (job_monitor, query_new_status) == (None, 'submitted')
+    # the finished job is not submitted again
+    assert requests_query_out == [False]
+
+    query_out.serialize_npz(query.response_npz_filename)
+
+    restored, job_monitor, query_new_status = query.async_dispatcher_query('submitted')
+    assert (job_monitor, query_new_status) == ({'status': 'done'}, 'done')
+    assert restored.prod_dictionary['api_code'] == 'print(1)'
+    assert requests_query_out == [False]
+
+
+def test_task_state_tracker(tmpdir, monkeypatch):
+    from cdci_data_analysis.flask_app import tasks
+
+    flower_calls = []
+    flower_tasks = {'known-task': {'state': 'PENDING'}}
+
+    def flower_task(task_id, timeout=None):
+        assert timeout is not None
+        flower_calls.append(task_id)
+        if task_id == 'flower-down':
+            raise ConnectionError("flower is down")
+        return flower_tasks.get(task_id)
+
+    monkeypatch.setattr(tasks, 'flower_task', flower_task)
+
+    tracker = tasks.TaskStateTracker(str(tmpdir), flower_check_interval_s=3600, flower_timeout_s=1)
+    monkeypatch.setattr(tasks, 'task_state_tracker', tracker)
+
+    for task_id in ['known-task', 'lost-task', 'flower-down']:
+        tracker.record(task_id, 'PENDING', replace=False)
+
+    for i in range(5):
+        assert tracker.state('known-task') == 'PENDING'
+        assert tracker.state('lost-task') == 'UNEXISTENT'
+        assert tracker.state('flower-down') == 'PENDING'
+
+    # once per task and interval
+    assert sorted(flower_calls) == ['flower-down', 'known-task', 'lost-task']
+
+    # pushed by the worker
+    tasks.task_started(sender=tasks.request_dispatcher, task_id='known-task')
+    assert tracker.state('known-task') == 'STARTED'
+
+    # the dispatcher records PENDING after sending the task, possibly after the worker started it
+    tracker.record('known-task', 'PENDING', replace=False)
+    assert tracker.state('known-task') == 'STARTED'
+
+    tasks.task_failed(sender=tasks.request_dispatcher, task_id='known-task')
+    assert tracker.state('known-task') == 'FAILURE'
+
+    assert len(flower_calls) == 3
+
+    tracker.flower_check_interval_s = 0
+    time.sleep(0.01)
+    assert tracker.state('lost-task') == 'UNEXISTENT'
+    assert len(flower_calls) == 4
+
+    # the job is finished
+    tracker.forget('known-task')
+    assert tracker.read('known-task') is None
+
+    # recorded by the worker after the job was found finished, pruned once old enough
+    tracker.record('late-task', 'SUCCESS')
+    tracker.record('running-task', 'STARTED')
+    tracker.prune_age_s = 0
+    time.sleep(0.01)
+    tracker.forget('lost-task')
+    assert tracker.read('late-task') is None
+    assert tracker.read('running-task')['state'] == 'STARTED'
+    assert sorted(os.listdir(tmpdir)) == ['flower-down.json', 'running-task.json']
+
+
+def test_run_dispatcher_query_in_worker(dispatcher_test_conf_fn, tmpdir, monkeypatch):
+    from cdci_data_analysis.flask_app import tasks
+    from cdci_data_analysis.analysis import query_output_store
+    from cdci_data_analysis.plugins import importer
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument
+
+    def no_loopback(*args, **kwargs):
+        raise AssertionError("the dispatcher should not be requested")
+
+    monkeypatch.setattr(tasks.requests, 'get', no_loopback)
+    monkeypatch.setattr(importer, 'instrument_factory_list', [empty_instrument.my_instr_factory])
+    importer.invalidate_instrument_templates()
+    monkeypatch.chdir(tmpdir)
+
+    params = {
+        'query_status': 'new',
+        'query_type': 'Dummy',
+        'instrument': 'empty',
+        'product_type': 'dummy',
+        'async_dispatcher': False,
+    }
+
+    tasks.run_dispatcher_query(params, conf_file=dispatcher_test_conf_fn, cwd=str(tmpdir), url="http://localhost:1/run_analysis")
+
+    scratch_dirs = glob.glob(os.path.join(str(tmpdir), "scratch_sid_*_jid_*"))
+    assert len(scratch_dirs) == 1
+
+    state = query_output_store.load_query_output_state(scratch_dirs[0])
+    assert state['status_dictionary']['job_status'] == 'done'
+    assert os.path.exists(os.path.join(scratch_dirs[0], query_output_store.status_filename))
+
+    # the worker runs elsewhere
+    loopback_requests = []
+    monkeypatch.setattr(tasks, 'request_dispatcher', lambda url, **params: loopback_requests.append((url, params)))
+    tasks.run_dispatcher_query(params, conf_file=dispatcher_test_conf_fn, cwd="/elsewhere", url="http://localhost:1/run_analysis")
+    assert loopback_requests == [("http://localhost:1/run_analysis", params)]
+
+    importer.invalidate_instrument_templates()
+
+
+def test_local_async_executor(dispatcher_test_conf_fn, tmpdir, monkeypatch):
+    import threading
+    from cdci_data_analysis.flask_app import tasks, async_executor
+    from cdci_data_analysis.flask_app.app import conf_app
+    from cdci_data_analysis.analysis import query_output_store
+    from cdci_data_analysis.plugins import importer
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument
+
+    monkeypatch.setattr(tasks, 'task_state_tracker', tasks.TaskStateTracker(str(tmpdir.join('task-state'))))
+
+    release = threading.Event()
+    running = []
+
+    def blocking_query(app, params):
+        running.append(params['instrument'])
+        assert release.wait(10)
+
+    monkeypatch.setattr(tasks, 'run_query_in_app', blocking_query)
+
+    executor = async_executor.LocalAsyncExecutor(max_workers=2, max_queued=3, instrument_max_workers={'isgri': 1})
+
+    task_ids = [executor.submit(None, {'instrument': 'isgri'}, None) for i in range(3)]
+    assert None not in task_ids
+    # bounded queue
+    assert executor.submit(None, {'instrument': 'jemx'}, None) is None
+
+    # one isgri query at once
+    assert [executor.state(task_id) for task_id in task_ids] == ['STARTED', 'PENDING', 'PENDING']
+    assert running == ['isgri']
+
+    release.set()
+    for i in range(100):
+        if executor.n_running == 0 and len(executor._queued) == 0:
+            break
+        time.sleep(0.1)
+
+    assert [executor.state(task_id) for task_id in task_ids] == ['SUCCESS'] * 3
+    assert executor.state('unknown-task') == 'UNEXISTENT'
+
+    # lost with the process which queued it
+    tasks.task_state_tracker.record('lost-task', 'PENDING', pid=os.getpid())
+    assert executor.state('lost-task') == 'UNEXISTENT'
+
+    # the queries run in the dispatcher process store their output
+    monkeypatch.undo()
+    monkeypatch.setattr(tasks, 'task_state_tracker', tasks.TaskStateTracker(str(tmpdir.join('task-state'))))
+    monkeypatch.setattr(importer, 'instrument_factory_list', [empty_instrument.my_instr_factory])
+    importer.invalidate_instrument_templates()
+    monkeypatch.chdir(tmpdir)
+
+    app = conf_app(dispatcher_test_conf_fn)
+    executor = async_executor.LocalAsyncExecutor(max_workers=1)
+    task_id = executor.submit(app, {'query_status': 'new', 'query_type': 'Dummy', 'instrument': 'empty',
+                                    'product_type': 'dummy', 'async_dispatcher': False}, None)
+    for i in range(100):
+        if executor.state(task_id) == 'SUCCESS':
+            break
+        time.sleep(0.1)
+
+    assert executor.state(task_id) == 'SUCCESS'
+
+    scratch_dirs = glob.glob(os.path.join(str(tmpdir), "scratch_sid_*_jid_*"))
+    assert len(scratch_dirs) == 1
+    assert query_output_store.load_query_output_state(scratch_dirs[0])['status_dictionary']['job_status'] == 'done'
+
+    importer.invalidate_instrument_templates()
+
+
+def test_get_async_executor_configuration(dispatcher_test_conf_fn):
+    from cdci_data_analysis.flask_app import async_executor
+    from cdci_data_analysis.configurer import ConfigEnv
+
+    conf = ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
+
+    conf.async_executor = 'unknown'
+    with pytest.raises(ValueError, match="not one of"):
+        async_executor.get_async_executor(conf)
+
+    # the processes of the pool can not be configured without the file
+    conf.async_executor = 'process'
+    conf.origin = None
+    with pytest.raises(ValueError, match="loaded from a file"):
+        async_executor.get_async_executor(conf)
+
+
+def test_backend_health_circuit_breaker(monkeypatch):
+    from cdci_data_analysis.analysis import backend_health as backend_health_module
+    from cdci_data_analysis.analysis.backend_health import BackendHealth
+    from cdci_data_analysis.analysis.queries import ProductQuery
+    from cdci_data_analysis.analysis.products import QueryOutput
+
+    health = BackendHealth(ttl_s=3600, failure_threshold=2, open_s=3600)
+    monkeypatch.setattr('cdci_data_analysis.analysis.queries.backend_health', health)
+
+    transitions = []
+    health.listeners.append(lambda *args: transitions.append(args))
+
+    class FakeInstrument:
+        name = 'fake'
+        available = True
+        n_probes = 0
+
+        def test_communication(self, config, logger=None):
+            self.n_probes += 1
+            if not self.available:
+                raise ConnectionError("backend down")
+            query_out = QueryOutput()
+            query_out.set_done()
+            return query_out
+
+    instrument = FakeInstrument()
+    query = ProductQuery('fake_query')
+
+    # healthy: probed once, then skipped
+    for i in range(3):
+        assert query.test_communication(instrument).get_status() == 0
+    assert instrument.n_probes == 1
+
+    # the cached health expires, the backend is down
+    health.ttl_s = 0
+    instrument.available = False
+    for i in range(2):
+        assert query.test_communication(instrument).get_status() == 1
+    assert instrument.n_probes == 3
+    assert transitions == [('fake', backend_health_module.CLOSED, backend_health_module.OPEN)]
+
+    # open: failing fast, with a clear message
+    query_out = query.test_communication(instrument)
+    assert query_out.get_status() == 1
+    assert 'unavailable' in query_out.status_dictionary['error_message']
+    assert instrument.n_probes == 3
+
+    # half-open: one probe, the backend is still down
+    health.open_s = 0
+    assert query.test_communication(instrument).get_status() == 1
+    assert instrument.n_probes == 4
+    assert transitions[-2:] == [('fake', 'open', 'half-open'), ('fake', 'half-open', 'open')]
+
+    # half-open: the backend is back
+    instrument.available = True
+    assert query.test_communication(instrument).get_status() == 0
+    assert transitions[-1] == ('fake', 'half-open', 'closed')
+
+    metrics = health.metrics()
+    assert metrics['backends']['fake']['state'] == 'closed'
+    assert {'backend': 'fake', 'from': 'closed', 'to': 'open', 'count': 1} in metrics['transitions']
+
+    # in half-open, only one query probes the backend
+    health.record_failure('fake')
+    health.record_failure('fake')
+    assert health.check('fake') == 'probe'
+    assert health.check('fake') == 'fail'
+
+
+def test_backend_http_session_pool():
+    import threading
+    import requests
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from cdci_data_analysis.analysis.backend_sessions import backend_sessions
+    from cdci_data_analysis.analysis.products import QueryOutput
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument
+
+    opened_connections = []
+
+    class StandInBackend(BaseHTTPRequestHandler):
+        # keep-alive
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            opened_connections.append(self.client_address)
+            super().setup()
+
+        def do_GET(self):
+            body = json.dumps({'status': 'ok', 'cookie': self.headers.get('Cookie')}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Set-Cookie', 'session=user-specific; Path=/')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInBackend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/test-communication"
+
+    class DataServerQuery:
+        def __init__(self, config=None, instrument=None):
+            self.instrument = instrument
+
+        def test_communication(self, logger=None):
+            assert self.instrument.http_session.get(url).json()['status'] == 'ok'
+            query_out = QueryOutput()
+            query_out.set_done()
+            return query_out
+
+    try:
+        backend_sessions.configure(pool_size=2, connect_timeout=1, read_timeout=5)
+
+        instrument = empty_instrument.my_instr_factory()
+        instrument.data_server_query_class = DataServerQuery
+
+        for i in range(10):
+            assert instrument.test_communication(None).get_status() == 0
+
+        # the connection is reused
+        assert len(opened_connections) == 1
+        assert instrument.http_session is backend_sessions.get(instrument.name)
+        assert instrument.http_session.timeout == (1, 5)
+
+        # the cookies of a user are not sent with the requests of the next ones
+        assert instrument.http_session.get(url).cookies['session'] == 'user-specific'
+        assert instrument.http_session.get(url).json()['cookie'] is None
+        assert len(instrument.http_session.cookies) == 0
+        assert instrument.http_session.get(url, cookies={'token': 'x'}).json()['cookie'] == 'token=x'
+        assert instrument.http_session.get(url).json()['cookie'] is None
+
+        # without the shared session
+        for i in range(10):
+            requests.get(url)
+        assert len(opened_connections) == 11
+    finally:
+        server.shutdown()
+        server.server_close()
+        backend_sessions.configure(pool_size=10, connect_timeout=10, read_timeout=300)
+
+
+def test_parameter_normalizer_benchmark(caplog):
+    import copy
+    import logging
+
+    n_parameters = 300
+
+    def build_instrument():
+        product_queries = [
+            ProductQuery(f"{product_type}_query",
+                         parameters_list=[Float(value=float(i), name=f"{product_type}_p{i}", units='keV')
+                                          for i in range(n_parameters)] +
+                                         [Time(value='2008-01-01T11:11:11.0', name='T1', Time_format_name='T_format')])
+            for product_type in ['spectrum', 'image']
+        ]
+
+        return Instrument("benchmark",
+                          src_query=SourceQuery("src_query"),
+                          instrumet_query=InstrumentQuery(name="benchmark_instrument_query"),
+                          product_queries_list=product_queries,
+                          query_dictionary={'spectrum': 'spectrum_query', 'image': 'image_query'})
+
+    template = build_instrument()
+
+    arg_dic = {'instrument': 'benchmark',
+               'product_type': 'spectrum',
+               'T1': '2010-01-01T00:00:00',
+               'T_format': 'isot',
+               'unknown_argument': 1,
+               **{f"spectrum_p{i}": str(i / 2) for i in range(0, n_parameters, 2)}}
+
+    # as the dispatcher, which copies the instrument template for each request
+    instrument = copy.deepcopy(template)
+    normalized = instrument.set_pars_from_dic(arg_dic)
+    assert normalized['spectrum_p2'] == 1.
+    assert normalized['spectrum_p3'] == 3.
+    assert normalized['T1'] == '2010-01-01T00:00:00.000'
+    assert 'image_p2' not in normalized
+    assert instrument.unknown_arguments_name_list == ['unknown_argument']
+    assert instrument.get_par_by_name('spectrum_p2').value == 1.
+
+    # the normalizer is compiled once for the copies, and the values are set in the copy being normalized
+    assert instrument._parameter_normalizers is template._parameter_normalizers
+    assert template.get_par_by_name('spectrum_p2').value == 2.
+
+    with caplog.at_level(logging.INFO):
+        n_repeat = 20
+
+        t0 = time.time()
+        for i in range(n_repeat):
+            instrument._parameter_normalizers.clear()
+            uncompiled_normalized = instrument.set_pars_from_dic(arg_dic)
+        dt_uncompiled = (time.time() - t0) / n_repeat
+
+        t0 = time.time()
+        for i in range(n_repeat):
+            compiled_normalized = instrument.set_pars_from_dic(arg_dic)
+        dt_compiled = (time.time() - t0) / n_repeat
+
+    assert compiled_normalized == uncompiled_normalized == normalized
+
+    print(f"set_pars_from_dic with {len(arg_dic)} arguments and {2 * n_parameters} parameters: "
+          f"{dt_uncompiled * 1e3:.3g} ms resolving the parameters, {dt_compiled * 1e3:.3g} ms compiled")
+
+    assert dt_compiled < dt_uncompiled